@@ -113,6 +113,12 @@ BILLING_AGREEMENT_DESCRIPTION = BILLING_AGREEMENT_NAME
 BILLING_COMPONENTS = ["fullctl.prefixctl"]
 BILLING_HANDLERS = ["billing.product_handlers.fullctl.PrefixCtlPrefixes"]
 BILLING_PROCESSORS = ["billing.payment_processors.stripe.Stripe"]
+
+# in-memory payment processor for development and load testing, never
+# contacts a payment provider - do not enable in production
+settings_manager.set_option("BILLING_SIMULATED_PROCESSOR", False)
+if BILLING_SIMULATED_PROCESSOR:
+    BILLING_PROCESSORS.append("billing.payment_processors.simulated.Simulated")
 BILLING_DEFAULT_CURRENCY = "USD"
 
 
@@ -263,6 +269,18 @@ settings_manager.set_option("AUTO_USER_TO_ORG", None, str)
 # expiry for invite links (days)
 settings_manager.set_option("INVITE_EXPIRY", 3)
 
+# wait this many seconds before recomputing queued permission changes,
+# so changes made in quick succession are recomputed together
+settings_manager.set_option("PERMISSION_UPDATE_DELAY", 10)
+
+# cache compiled permission sets across requests in this cache, needs to
+# be a redis or memcached cache shared between all processes serving
+# requests (checked on startup), not cached if None
+settings_manager.set_option("PERMISSIONS_CACHE", None, str)
+
+# expiry for cached permission sets (seconds)
+settings_manager.set_option("PERMISSIONS_CACHE_TIMEOUT", 3600)
+
 # look for mainsite/settings/${RELEASE_ENV}_append.py and load if it exists
 env_file = os.path.join(os.path.dirname(__file__), f"{RELEASE_ENV}_append.py")
 settings_manager.try_include(env_file)
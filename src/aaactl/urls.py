@@ -19,9 +19,8 @@ from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
 from django.views.generic import RedirectView
-from django_grainy.remote import ProvideGet, ProvideLoad
 
-from account.grainy_ext import APIKeyAuthenticator
+from account.grainy_ext import APIKeyAuthenticator, ProvideGet, ProvideLoad
 
 # OAuth2 provider endpoints
 oauth2_endpoint_views = [
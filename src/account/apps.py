@@ -6,3 +6,6 @@ class AccountConfig(AppConfig):
 
     def ready(self):
         import account.signals  # noqa: F401
+        from account.permissions import check_cache
+
+        check_cache()
@@ -1,32 +1,89 @@
+import collections.abc
+
 from django.conf import settings
+from grainy.const import PERM_CREATE, PERM_DELETE, PERM_READ, PERM_UPDATE
+
+
+class PermissionsContext(collections.abc.Mapping):
+
+    """
+    CRUD permission flags of the selected organization's permission
+    namespaces as template context
+
+    Keys are `<op>_<tag>_<namespace>`, for example `read_org_billing`, and
+    `has_asn`. They are computed the first time a template reads them, so
+    pages that do not use them do not pay for them.
+    """
+
+    ops = [
+        (PERM_CREATE, "create"),
+        (PERM_READ, "read"),
+        (PERM_UPDATE, "update"),
+        (PERM_DELETE, "delete"),
+    ]
+
+    def __init__(self, request):
+        self.request = request
+        self._context = None
+
+    @property
+    def context(self):
+        if self._context is None:
+            self._context = self.compile()
+        return self._context
+
+    def compile(self):
+        context = {}
+
+        try:
+            instances = [self.request.selected_org]
+        except AttributeError:
+            return context
+
+        perms = self.request.perms
+
+        # the permission set is read directly below, make sure it is loaded
+        # on pages that did not check any permissions yet
+        perms.load()
+
+        for instance in instances:
+            if not instance:
+                continue
+            for namespace in instance.permission_namespaces:
+                target = namespace.format(org_id=instance.id)
+                name = namespace.replace(".{org_id}", "").replace(".", "__")
+
+                # a single lookup in the permission index answers all four
+                # operations (same as `check` with `ignore_grant_all`),
+                # namespaces with wildcards need to be checked per operation
+                if perms.pset.expandable(target):
+                    flags = None
+                else:
+                    flags = perms.pset.get_permissions(target)
+
+                for flag, op in self.ops:
+                    key = f"{op}_{instance.HandleRef.tag}_{name}"
+                    if flags is None:
+                        context[key] = perms.check(target, flag, ignore_grant_all=True)
+                    else:
+                        context[key] = (flags & flag) != 0
+
+        context["has_asn"] = perms.check("verified.asn.?", "r")
+
+        return context
+
+    def __getitem__(self, key):
+        return self.context[key]
+
+    def __iter__(self):
+        return iter(self.context)
+
+    def __len__(self):
+        return len(self.context)
 
 
 def permissions(request):
-    context = {}
-
-    try:
-        instances = [request.selected_org]
-    except AttributeError:
-        return {"permissions": context}
-    ops = [("c", "create"), ("r", "read"), ("u", "update"), ("d", "delete")]
-
-    for instance in instances:
-        if not instance:
-            continue
-        for namespace in instance.permission_namespaces:
-            for op, name in ops:
-                key = "{}_{}_{}".format(
-                    name,
-                    instance.HandleRef.tag,
-                    namespace.replace(".{org_id}", "").replace(".", "__"),
-                )
-                context[key] = request.perms.check(
-                    namespace.format(org_id=instance.id), op, ignore_grant_all=True
-                )
-
-    context["has_asn"] = request.perms.check("verified.asn.?", "r")
-
-    return {"permissions": context}
+    return {"permissions": PermissionsContext(request)}
 
 
 def info(request):
@@ -1,12 +1,13 @@
 from django.contrib.auth import get_user_model
+from django_grainy import remote
 from django_grainy.remote import Authenticator
 
+from account.permissions import CachedPermissions
 from account.rest.authentication import (
     APIKey,
     APIKeyAuthentication,
     InternalAPIKey,
     OrganizationAPIKey,
-    Permissions,
 )
 
 
@@ -22,7 +23,7 @@ class APIKeyAuthenticator(Authenticator):
 
         elif isinstance(permission_holder, OrganizationAPIKey):
             request.user = permission_holder
-            request.perms = Permissions(permission_holder)
+            request.perms = CachedPermissions(permission_holder)
 
         elif isinstance(permission_holder, User):
             request.user = permission_holder
@@ -37,7 +38,27 @@ class APIKeyAuthenticator(Authenticator):
             if userid:
                 user = get_user_model().objects.get(id=userid)
                 request.user = user
-                request.perms = Permissions(user)
+                request.perms = CachedPermissions(user)
             else:
                 request.user = permission_holder
-                request.perms = Permissions(permission_holder)
+                request.perms = CachedPermissions(permission_holder)
+
+
+class CachedProvider:
+
+    """
+    Provider view mixin that checks the permissions loaded through the
+    permissions cache
+    """
+
+    def authenticate(self, request):
+        self.authenticator_cls().authenticate(request)
+        self.permissions = CachedPermissions(request.user)
+
+
+class ProvideGet(CachedProvider, remote.ProvideGet):
+    pass
+
+
+class ProvideLoad(CachedProvider, remote.ProvideLoad):
+    pass
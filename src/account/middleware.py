@@ -1,11 +1,11 @@
 from django.contrib import messages
 from django.utils.translation import gettext as _
-from django_grainy.util import Permissions
 from social_core.exceptions import AuthFailed
 from social_django.middleware import SocialAuthExceptionMiddleware
 
 from account.impersonate import is_impersonating
 from account.models import Organization
+from account.permissions import CachedPermissions
 from account.session import set_selected_org
 
 
@@ -61,7 +61,7 @@ class RequestAugmentation:
         request.selected_org = org
 
     def process_view(self, request, view_func, view_args, view_kwargs):
-        request.perms = Permissions(request.user)
+        request.perms = CachedPermissions(request.user)
         self.set_selected_org(request)
 
 
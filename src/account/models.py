@@ -1,13 +1,14 @@
+import collections
 import datetime
-import secrets
 
 import reversion
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models, transaction
 from django.shortcuts import render
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.translation import gettext as _
 from django_grainy.decorators import grainy_model
 from django_grainy.models import (
@@ -19,9 +20,15 @@ from django_grainy.models import (
 from django_grainy.util import Permissions
 from fullctl.django.enum import CONTACT_MESSAGE_TYPE
 
+from account.permissions import bump_version
 from account.tasks import UpdatePermissions  # noqa F401
 from common.email import email_contact_us, email_noreply
 from common.models import HandleRefModel
+from common.unique import unique_token
+
+# key of the postgres advisory lock guarding the pending permission
+# update queue
+ADVISORY_LOCK_PERMISSION_QUEUE = 0x7065726D
 
 # Create your models here.
 
@@ -52,23 +59,11 @@ class UserSettings(HandleRefModel):
 
 
 def generate_org_name():
-    i = 0
-    while i < 1000:
-        name = secrets.token_urlsafe(8)
-        if not Organization.objects.filter(name=name).exists():
-            return name
-        i += 1
-    raise OSError(_("Unable to generate unique organization name"))
+    return unique_token(8)
 
 
 def generate_org_slug():
-    i = 0
-    while i < 1000:
-        slug = secrets.token_urlsafe(8).lower()
-        if not Organization.objects.filter(slug=slug).exists():
-            return slug
-        i += 1
-    raise OSError(_("Unable to generate unique organization slug"))
+    return unique_token(8, lower=True)
 
 
 @reversion.register
@@ -290,13 +285,7 @@ class OrganizationRole(HandleRefModel):
 
 
 def generate_api_key():
-    i = 0
-    while i < 1000:
-        key = secrets.token_urlsafe()
-        if not APIKey.objects.filter(key=key).exists():
-            return key
-        i += 1
-    raise OSError(_("Unable to generate unique api key"))
+    return unique_token()
 
 
 class APIKeyBase(HandleRefModel):
@@ -452,13 +441,7 @@ class OrganizationAPIKeyPermission(HandleRefModel, Permission):
 
 
 def generate_email_confirmation_secret():
-    i = 0
-    while i < 1000:
-        secret = secrets.token_urlsafe()
-        if not EmailConfirmation.objects.filter(secret=secret).exists():
-            return secret
-        i += 1
-    raise OSError(_("Unable to generate unique email confirmation secret"))
+    return unique_token()
 
 
 @reversion.register
@@ -525,13 +508,7 @@ class EmailConfirmation(HandleRefModel):
 
 
 def generate_password_reset_secret():
-    i = 0
-    while i < 1000:
-        secret = secrets.token_urlsafe()
-        if not PasswordReset.objects.filter(secret=secret).exists():
-            return secret
-        i += 1
-    raise OSError(_("Unable to generate unique password reset secret"))
+    return unique_token()
 
 
 @reversion.register
@@ -596,13 +573,7 @@ class PasswordReset(HandleRefModel):
 
 
 def generate_invite_secret():
-    i = 0
-    while i < 1000:
-        secret = secrets.token_urlsafe()
-        if not Invitation.objects.filter(secret=secret).exists():
-            return secret
-        i += 1
-    raise OSError(_("Unable to generate unique invitation secret"))
+    return unique_token()
 
 
 @reversion.register
@@ -684,48 +655,162 @@ class ManagedPermission(HandleRefModel):
 
     @classmethod
     def apply_roles(cls, org, user, delete_permissions=True):
-        user_roles = [ur.role_id for ur in user.roles.filter(org=org)]
-        # delete all those namespaces for the user in the org
-        if delete_permissions and org:
-            for ns in cls.namespaces():
-                user.grainy_permissions.delete_permission(ns.format(org_id=org.id))
+        """
+        Reapplies the roles of the user in the organization
 
-        # re-apply automatically granted permissions through roles
-        for auto_grant in ManagedPermissionRoleAutoGrant.objects.filter(
-            role__in=user_roles
-        ).order_by("-role__level"):
-            managed_permission = auto_grant.managed_permission
+        Computes the permissions the roles and permission overrides grant
+        the user for the organization and writes only the user
+        permissions that differ.
 
-            if not managed_permission.can_grant_to_org(org):
-                continue
+        Arguments:
 
-            ns = managed_permission.namespace.format(org_id=org.id)
-            user.grainy_permissions.add_permission(ns, auto_grant.permissions)
+        - org (`Organization`)
+        - user (`User`)
+        - delete_permissions (`bool`): remove permissions for managed
+          namespaces of the organization that the roles no longer grant
+        """
 
-        # re-apply permission overrides
-        for override in UserPermissionOverride.objects.filter(user=user):
-            override.apply()
+        permissions = {}
+        managed_namespaces = set()
+
+        if org:
+            restricted = set(
+                org.org_managed_permission_set.values_list(
+                    "managed_permission_id", flat=True
+                )
+            )
+
+            for ns in cls.objects.values_list("namespace", flat=True):
+                managed_namespaces.add(ns.format(org_id=org.id))
+
+            # automatically granted permissions through roles, lowest
+            # level role applied last
+            for mperm_id, ns, grant_mode, flags in (
+                ManagedPermissionRoleAutoGrant.objects.filter(
+                    role__organization_roles__org=org,
+                    role__organization_roles__user=user,
+                )
+                .order_by("-role__level", "id")
+                .values_list(
+                    "managed_permission_id",
+                    "managed_permission__namespace",
+                    "managed_permission__grant_mode",
+                    "permissions",
+                )
+            ):
+                if grant_mode not in ("auto", "restricted"):
+                    raise ValueError(f"Invalid value for grant_mode: {grant_mode}")
+                if grant_mode == "restricted" and mperm_id not in restricted:
+                    continue
+
+                permissions[(user.id, ns.format(org_id=org.id))] = flags
+
+        # permission overrides for the organization, global overrides and
+        # overrides of the namespaces the roles manage
+        scope = models.Q(org__isnull=True)
+        if org:
+            scope |= models.Q(org=org) | models.Q(namespace__in=managed_namespaces)
+
+        overrides = UserPermissionOverride.objects.filter(scope, user=user)
+
+        for ns, flags in overrides.order_by("id").values_list(
+            "namespace", "permissions"
+        ):
+            permissions[(user.id, ns)] = flags
+
+        namespaces = {ns for _, ns in permissions}
+        if delete_permissions:
+            namespaces |= managed_namespaces
+
+        cls.sync_user_permissions(permissions, users=[user.id], namespaces=namespaces)
 
     @classmethod
     def apply_roles_all(cls):
         """
         Reapplies roles for all users across all orgs
 
-        TODO: This is a costly operation, and should eventually be replaced
-        with something that does batch inserts, especially once the
-        number of active users grow.
+        The permissions all users should have are computed in memory
+        (see `RolePermissions`) and compared to the existing user
+        permissions, only rows that differ are written, in a single
+        transaction so users never end up without permissions while
+        this runs.
+
+        User permissions that are neither granted through a role nor
+        overridden are removed.
+        """
+
+        with transaction.atomic():
+            cls.sync_user_permissions(RolePermissions().permissions())
+
+    @classmethod
+    def sync_user_permissions(
+        cls, permissions, users=None, namespaces=None, batch_size=500
+    ):
+        """
+        Brings the user permission rows in line with `permissions`, all
+        changes are written in a single transaction
+
+        Arguments:
 
-        Alternatively call it from a task. Or both.
+        - permissions (`dict`): (user id, namespace) -> permission flags
+        - users: limit to the user permissions of these users (queryset or
+          list of ids), defaults to all users
+        - namespaces: limit to the user permissions for these namespaces,
+          defaults to all namespaces
+        - batch_size (`int`): rows per insert, update and delete query
+
+        Returns a (created, updated, deleted) tuple of row counts
         """
 
-        org_qset = Organization.objects.all()
+        qset = UserPermission.objects.all()
+        if users is not None:
+            qset = qset.filter(user__in=users)
+        if namespaces is not None:
+            qset = qset.filter(namespace__in=namespaces)
+
+        permissions = dict(permissions)
+        updated = []
+        deleted = []
+        changed_users = set()
+
+        for pk, user_id, ns, permission in qset.order_by("id").values_list(
+            "id", "user_id", "namespace", "permission"
+        ):
+            # rows that are kept are popped, so duplicates are deleted
+            wanted = permissions.pop((user_id, ns), None)
+
+            if wanted is None:
+                deleted.append(pk)
+                changed_users.add(user_id)
+            elif wanted != permission:
+                updated.append(UserPermission(id=pk, permission=wanted))
+                changed_users.add(user_id)
+
+        created = [
+            UserPermission(user_id=user_id, namespace=ns, permission=permission)
+            for (user_id, ns), permission in permissions.items()
+        ]
+
+        if not (created or updated or deleted):
+            return 0, 0, 0
+
+        with transaction.atomic():
+            for start in range(0, len(deleted), batch_size):
+                end = start + batch_size
+                UserPermission.objects.filter(id__in=deleted[start:end]).delete()
+
+            UserPermission.objects.bulk_update(
+                updated, ["permission"], batch_size=batch_size
+            )
+            UserPermission.objects.bulk_create(created, batch_size=batch_size)
 
-        # delete all user permissions
-        UserPermission.objects.all().delete()
+            # bulk writes do not send signals
+            bump_version(
+                get_user_model(),
+                changed_users | {permission.user_id for permission in created},
+            )
 
-        for org in org_qset:
-            for user in org.org_user_set.all().select_related("user", "org"):
-                cls.apply_roles(org, user.user, delete_permissions=False)
+        return len(created), len(updated), len(deleted)
 
     @classmethod
     def apply_roles_org(cls, org):
@@ -756,6 +841,248 @@ class ManagedPermission(HandleRefModel):
         raise ValueError(f"Invalid value for grant_mode: {self.grant_mode}")
 
 
+class RolePermissions:
+    """
+    Computes the user permissions granted through organization roles
+    for organization members, as `ManagedPermission.apply_roles` would
+    apply them, with a fixed number of queries
+
+    Arguments:
+
+    - org_users: memberships (`OrganizationUser` queryset) to compute
+      the permissions for, defaults to all memberships
+    """
+
+    def __init__(self, org_users=None):
+        if org_users is None:
+            org_users = OrganizationUser.objects.all()
+
+        self.org_users = list(
+            org_users.order_by("org_id", "id").values_list("org_id", "user_id")
+        )
+
+        user_ids = {user_id for _, user_id in self.org_users}
+        org_ids = {org_id for org_id, _ in self.org_users}
+
+        # (org id, user id) -> role ids
+        self.roles = collections.defaultdict(set)
+        for org_id, user_id, role_id in OrganizationRole.objects.filter(
+            org_id__in=org_ids, user_id__in=user_ids
+        ).values_list("org_id", "user_id", "role_id"):
+            self.roles[(org_id, user_id)].add(role_id)
+
+        # auto grants in the order they are applied, lowest level last
+        self.auto_grants = list(
+            ManagedPermissionRoleAutoGrant.objects.order_by(
+                "-role__level", "id"
+            ).values_list(
+                "role_id",
+                "managed_permission_id",
+                "managed_permission__namespace",
+                "managed_permission__grant_mode",
+                "permissions",
+            )
+        )
+
+        # (org id, managed permission id) of restricted permissions
+        # organizations are allowed to grant
+        self.restricted = set(
+            OrganizationManagedPermission.objects.filter(
+                org_id__in=org_ids
+            ).values_list("org_id", "managed_permission_id")
+        )
+
+        # user id -> [(namespace, permissions)]
+        self.overrides = collections.defaultdict(list)
+        for user_id, ns, permissions in (
+            UserPermissionOverride.objects.filter(user_id__in=user_ids)
+            .order_by("id")
+            .values_list("user_id", "namespace", "permissions")
+        ):
+            self.overrides[user_id].append((ns, permissions))
+
+    def can_grant(self, org_id, managed_permission_id, grant_mode):
+        """
+        In memory version of `ManagedPermission.can_grant_to_org`
+        """
+
+        if grant_mode == "auto":
+            return True
+
+        if grant_mode == "restricted":
+            return (org_id, managed_permission_id) in self.restricted
+
+        raise ValueError(f"Invalid value for grant_mode: {grant_mode}")
+
+    def permissions(self):
+        """
+        Returns the permissions as a dict of (user id, namespace) ->
+        permission flags
+        """
+
+        permissions = {}
+
+        for org_id, user_id in self.org_users:
+            roles = self.roles.get((org_id, user_id), ())
+
+            for role_id, mperm_id, ns, grant_mode, flags in self.auto_grants:
+                if role_id not in roles:
+                    continue
+                if not self.can_grant(org_id, mperm_id, grant_mode):
+                    continue
+                permissions[(user_id, ns.format(org_id=org_id))] = flags
+
+            for ns, flags in self.overrides.get(user_id, ()):
+                permissions[(user_id, ns)] = flags
+
+        return permissions
+
+
+class PendingPermissionUpdate(models.Model):
+
+    """
+    Organizations and users whose permissions need to be recomputed
+
+    - org and user set: `ManagedPermission.apply_roles` for the user
+    - org set: `ManagedPermission.apply_roles_org`
+    - neither set: `ManagedPermission.apply_roles_all`
+
+    Entries are merged as they are queued and drained by the
+    `UpdatePermissions` task.
+    """
+
+    org = models.ForeignKey(
+        Organization,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="pending_permission_update_set",
+    )
+    user = models.ForeignKey(
+        get_user_model(),
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name="pending_permission_update_set",
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "account_pending_permission_update"
+        verbose_name = _("Pending permission update")
+        verbose_name_plural = _("Pending permission updates")
+
+    @classmethod
+    def lock(cls):
+        """
+        Takes a transaction level lock on the queue, so entries are
+        checked and changed by one transaction at a time
+
+        No-op on database backends that do not support advisory locks
+        """
+
+        if connection.vendor != "postgresql":
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(%s)", [ADVISORY_LOCK_PERMISSION_QUEUE]
+            )
+
+    @classmethod
+    def queue(cls, org=None, user=None, create_task=True):
+        """
+        Queues a permission recompute for the user in the organization,
+        all users in the organization (no `user`) or all users (no `org`)
+
+        Recomputes already covered by a queued entry are not queued
+        again (the covering entry is marked as changed instead), a wider
+        recompute replaces the entries it covers.
+
+        Unless `create_task` is False an `UpdatePermissions` task is
+        created if none is pending.
+        """
+
+        with transaction.atomic():
+            cls.lock()
+
+            pending = cls.objects.all()
+
+            if org is None:
+                covering = pending.filter(org__isnull=True)
+            elif user is None:
+                covering = pending.filter(
+                    models.Q(org__isnull=True) | models.Q(org=org, user__isnull=True)
+                )
+            else:
+                covering = pending.filter(
+                    models.Q(org__isnull=True)
+                    | models.Q(org=org, user__isnull=True)
+                    | models.Q(org=org, user=user)
+                )
+
+            # an entry that is being drained is only removed if it has
+            # not changed since the drain started
+            if not covering.update(created=timezone.now()):
+                if org is None:
+                    pending.delete()
+                elif user is None:
+                    pending.filter(org=org).delete()
+                cls.objects.create(org=org, user=user)
+
+        if (
+            create_task
+            and not UpdatePermissions.objects.filter(
+                op=UpdatePermissions.HandleRef.tag, status="pending"
+            ).exists()
+        ):
+            UpdatePermissions.create_task()
+
+    @classmethod
+    def drain(cls):
+        """
+        Recomputes the permissions of all queued entries in one pass
+
+        Entries are removed from the queue once they have been
+        recomputed, entries queued or changed while this runs are left
+        for the next run. If the recompute fails the entries stay queued.
+
+        Returns a summary of what was recomputed
+        """
+
+        with transaction.atomic():
+            cls.lock()
+            started = timezone.now()
+            entries = list(cls.objects.select_related("org", "user").order_by("id"))
+
+        if not entries:
+            return "nothing queued"
+
+        if any(entry.org_id is None for entry in entries):
+            ManagedPermission.apply_roles_all()
+            summary = "all users"
+        else:
+            orgs = {entry.org_id for entry in entries if entry.user_id is None}
+            users = 0
+
+            for entry in entries:
+                if entry.user_id is None:
+                    ManagedPermission.apply_roles_org(entry.org)
+                elif entry.org_id not in orgs:
+                    ManagedPermission.apply_roles(entry.org, entry.user)
+                    users += 1
+
+            summary = f"{len(orgs)} organizations, {users} users"
+
+        with transaction.atomic():
+            cls.lock()
+            cls.objects.filter(
+                id__in=[entry.id for entry in entries], created__lte=started
+            ).delete()
+
+        return summary
+
+
 @reversion.register
 class ManagedPermissionRoleAutoGrant(HandleRefModel):
     managed_permission = models.ForeignKey(
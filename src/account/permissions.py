@@ -0,0 +1,148 @@
+"""
+Cross request cache of compiled permission sets
+
+The permission set of a permission holder (user, personal, organization
+or internal api key) is cached under a key that carries a version of the
+holder's permissions. Any change to the holder's permission rows bumps
+the version (see `bump_version`), so the next request loads the changed
+permissions while unchanged holders skip the permission queries.
+
+The cache is configured through the `PERMISSIONS_CACHE` setting, which
+needs to be a cache shared between all processes serving requests, otherwise
+a version bump only reaches the process that made the change. Permission
+sets are not cached if the setting is not set.
+"""
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django_grainy.util import Permissions
+from grainy.core import PermissionSet
+
+from common.unique import unique_token
+
+# cache backends that are shared between processes
+SHARED_CACHE_BACKENDS = ("redis", "memcached")
+
+
+def get_cache():
+    """
+    Returns the permissions cache, None if permission sets are not cached
+    """
+
+    if not settings.PERMISSIONS_CACHE:
+        return None
+    return caches[settings.PERMISSIONS_CACHE]
+
+
+def check_cache():
+    """
+    Raises ImproperlyConfigured if the permissions cache is not
+    shared between processes (redis or memcached)
+    """
+
+    alias = settings.PERMISSIONS_CACHE
+
+    if not alias:
+        return
+
+    if alias not in settings.CACHES:
+        raise ImproperlyConfigured(f"PERMISSIONS_CACHE: unknown cache `{alias}`")
+
+    backend = settings.CACHES[alias]["BACKEND"]
+
+    if not any(shared in backend.lower() for shared in SHARED_CACHE_BACKENDS):
+        raise ImproperlyConfigured(
+            f"PERMISSIONS_CACHE: cache `{alias}` ({backend}) is not shared between "
+            "processes, use a redis or memcached backed cache or unset "
+            "PERMISSIONS_CACHE"
+        )
+
+
+def holder_key(model, pk):
+    return f"perms:{model._meta.label_lower}:{pk}"
+
+
+def get_version(model, pk):
+    """
+    Returns the current permissions version of the holder, starting a
+    new one if there is none
+    """
+
+    cache = get_cache()
+    key = f"{holder_key(model, pk)}:version"
+    version = cache.get(key)
+
+    if version is None:
+        # versions are random so a version that was evicted from the
+        # cache is never reused
+        cache.add(key, unique_token(8), timeout=None)
+        version = cache.get(key)
+
+    return version
+
+
+def bump_version(model, pks):
+    """
+    Bumps the permissions version of the holders, cached permission sets
+    of the previous versions are no longer used
+
+    The versions are bumped again once the current transaction commits,
+    so a permission set loaded before the changes were committed is not
+    cached under the new version.
+    """
+
+    if get_cache() is None:
+        return
+
+    pks = set(pks)
+
+    if not pks:
+        return
+
+    def bump():
+        get_cache().set_many(
+            {f"{holder_key(model, pk)}:version": unique_token(8) for pk in pks},
+            timeout=None,
+        )
+
+    bump()
+    transaction.on_commit(bump)
+
+
+class CachedPermissions(Permissions):
+
+    """
+    `Permissions` that loads the permission set from the permissions
+    cache if possible
+    """
+
+    def load(self, refresh=False):
+        if self.loaded and not refresh:
+            return
+
+        obj = self.obj
+
+        cache = get_cache()
+
+        if cache is None or not hasattr(obj, "grainy_permissions") or obj.pk is None:
+            return super().load(refresh=refresh)
+
+        # request users are lazy objects, resolve the model through _meta
+        model = obj._meta.model
+        key = f"{holder_key(model, obj.pk)}:{get_version(model, obj.pk)}"
+        permissions = cache.get(key)
+
+        if permissions is None:
+            self.loaded = False
+            super().load(refresh=True)
+            permissions = {
+                str(ns): permission.value
+                for ns, permission in self.pset.permissions.items()
+            }
+            cache.set(key, permissions, timeout=settings.PERMISSIONS_CACHE_TIMEOUT)
+            return
+
+        self.pset = PermissionSet(permissions)
+        self.loaded = True
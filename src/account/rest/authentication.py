@@ -1,8 +1,8 @@
-from django_grainy.util import Permissions
 from fullctl.django.rest.authentication import key_from_request
 from rest_framework import authentication, exceptions
 
 from account.models import APIKey, InternalAPIKey, OrganizationAPIKey
+from account.permissions import CachedPermissions
 
 
 class APIKeyAuthentication(authentication.BaseAuthentication):
@@ -27,18 +27,18 @@ class APIKeyAuthentication(authentication.BaseAuthentication):
                         if not api_key.managed:
                             # unmanaged personal keys have their own set of permissions
 
-                            request.perms = Permissions(api_key)
+                            request.perms = CachedPermissions(api_key)
 
                         else:
                             # managed personal keys inherit the users permissions
 
-                            request.perms = Permissions(api_key.user)
+                            request.perms = CachedPermissions(api_key.user)
 
                         return (api_key.user, None)
                     if model == OrganizationAPIKey:
                         # Organization API Key
 
-                        request.perms = Permissions(api_key)
+                        request.perms = CachedPermissions(api_key)
                         return (api_key, None)
                     if model == InternalAPIKey:
                         # Inernal API Key
@@ -2,27 +2,32 @@ import fullctl.django.models.concrete.tasks as task_models
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.signals import user_logged_out
-from django.db.models.signals import post_delete, post_save, pre_delete
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.shortcuts import render
 from django.utils.translation import gettext as _
+from django_grainy.models import GroupPermission, UserPermission
 from oauth2_provider.models import AccessToken
 from reversion.signals import post_revision_commit
 
 from account.models import (
     APIKey,
+    APIKeyPermission,
     EmailConfirmation,
+    InternalAPIKeyPermission,
     ManagedPermission,
     ManagedPermissionRoleAutoGrant,
     Organization,
+    OrganizationAPIKeyPermission,
     OrganizationManagedPermission,
     OrganizationRole,
     OrganizationUser,
+    PendingPermissionUpdate,
     Role,
-    UpdatePermissions,
     UserPermissionOverride,
     UserSettings,
 )
+from account.permissions import bump_version
 from common.email import email_noreply
 
 
@@ -119,19 +124,19 @@ def auto_user_to_org(sender, **kwargs):
 
 @receiver(post_delete, sender=ManagedPermissionRoleAutoGrant)
 def delete_auto_grant(sender, **kwargs):
-    UpdatePermissions.create_task_silent_limit()
+    PendingPermissionUpdate.queue()
 
 
 @receiver(post_save, sender=OrganizationManagedPermission)
 def set_org_manage_permission(sender, **kwargs):
     instance = kwargs.get("instance")
-    UpdatePermissions.create_task_silent_limit(target_org=instance.org.id)
+    PendingPermissionUpdate.queue(org=instance.org)
 
 
 @receiver(post_delete, sender=OrganizationManagedPermission)
 def delete_org_manage_permission(sender, **kwargs):
     instance = kwargs.get("instance")
-    UpdatePermissions.create_task_silent_limit(target_org=instance.org.id)
+    PendingPermissionUpdate.queue(org=instance.org)
 
 
 @receiver(pre_delete, sender=OrganizationUser)
@@ -183,7 +188,7 @@ def sync_roles(**kwargs):
             update_all_permissions = True
 
     if update_all_permissions:
-        UpdatePermissions.create_task_silent_limit()
+        PendingPermissionUpdate.queue()
 
 
 post_revision_commit.connect(sync_roles)
@@ -193,3 +198,45 @@ post_revision_commit.connect(sync_roles)
 def delete_user_access_tokens(sender, user, request, **kwargs):
     # Find and delete all access tokens associated with the user
     AccessToken.objects.filter(user=user).delete()
+
+
+@receiver(post_save, sender=UserPermission)
+@receiver(post_delete, sender=UserPermission)
+def bump_user_permissions(sender, **kwargs):
+    bump_version(get_user_model(), [kwargs["instance"].user_id])
+
+
+@receiver(post_save, sender=APIKeyPermission)
+@receiver(post_delete, sender=APIKeyPermission)
+@receiver(post_save, sender=OrganizationAPIKeyPermission)
+@receiver(post_delete, sender=OrganizationAPIKeyPermission)
+@receiver(post_save, sender=InternalAPIKeyPermission)
+@receiver(post_delete, sender=InternalAPIKeyPermission)
+def bump_api_key_permissions(sender, **kwargs):
+    instance = kwargs["instance"]
+    bump_version(type(instance).api_key.field.related_model, [instance.api_key_id])
+
+
+@receiver(post_save, sender=GroupPermission)
+@receiver(post_delete, sender=GroupPermission)
+def bump_group_permissions(sender, **kwargs):
+    group = kwargs["instance"].group
+    bump_version(get_user_model(), group.user_set.values_list("id", flat=True))
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def bump_user_groups(sender, **kwargs):
+    action = kwargs["action"]
+
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+
+    if not kwargs["reverse"]:
+        users = [kwargs["instance"].pk]
+    elif action == "pre_clear":
+        # members are no longer known once the group is cleared
+        users = kwargs["instance"].user_set.values_list("id", flat=True)
+    else:
+        users = kwargs["pk_set"]
+
+    bump_version(get_user_model(), users)
@@ -1,14 +1,42 @@
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
 from fullctl.django.models import Task
 from fullctl.django.tasks import register
-from fullctl.django.tasks.qualifiers import ConcurrencyLimit
+from fullctl.django.tasks.qualifiers import Base, ConcurrencyLimit
 
 import account.models
 
 __all__ = ["UpdatePermissions"]
 
 
+class Delay(Base):
+
+    """
+    Holds a task back until `PERMISSION_UPDATE_DELAY` seconds have passed
+    since it was created
+
+    The delay is fixed, it is not extended by changes queued while the
+    task waits. Those are handled by the same run, so changes made in
+    quick succession only cause a single recompute.
+    """
+
+    def __str__(self):
+        return f"{self.__class__.__name__} {settings.PERMISSION_UPDATE_DELAY}"
+
+    def check(self, task):
+        delay = datetime.timedelta(seconds=settings.PERMISSION_UPDATE_DELAY)
+        return task.created <= timezone.now() - delay
+
+
 @register
 class UpdatePermissions(Task):
+
+    """
+    Recomputes the user permissions queued in `PendingPermissionUpdate`
+    """
+
     class Meta:
         proxy = True
 
@@ -18,17 +46,16 @@ class UpdatePermissions(Task):
     class TaskMeta:
         qualifiers = [
             ConcurrencyLimit(1),
+            Delay(),
         ]
 
-    @property
-    def generate_limit_id(self):
-        if self.param["kwargs"].get("target_org"):
-            return "org:" + str(self.param["kwargs"].get("target_org"))
-        return ""
-
     def run(self, target_org=None, *args, **kwargs):
+        # tasks queued before the pending permission update queue
+        # existed carry their target in the task parameters
         if target_org:
-            org = account.models.Organization.objects.get(id=target_org)
-            account.models.ManagedPermission.apply_roles_org(org)
-        else:
-            account.models.ManagedPermission.apply_roles_all()
+            account.models.PendingPermissionUpdate.queue(
+                org=account.models.Organization.objects.get(id=target_org),
+                create_task=False,
+            )
+
+        return account.models.PendingPermissionUpdate.drain()
@@ -26,6 +26,18 @@ def get_client_bridge(service_tag, cls_name):
     return get_client_bridge_cls(service_tag, cls_name)(key=api_key.key)
 
 
+def usage_from_document(data, product_name):
+    """
+    Returns the units for the product from a usage document
+    as returned by Bridge.usage_document
+    """
+
+    for row in data:
+        if row["name"] == product_name:
+            return row["units"]
+    return None
+
+
 class Bridge(client.Bridge):
     def __init__(self, service, org, user=None):
         api_key = InternalAPIKey.objects.first()
@@ -53,13 +65,20 @@ class Bridge(client.Bridge):
         super().__init__(service.api_url, api_key.key, org_slug)
 
     def usage(self, product_name):
+        return usage_from_document(self.usage_document(), product_name)
+
+    def usage_path(self):
         # this should stay {org} and not {org_id} so it uses the org slug
-        path = self._endpoint("usage", default="usage/{org}/")
-        data = self.get(path)
-        for row in data:
-            if row["name"] == product_name:
-                return row["units"]
-        return None
+        return self._endpoint("usage", default="usage/{org}/")
+
+    def usage_document(self, **kwargs):
+        """
+        Returns the usage of all metered products for the organization
+
+        Keyword arguments are passed through to the request (e.g., timeout)
+        """
+
+        return self.get(self.usage_path(), **kwargs)
 
     def sync_user(self):
         path = self._endpoint(
@@ -4,6 +4,7 @@ from django import forms
 from django.contrib import admin
 from django.http import JsonResponse
 from django.http.request import HttpRequest
+from django.template.response import TemplateResponse
 from django.urls import path, reverse
 from django.utils.html import format_html
 from django.utils.translation import gettext as _
@@ -11,8 +12,12 @@ from fullctl.django.admin import BaseAdmin
 
 import billing.product_handlers
 from applications.service_bridge import get_client_bridge, get_client_bridge_cls
+from billing.forecast import Forecast
 from billing.models import (
+    AccountSummary,
     BillingContact,
+    BillingRun,
+    BillingRunSubscription,
     CustomerData,
     Invoice,
     InvoiceLine,
@@ -271,7 +276,13 @@ class SubscriptionAdminForm(forms.ModelForm):
 
 @admin.register(Subscription)
 class SubscriptionAdmin(BaseAdmin):
-    list_display = ("group", "org", "subscription_cycle", "subscription_cycle_start")
+    list_display = (
+        "group",
+        "org",
+        "subscription_cycle",
+        "subscription_cycle_start",
+        "charge_type",
+    )
     search_fields = ("group__name", "product__name", "org__name")
     autocomplete_fields = ("org",)
     inlines = (
@@ -279,10 +290,14 @@ class SubscriptionAdmin(BaseAdmin):
         SubscriptionCycleInline,
     )
     form = SubscriptionAdminForm
+    change_list_template = "admin/billing/subscription/change_list.html"
 
     class Media:
         js = ("billing/admin.js",)  # Include the JavaScript file in Django admin
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).billing_state()
+
     def get_urls(self):
         urls = super().get_urls()
         my_urls = [
@@ -296,9 +311,36 @@ class SubscriptionAdmin(BaseAdmin):
                 self.admin_site.admin_view(self.load_payment_methods),
                 name="ajax_load_payment_methods",
             ),
+            path(
+                "forecast/",
+                self.admin_site.admin_view(self.forecast_view),
+                name="billing_subscription_forecast",
+            ),
         ]
         return my_urls + urls
 
+    def forecast_view(self, request):
+        """
+        Revenue and usage forecast report for all subscriptions
+        """
+
+        try:
+            months = min(max(int(request.GET.get("months", 12)), 1), 60)
+        except ValueError:
+            months = 12
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title=_("Revenue forecast"),
+            months=months,
+            forecast=Forecast(months=months),
+        )
+
+        return TemplateResponse(
+            request, "admin/billing/subscription/forecast.html", context
+        )
+
     def load_component_objects(self, request):
         """
         This view returns a list of component objects for a given product.
@@ -338,6 +380,10 @@ class SubscriptionAdmin(BaseAdmin):
 class SubscriptionCycleProductInline(admin.TabularInline):
     model = SubscriptionCycleProduct
     extra = 0
+    readonly_fields = ("price",)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).pricing()
 
 
 class SubscriptionCycleChargeInline(admin.TabularInline):
@@ -354,6 +400,7 @@ class SubscriptionCycleAdmin(BaseAdmin):
         "status",
         "charge_status",
         "organization_name",
+        "price",
     )
     search_fields = (
         "subscription__product__name",
@@ -363,9 +410,36 @@ class SubscriptionCycleAdmin(BaseAdmin):
     )
     inlines = (SubscriptionCycleProductInline, SubscriptionCycleChargeInline)
 
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .prefetch_related(SubscriptionCycle.pricing_prefetch())
+        )
+
     def organization_name(self, obj):
         return obj.subscription.org.name
 
+    def price(self, obj):
+        return obj.price
+
+
+class BillingRunSubscriptionInline(admin.TabularInline):
+    model = BillingRunSubscription
+    fields = ("subscription", "status", "created")
+    readonly_fields = fields
+    extra = 0
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(BillingRun)
+class BillingRunAdmin(BaseAdmin):
+    list_display = ("id", "status", "created", "finished", "phases")
+    readonly_fields = ("status", "options", "phases", "finished")
+    inlines = (BillingRunSubscriptionInline,)
+
 
 @admin.register(SubscriptionProductModifier)
 class SubscriptionProductModifierAdmin(BaseAdmin):
@@ -413,6 +487,8 @@ class PaymentChargeAdmin(BaseAdmin):
         "payment_method",
         "billing_contact",
         "price",
+        "invoice_number",
+        "order_number",
         "status",
         "created",
         "updated",
@@ -425,6 +501,14 @@ class PaymentChargeAdmin(BaseAdmin):
     )
     list_filter = ("status",)
 
+    def get_queryset(self, request):
+        return (
+            super()
+            .get_queryset(request)
+            .references()
+            .select_related("payment_method__billing_contact")
+        )
+
     def billing_contact(self, obj):
         if not obj.payment_method:
             return None
@@ -450,6 +534,34 @@ class BillingContactAdmin(BaseAdmin):
     autocomplete_fields = ("org",)
 
 
+@admin.register(AccountSummary)
+class AccountSummaryAdmin(BaseAdmin):
+    list_display = (
+        "org",
+        "currency",
+        "balance",
+        "invoiced",
+        "paid",
+        "deposited",
+        "withdrawn",
+        "last_payment",
+        "updated",
+    )
+    readonly_fields = (
+        "org",
+        "currency",
+        "ordered",
+        "invoiced",
+        "paid",
+        "deposited",
+        "withdrawn",
+        "balance",
+        "transactions",
+        "last_payment",
+    )
+    search_fields = ("org__name", "org__slug")
+
+
 @admin.register(Ledger)
 class LedgerAdmin(BaseAdmin):
     list_display = (
@@ -510,6 +622,7 @@ class OrderAdmin(BaseAdmin):
         "order_number",
         "invoice",
         "org",
+        "price",
         "created",
     )
 
@@ -521,6 +634,9 @@ class OrderAdmin(BaseAdmin):
 
     search_fields = ("org__name", "org__slug", "order_number", "invoice_number")
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).totals().select_related("org", "invoice")
+
     def invoice_order(self, request, queryset):
         """
         Create invoices out of selected orders
@@ -543,6 +659,9 @@ class InvoiceAdmin(BaseAdmin):
         "invoice_number",
         "order",
         "org",
+        "price",
+        "currency",
+        "paid",
         "status",
         "created",
     )
@@ -555,6 +674,11 @@ class InvoiceAdmin(BaseAdmin):
 
     readonly_fields = ("paid",)
 
+    def get_queryset(self, request):
+        return (
+            super().get_queryset(request).totals().select_related("org", "order__org")
+        )
+
 
 @admin.register(Payment)
 class PaymentAdmin(BaseAdmin):
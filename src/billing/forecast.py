@@ -0,0 +1,426 @@
+"""
+Revenue and usage forecasting
+
+Projects the subscription cycle charges of the coming months from the
+current billing state:
+
+- fixed price products are charged their recurring price
+- metered products are charged their projected usage, following the
+  linear trend of the usage of their last ended cycles
+- subscription product modifiers apply as long as they are valid when
+  a cycle is charged (see `SubscriptionCycleProduct.price`)
+- subscription products stop being charged once they expire or, if they
+  end with the next cycle, after the current cycle
+
+Rather than pricing every cycle product through the ORM, the billing
+state is loaded with a fixed number of queries into flat columns (one
+list per attribute) and the projected cycles are priced column by column.
+"""
+
+import bisect
+import dataclasses
+import datetime
+
+import dateutil.relativedelta
+from django.utils import timezone
+
+from billing.models import (
+    Subscription,
+    SubscriptionCycle,
+    SubscriptionCycleProduct,
+    SubscriptionProduct,
+    SubscriptionProductModifier,
+    apply_price_modifier,
+)
+
+CYCLE_INTERVALS = {
+    "month": dateutil.relativedelta.relativedelta(months=1),
+    "year": dateutil.relativedelta.relativedelta(years=1),
+}
+
+# length of a cycle in months, to normalize cycle prices to monthly
+# recurring revenue
+CYCLE_MONTHS = {"month": 1, "year": 12}
+
+
+@dataclasses.dataclass
+class ForecastPeriod:
+    """
+    A month of the forecast
+
+    - revenue: total of the cycle charges due in the period
+    - mrr: monthly recurring revenue of the cycles active at the start
+      of the period
+    - usage: projected metered usage charged in the period
+    - charges: number of cycle charges due in the period
+    """
+
+    start: datetime.date
+    end: datetime.date
+    revenue: float = 0
+    mrr: float = 0
+    usage: float = 0
+    charges: int = 0
+
+
+@dataclasses.dataclass
+class ForecastExpiry:
+    """
+    A subscription product or modifier expiring during the forecast
+    """
+
+    date: datetime.date
+    kind: str
+    subscription_id: int
+    org_name: str
+    description: str
+
+
+class Forecast:
+    """
+    Revenue and usage forecast for `months` months starting at `date`
+
+    Arguments:
+
+    - months (`int`): number of months to project
+    - date (`datetime.date`): start of the forecast, defaults to today
+    - history (`int`): number of ended cycles the metered usage trend is
+      computed from
+    - queryset: subscriptions to forecast, defaults to all subscriptions
+
+    Attributes:
+
+    - periods (`list`): `ForecastPeriod` for each month
+    - expiries (`list`): `ForecastExpiry` ordered by date
+    - subscriptions (`int`): number of subscriptions forecast
+    """
+
+    def __init__(self, months=12, date=None, history=3, queryset=None):
+        self.months = months
+        self.date = date or datetime.date.today()
+        self.history = history
+
+        if queryset is None:
+            queryset = Subscription.objects.all()
+
+        self.queryset = queryset
+
+        self.periods = [
+            ForecastPeriod(
+                start=self.date + dateutil.relativedelta.relativedelta(months=i),
+                end=self.date + dateutil.relativedelta.relativedelta(months=i + 1),
+            )
+            for i in range(months)
+        ]
+        self.end = self.periods[-1].end if self.periods else self.date
+        self.expiries = []
+
+        self.load()
+        self.project()
+
+    @property
+    def revenue(self):
+        return sum(period.revenue for period in self.periods)
+
+    def load(self):
+        """
+        Loads subscriptions, subscription products, modifiers and usage
+        history into columns
+        """
+
+        subscription_ids = self.queryset.values("id")
+
+        # subscriptions
+
+        self.sub_index = {}
+        self.sub_id = []
+        self.sub_org = []
+        self.sub_interval = []
+
+        for sub_id, org_name, interval in (
+            Subscription.objects.filter(id__in=subscription_ids)
+            .order_by("id")
+            .values_list("id", "org__name", "subscription_cycle_interval")
+        ):
+            self.sub_index[sub_id] = len(self.sub_id)
+            self.sub_id.append(sub_id)
+            self.sub_org.append(org_name)
+            self.sub_interval.append(interval)
+
+        self.subscriptions = len(self.sub_id)
+
+        # start of the current cycle, a subscription without one starts
+        # a new cycle on the next billing run
+        self.sub_cycle_start = [None] * self.subscriptions
+
+        for sub_id, start in SubscriptionCycle.objects.filter(
+            subscription_id__in=subscription_ids,
+            start__lte=self.date,
+            end__gt=self.date,
+        ).values_list("subscription_id", "start"):
+            self.sub_cycle_start[self.sub_index[sub_id]] = start
+
+        # subscription products with a recurring product
+
+        self.line_index = {}
+        self.line_sub = []
+        self.line_metered = []
+        self.line_price = []
+        self.line_expires = []
+        self.line_ends_next_cycle = []
+        self.line_product = []
+
+        for (
+            line_id,
+            sub_id,
+            recurring_type,
+            price,
+            expires,
+            ends_next_cycle,
+            product_name,
+        ) in (
+            SubscriptionProduct.objects.filter(
+                subscription_id__in=subscription_ids,
+                product__recurring_product__isnull=False,
+            )
+            .order_by("id")
+            .values_list(
+                "id",
+                "subscription_id",
+                "product__recurring_product__type",
+                "product__recurring_product__price",
+                "expires",
+                "ends_next_cycle",
+                "product__name",
+            )
+        ):
+            self.line_index[line_id] = len(self.line_sub)
+            self.line_sub.append(self.sub_index[sub_id])
+            self.line_metered.append(recurring_type == "metered")
+            self.line_price.append(float(price))
+            self.line_expires.append(expires)
+            self.line_ends_next_cycle.append(ends_next_cycle)
+            self.line_product.append(product_name)
+
+            if expires and self.date <= expires.date() < self.end:
+                self.expiries.append(
+                    ForecastExpiry(
+                        date=expires.date(),
+                        kind="product",
+                        subscription_id=sub_id,
+                        org_name=self.sub_org[self.sub_index[sub_id]],
+                        description=product_name,
+                    )
+                )
+
+        # subscriptions with a metered product are charged at the end
+        # of their cycles (see `Subscription.charge_type`)
+
+        self.sub_charge_end = [False] * self.subscriptions
+        for sub, metered in zip(self.line_sub, self.line_metered):
+            if metered:
+                self.sub_charge_end[sub] = True
+
+        # modifiers, applied in order
+
+        self.line_modifiers = [[] for _ in self.line_sub]
+
+        for line_id, modifier_type, value, valid in (
+            SubscriptionProductModifier.objects.filter(
+                subscription_product__subscription_id__in=subscription_ids,
+                subscription_product__product__recurring_product__isnull=False,
+            )
+            .order_by("id")
+            .values_list("subscription_product_id", "type", "value", "valid")
+        ):
+            line = self.line_index[line_id]
+            self.line_modifiers[line].append((modifier_type, value, valid))
+
+            if self.date <= valid.date() < self.end:
+                sub = self.line_sub[line]
+                self.expiries.append(
+                    ForecastExpiry(
+                        date=valid.date(),
+                        kind="modifier",
+                        subscription_id=self.sub_id[sub],
+                        org_name=self.sub_org[sub],
+                        description=f"{modifier_type} {value} on {self.line_product[line]}",
+                    )
+                )
+
+        self.expiries.sort(key=lambda expiry: expiry.date)
+
+        self.load_usage()
+
+    def load_usage(self):
+        """
+        Computes the usage trend (intercept, slope) of the metered lines
+        from the usage of their last `history` ended cycles
+
+        Lines without ended cycles are projected at the usage collected
+        for their current cycle so far.
+        """
+
+        ended = [[] for _ in self.line_sub]
+        current = [0] * len(self.line_sub)
+
+        for line_id, usage, end in (
+            SubscriptionCycleProduct.objects.filter(
+                subscription_product__subscription_id__in=self.queryset.values("id"),
+                subscription_product__product__recurring_product__type="metered",
+                subscription_cycle__start__lte=self.date,
+            )
+            .order_by("subscription_cycle__start")
+            .values_list("subscription_product_id", "usage", "subscription_cycle__end")
+        ):
+            line = self.line_index[line_id]
+            if end <= self.date:
+                ended[line].append(usage)
+            else:
+                current[line] = usage
+
+        self.line_usage_trend = []
+
+        for usage, current_usage in zip(ended, current):
+            skip = max(len(usage) - self.history, 0)
+            usage = usage[skip:] if self.history else []
+
+            if not usage:
+                self.line_usage_trend.append((float(current_usage), 0.0, 0))
+                continue
+
+            # least squares fit over the cycles, x = 0 .. n - 1
+            n = len(usage)
+            mean_x = (n - 1) / 2
+            mean_y = sum(usage) / n
+            var_x = sum((x - mean_x) ** 2 for x in range(n))
+            slope = (
+                sum((x - mean_x) * (y - mean_y) for x, y in enumerate(usage)) / var_x
+                if var_x
+                else 0.0
+            )
+            self.line_usage_trend.append((mean_y - slope * mean_x, slope, n))
+
+    def cycles(self, sub):
+        """
+        Yields (offset, start, end) of the cycles of a subscription from
+        its current cycle through the end of the forecast
+        """
+
+        interval = CYCLE_INTERVALS.get(self.sub_interval[sub], CYCLE_INTERVALS["month"])
+        start = self.sub_cycle_start[sub] or self.date
+        offset = 0
+
+        while start < self.end:
+            end = start + interval
+            yield offset, start, end
+            start = end
+            offset += 1
+
+    def project(self):
+        """
+        Expands the subscription lines into one row per projected cycle
+        and prices the rows
+        """
+
+        sub_lines = [[] for _ in self.sub_id]
+        for line, sub in enumerate(self.line_sub):
+            sub_lines[sub].append(line)
+
+        # rows: one per line and projected cycle
+
+        row_line = []
+        row_offset = []
+        row_start = []
+        row_end = []
+        row_charge_date = []
+
+        for sub, lines in enumerate(sub_lines):
+            has_cycle = self.sub_cycle_start[sub] is not None
+            charge_end = self.sub_charge_end[sub]
+
+            for offset, start, end in self.cycles(sub):
+                for line in lines:
+                    expires = self.line_expires[line]
+                    if expires and expires.date() <= start:
+                        continue
+                    if self.line_ends_next_cycle[line] and (offset or not has_cycle):
+                        continue
+
+                    row_line.append(line)
+                    row_offset.append(offset)
+                    row_start.append(start)
+                    row_end.append(end)
+                    row_charge_date.append(end if charge_end else start)
+
+        # usage, extrapolated from the trend of each metered line
+
+        row_usage = []
+        for line, offset in zip(row_line, row_offset):
+            if not self.line_metered[line]:
+                row_usage.append(0.0)
+                continue
+            intercept, slope, n = self.line_usage_trend[line]
+            row_usage.append(max(intercept + slope * (n + offset), 0.0))
+
+        # base prices
+
+        row_price = [
+            usage * self.line_price[line]
+            if self.line_metered[line]
+            else self.line_price[line]
+            for line, usage in zip(row_line, row_usage)
+        ]
+
+        # modifiers valid when the cycle is charged
+
+        row_charged_at = [
+            timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+            for date in row_charge_date
+        ]
+
+        for row, line in enumerate(row_line):
+            for modifier_type, value, valid in self.line_modifiers[line]:
+                if row_charged_at[row] < valid:
+                    row_price[row] = apply_price_modifier(
+                        modifier_type, value, row_price[row], self.line_price[line]
+                    )
+
+        self.aggregate(
+            row_line, row_start, row_end, row_charge_date, row_usage, row_price
+        )
+
+    def aggregate(
+        self, row_line, row_start, row_end, row_charge_date, row_usage, row_price
+    ):
+        """
+        Sums up the priced rows into the forecast periods
+        """
+
+        periods = self.periods
+        period_starts = [period.start for period in periods]
+        charged = set()
+
+        for line, start, end, charge_date, usage, price in zip(
+            row_line, row_start, row_end, row_charge_date, row_usage, row_price
+        ):
+            sub = self.line_sub[line]
+            monthly = price / CYCLE_MONTHS.get(self.sub_interval[sub], 1)
+
+            # periods starting during the cycle
+            first = bisect.bisect_left(period_starts, start)
+            last = bisect.bisect_left(period_starts, end)
+            for period in periods[first:last]:
+                period.mrr += monthly
+
+            # period the cycle is charged in
+            if not self.date <= charge_date < self.end:
+                continue
+
+            period = periods[bisect.bisect_right(period_starts, charge_date) - 1]
+            period.revenue += price
+            period.usage += usage
+
+            if (sub, start) not in charged:
+                charged.add((sub, start))
+                period.charges += 1
@@ -0,0 +1,44 @@
+from fullctl.django.management.commands.base import CommandInterface
+
+from account.models import Organization
+from billing.models import AccountSummary
+
+
+class Command(CommandInterface):
+    help = "Rebuilds the organization account summaries from the ledger"
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+
+        parser.add_argument(
+            "--org",
+            type=str,
+            default=None,
+            help="Only rebuild the account summaries of this organization (slug)",
+        )
+
+    def run(self, *args, **kwargs):
+        org = None
+
+        if kwargs.get("org"):
+            org = Organization.objects.get(slug=kwargs.get("org"))
+
+        current = AccountSummary.objects.all()
+        if org:
+            current = current.filter(org=org)
+
+        current = {
+            (summary.org_id, summary.currency): summary.balance for summary in current
+        }
+
+        summaries = AccountSummary.rebuild(org)
+
+        for summary in summaries:
+            balance = current.pop((summary.org_id, summary.currency), None)
+            if balance != summary.balance:
+                self.log_info(f"{summary}: balance {balance} -> {summary.balance}")
+
+        for org_id, currency in current:
+            self.log_info(f"removed summary for org {org_id} {currency}")
+
+        self.log_info(f"rebuilt {len(summaries)} account summaries")
@@ -0,0 +1,230 @@
+import dataclasses
+import io
+import time
+import tracemalloc
+
+from django.core.management import call_command, get_commands, load_command_class
+from django.core.management.base import CommandError
+from django.db import connection
+from fullctl.django.management.commands.base import CommandInterface
+
+from billing.payment_processors.simulated import Simulated
+from billing.workload import FakeServiceBridge, generate_workload
+
+
+@dataclasses.dataclass
+class BenchmarkResult:
+    name: str
+    wall_time: float
+    queries: int
+    peak_memory: int
+    subscriptions: int
+    error: str = None
+
+    @property
+    def queries_per_subscription(self):
+        if not self.subscriptions:
+            return 0
+        return self.queries / self.subscriptions
+
+    def __str__(self):
+        return (
+            f"{self.name}: {self.wall_time:.2f}s, {self.queries} queries "
+            f"({self.queries_per_subscription:.1f} per subscription), "
+            f"peak memory {self.peak_memory / 1024 / 1024:.1f} MiB"
+            f"{' (errored)' if self.error else ''}"
+        )
+
+
+class QueryCounter:
+    """
+    Database execute wrapper that counts queries without recording them
+    """
+
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+class Command(CommandInterface):
+    help = "Benchmarks billing_cycles and billing_product_expiry against a synthetic workload"
+
+    # commands measured by a benchmark run, each needs to produce
+    # a result for the benchmark to pass
+    scenarios = ("billing_product_expiry", "billing_cycles")
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+
+        parser.add_argument(
+            "--orgs", type=int, default=100, help="Number of organizations"
+        )
+        parser.add_argument(
+            "--subscriptions-per-org",
+            type=int,
+            default=1,
+            help="Number of subscriptions per organization",
+        )
+        parser.add_argument(
+            "--metered-ratio",
+            type=float,
+            default=0.5,
+            help="Share of subscriptions with a metered product",
+        )
+        parser.add_argument(
+            "--modifier-ratio",
+            type=float,
+            default=0.25,
+            help="Share of subscriptions with a price modifier",
+        )
+        parser.add_argument(
+            "--expired-per-org",
+            type=int,
+            default=1,
+            help="Number of expired trial products per organization",
+        )
+        parser.add_argument(
+            "--processor-latency",
+            type=float,
+            default=0,
+            help="Latency (seconds) of payment processor requests",
+        )
+        parser.add_argument(
+            "--processor-failure-rate",
+            type=float,
+            default=0,
+            help="Share of charges declined by the payment processor",
+        )
+        parser.add_argument(
+            "--processor-settle-after",
+            type=int,
+            default=0,
+            help="Number of status syncs a charge stays pending before it settles",
+        )
+        parser.add_argument(
+            "--processor-rate-limit-rate",
+            type=float,
+            default=0,
+            help="Share of payment processor requests answered with a rate limit error",
+        )
+        parser.add_argument(
+            "--usage-latency",
+            type=float,
+            default=0,
+            help="Latency (seconds) of service application usage requests",
+        )
+        parser.add_argument(
+            "--query-budget",
+            type=float,
+            default=None,
+            help="Fail if billing_cycles makes more than this many queries per subscription",
+        )
+        parser.add_argument("--seed", type=int, default=0, help="Random seed")
+
+    def handle(self, *args, **kwargs):
+        self.results = []
+        self.query_budget = kwargs.get("query_budget")
+
+        super().handle(*args, **kwargs)
+
+        # errors inside `run` (and the measured commands) are logged and
+        # rolled back by the command interface, so they are raised and
+        # the budget is enforced once the run is done
+        results = {result.name: result for result in self.results}
+
+        for name in self.scenarios:
+            if name not in results:
+                raise CommandError(f"{name} produced no result: {self.error}")
+            if results[name].error:
+                raise CommandError(f"{name} errored: {results[name].error}")
+
+        for result in self.results:
+            if (
+                result.name == "billing_cycles"
+                and self.query_budget is not None
+                and result.queries_per_subscription > self.query_budget
+            ):
+                raise CommandError(
+                    f"Query budget exceeded: {result.queries_per_subscription:.1f} "
+                    f"queries per subscription (budget {self.query_budget})"
+                )
+
+    def run(self, *args, **kwargs):
+        ledger = Simulated.configure(
+            latency=kwargs.get("processor_latency", 0),
+            failure_rate=kwargs.get("processor_failure_rate", 0),
+            settle_after=kwargs.get("processor_settle_after", 0),
+            rate_limit_rate=kwargs.get("processor_rate_limit_rate", 0),
+            seed=kwargs.get("seed", 0),
+        )
+
+        with FakeServiceBridge(latency=kwargs.get("usage_latency", 0)) as bridge:
+            t = time.monotonic()
+            workload = generate_workload(
+                orgs=kwargs.get("orgs", 100),
+                subscriptions_per_org=kwargs.get("subscriptions_per_org", 1),
+                metered_ratio=kwargs.get("metered_ratio", 0.5),
+                modifier_ratio=kwargs.get("modifier_ratio", 0.25),
+                expired_per_org=kwargs.get("expired_per_org", 1),
+                service_url=bridge.url,
+                seed=kwargs.get("seed", 0),
+            )
+            bridge.server.usage = workload.usage
+
+            subscriptions = len(workload.subscriptions)
+
+            self.log_info(
+                f"generated {len(workload.orgs)} organizations with {subscriptions} "
+                f"subscriptions in {time.monotonic() - t:.2f}s"
+            )
+
+            # expiry is also measured in pretend mode, so billing_cycles
+            # still has the expired products to work on
+            self.measure(
+                "billing_product_expiry", subscriptions, "billing_product_expiry"
+            )
+            self.measure("billing_cycles", subscriptions, "billing_cycles", commit=True)
+
+            self.log_info(f"usage requests: {bridge.requests}")
+
+        self.log_info(
+            f"processor requests: {len(ledger.requests)}, "
+            f"declined: {ledger.declined}, rate limited: {ledger.rate_limited}"
+        )
+
+        for result in self.results:
+            self.log_info(f"{result}")
+
+    def measure(self, name, subscriptions, *args, **kwargs):
+        """
+        Runs the command and records its wall time, query count
+        and peak memory, along with the error the command logged (if any)
+        """
+
+        command = load_command_class(get_commands()[args[0]], args[0])
+        counter = QueryCounter()
+
+        tracemalloc.start()
+        t = time.monotonic()
+
+        try:
+            with connection.execute_wrapper(counter):
+                call_command(command, *args[1:], stdout=io.StringIO(), **kwargs)
+            wall_time = time.monotonic() - t
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+        result = BenchmarkResult(
+            name=name,
+            wall_time=wall_time,
+            queries=counter.queries,
+            peak_memory=peak_memory,
+            subscriptions=subscriptions,
+            error=getattr(command, "error", None),
+        )
+        self.results.append(result)
+        return result
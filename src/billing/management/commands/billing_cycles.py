@@ -1,14 +1,39 @@
+import concurrent.futures
+import contextlib
 import dataclasses
+import datetime
+import io
+import multiprocessing
+import time
 import traceback
 
+import django
 import reversion
+from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import Prefetch, Q
+from django.db.models.functions import Mod
 from django.utils import timezone
 from fullctl.django.auditlog import auditlog
 from fullctl.django.management.commands.base import CommandInterface
 
-from billing.models import Invoice, OrganizationProduct, Subscription, SubscriptionCycle
+from billing.models import (
+    BillingRun,
+    Invoice,
+    OrganizationProduct,
+    PaymentCharge,
+    Subscription,
+    SubscriptionCycle,
+    SubscriptionProduct,
+)
 from billing.payment_processors.processor import InternalProcessorError
+from billing.payment_processors.stripe import Reconciliation
+from billing.usage import UsageCollector
+
+# first key of the two-part postgres advisory lock used to guard
+# subscriptions during billing (second key is the subscription id)
+ADVISORY_LOCK_NAMESPACE = 0x62696C6C
 
 
 @dataclasses.dataclass
@@ -18,6 +43,92 @@ class InternalErrorInfo:
     traceback: str
 
 
+@contextlib.contextmanager
+def lock_subscription(subscription):
+    """
+    Context manager that attempts to acquire a database advisory lock for
+    the subscription, yields whether or not the lock was acquired.
+
+    The lock is session level and released when the block exits, so only
+    a single lock is held at a time, even if the whole run happens in one
+    transaction (pretend mode). Open the subscription's transaction inside
+    the block, so the lock is held until its changes are committed (or
+    rolled back) and no other worker or concurrent run can charge the same
+    cycle in the meantime.
+
+    On database backends that do not support advisory locks the lock
+    is always considered acquired.
+    """
+
+    if connection.vendor != "postgresql":
+        yield True
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT pg_try_advisory_lock(%s, %s)",
+            [ADVISORY_LOCK_NAMESPACE, subscription.id],
+        )
+        acquired = cursor.fetchone()[0]
+
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_advisory_unlock(%s, %s)",
+                    [ADVISORY_LOCK_NAMESPACE, subscription.id],
+                )
+
+
+def progress_shard(shards, shard_index, commit, progress_all=False, **options):
+    """
+    Process pool entry point, progresses the subscription cycles
+    of a single shard.
+
+    Additional options are passed through to the command.
+
+    Returns a dict containing the command output, the phase durations
+    and the critical cycle errors as (subscription cycle id, subscription id,
+    traceback) tuples so they can be merged into the report of the parent
+    process.
+    """
+
+    stdout = io.StringIO()
+    command = Command(stdout=stdout)
+    command.pool_worker = True
+
+    try:
+        call_command(
+            command,
+            shards=shards,
+            shard_index=shard_index,
+            commit=commit,
+            all=progress_all,
+            stdout=stdout,
+            **options,
+        )
+    except CommandError:
+        # critical cycle errors are reported by the parent process
+        pass
+
+    return {
+        "shard_index": shard_index,
+        "completed": getattr(command, "completed", False),
+        "output": stdout.getvalue(),
+        "phases": getattr(command, "phase_durations", {}),
+        "errors": [
+            (
+                error_info.subscription_cycle.id,
+                error_info.subscription_cycle.subscription_id,
+                error_info.traceback,
+            )
+            for error_info in command.critical_cycle_errors
+        ],
+    }
+
+
 def catch_internal_processor_error(fn):
     """
     decorator to catch internal processor errors and log them
@@ -37,26 +148,211 @@ class Command(CommandInterface):
 
     commit = False
 
+    # set on commands spawned by the process pool, these only
+    # progress the subscription cycles of their shard
+    pool_worker = False
+
+    # number of rows read from the database at a time when
+    # iterating over subscriptions and expiring products
+    chunk_size = 500
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=1,
+            help="Split subscriptions into N shards by organization id",
+        )
+        parser.add_argument(
+            "--shard-index",
+            type=int,
+            default=0,
+            help="Index of the shard to process (0 to N-1). Product expiry and open invoice sync only run on shard 0",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Progress subscription cycles in a pool of N processes",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Progress all active subscriptions, not just the ones that have billing work due (e.g., to refresh usage of all subscriptions)",
+        )
+        parser.add_argument(
+            "--usage-concurrency",
+            type=int,
+            default=4,
+            help="Max concurrent usage requests per service application",
+        )
+        parser.add_argument(
+            "--usage-timeout",
+            type=float,
+            default=10,
+            help="Timeout (seconds) for usage requests to service applications",
+        )
+        parser.add_argument(
+            "--usage-retries",
+            type=int,
+            default=2,
+            help="Number of times a failed usage request is retried",
+        )
+        parser.add_argument(
+            "--resume",
+            type=int,
+            default=None,
+            help="Resume the billing run with this id, skipping subscriptions the run already processed",
+        )
+
     def handle(self, *args, **kwargs):
         self.critical_cycle_errors = []
 
+        self.shards = kwargs.get("shards", 1)
+        self.shard_index = kwargs.get("shard_index", 0)
+        self.workers = kwargs.get("workers", 1)
+        self.all = kwargs.get("all", False)
+        self.usage_concurrency = kwargs.get("usage_concurrency", 4)
+        self.usage_timeout = kwargs.get("usage_timeout", 10)
+        self.usage_retries = kwargs.get("usage_retries", 2)
+        self.resume = kwargs.get("resume")
+
+        if self.shards < 1 or self.workers < 1:
+            raise CommandError("--shards and --workers need to be at least 1")
+
+        if self.usage_concurrency < 1:
+            raise CommandError("--usage-concurrency needs to be at least 1")
+
+        if not 0 <= self.shard_index < self.shards:
+            raise CommandError(
+                f"--shard-index needs to be between 0 and {self.shards - 1}"
+            )
+
+        if self.resume and not BillingRun.objects.filter(id=self.resume).exists():
+            raise CommandError(f"Billing run {self.resume} does not exist")
+
         super().handle(*args, **kwargs)
 
         self.handle_cycle_errors(self.critical_cycle_errors)
 
+    def _run(self, *args, **kwargs):
+        # pretend mode runs in a single transaction that is rolled back
+        if not self.commit:
+            return super()._run(*args, **kwargs)
+
+        # committal runs are checkpointed: each subscription is committed
+        # on its own so an interrupted run can be resumed with --resume
+        return self.run(*args, **kwargs)
+
     def run(self, *args, **kwargs):
-        self.progress_product_expiry()
-        self.progress_subscription_cycles()
-        self.sync_open_invoices()
+        # product expiry and open invoice sync are not sharded
+        global_phases = self.shard_index == 0 and not self.pool_worker
+
+        self.usage_collector = UsageCollector(
+            concurrency=self.usage_concurrency,
+            timeout=self.usage_timeout,
+            retries=self.usage_retries,
+        )
+
+        self.reconciliation = Reconciliation()
+
+        self.phase_durations = {}
+        self.billing_run = self.start_billing_run()
+
+        try:
+            if global_phases:
+                with self.phase("expiry"), reversion.create_revision():
+                    self.progress_product_expiry()
+
+            if self.workers > 1:
+                completed = self.progress_subscription_cycles_in_pool()
+            else:
+                completed = self.progress_subscription_cycles()
+                self.log_usage_collection()
+
+            if global_phases:
+                with self.phase("invoice_sync"):
+                    self.sync_open_invoices()
+        except Exception:
+            # in pretend mode the run is rolled back regardless
+            if self.commit:
+                self.finish_billing_run("failed")
+            raise
+
+        # progressing subscriptions is aborted on internal processor errors
+        self.completed = bool(completed)
+        self.finish_billing_run("completed" if self.completed else "failed")
+
+    def start_billing_run(self):
+        """
+        Returns the billing run to record progress in, either the run
+        that is resumed or a new one
+        """
+
+        if self.resume:
+            billing_run = BillingRun.objects.get(id=self.resume)
+            if not self.pool_worker:
+                self.log_info(f"resuming {billing_run}")
+            return billing_run
+
+        billing_run = BillingRun.objects.create(
+            options={
+                "shards": self.shards,
+                "shard_index": self.shard_index,
+                "workers": self.workers,
+                "all": self.all,
+            }
+        )
+        self.log_info(f"started {billing_run}")
+        return billing_run
+
+    def finish_billing_run(self, status):
+        """
+        Records the phase durations and final status of the billing run
+
+        Pool workers only report their phase durations back to the parent
+        process which finishes the run.
+        """
+
+        if self.pool_worker:
+            return
+
+        for name, duration in self.phase_durations.items():
+            self.billing_run.add_phase_duration(name, duration)
+        self.billing_run.finish(status)
+
+        phases = ", ".join(
+            f"{name}: {duration:.2f}s"
+            for name, duration in self.phase_durations.items()
+        )
+        self.log_info(f"{self.billing_run} finished ({phases})")
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager that adds the time spent in the block to the
+        duration of the phase
+        """
+
+        t = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phase_durations[name] = (
+                self.phase_durations.get(name, 0) + time.monotonic() - t
+            )
 
     def progress_product_expiry(self, *args, **kwargs):
-        qset = OrganizationProduct.objects.filter(expires__lt=timezone.now())
-        for org_prod in qset:
+        qset = (
+            OrganizationProduct.objects.filter(expires__lt=timezone.now())
+            .select_related("org", "product__expiry_replacement_product")
+            .order_by("id")
+        )
+        for org_prod in qset.iterator(chunk_size=self.chunk_size):
             self.log_info(f"Expiring {org_prod.product} for {org_prod.org}")
-            if org_prod.product.expiry_replacement_product_id:
-                replacement_product = org_prod.product.expiry_replacement_product
-            else:
-                replacement_product = None
+            replacement_product = org_prod.product.expiry_replacement_product
 
             org_prod.delete()
 
@@ -84,106 +380,308 @@ class Command(CommandInterface):
                     )
                     replacement_product.add_to_org(subscription.org)
 
+    def progress_subscription_cycles_in_pool(self):
+        """
+        Splits the shard into `workers` sub-shards and progresses each
+        of them in its own process.
+
+        Critical cycle errors from all workers are merged into
+        `critical_cycle_errors`, phase durations are summed up across workers.
+
+        Returns whether all workers completed
+        """
+
+        shards = self.shards * self.workers
+
+        # workers are spawned rather than forked so they do not inherit
+        # the database connection (and open transaction) of this process
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        )
+
+        with executor:
+            futures = [
+                executor.submit(
+                    progress_shard,
+                    shards,
+                    self.shard_index + self.shards * worker,
+                    self.commit,
+                    self.all,
+                    # in pretend mode the run is not committed and not visible
+                    # to the workers, which will record their own runs instead
+                    resume=self.billing_run.id if self.commit else None,
+                    usage_concurrency=self.usage_concurrency,
+                    usage_timeout=self.usage_timeout,
+                    usage_retries=self.usage_retries,
+                )
+                for worker in range(self.workers)
+            ]
+
+            completed = True
+
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                self.log_info(
+                    f"shard {result['shard_index']}/{shards} finished\n{result['output']}"
+                )
+                completed = completed and result["completed"]
+                for name, duration in result["phases"].items():
+                    self.phase_durations[name] = (
+                        self.phase_durations.get(name, 0) + duration
+                    )
+                for subscription_cycle_id, subscription_id, tb in result["errors"]:
+                    subscription_cycle = SubscriptionCycle.objects.filter(
+                        id=subscription_cycle_id
+                    ).first()
+
+                    if not subscription_cycle:
+                        # cycle was rolled back by the worker (pretend mode)
+                        subscription_cycle = SubscriptionCycle(
+                            id=subscription_cycle_id, subscription_id=subscription_id
+                        )
+
+                    self.critical_cycle_errors.append(
+                        InternalErrorInfo(
+                            subscription_cycle=subscription_cycle,
+                            exc=None,
+                            traceback=tb,
+                        )
+                    )
+
+        return completed
+
+    def subscription_queryset(self):
+        """
+        Returns the active subscriptions that belong to the current shard
+        and have billing work due (unless --all is set)
+
+        When resuming a billing run subscriptions that were already
+        processed by the run are excluded.
+        """
+
+        qset = Subscription.objects.filter(status="ok")
+
+        if not self.all:
+            qset = qset.filter(
+                Q(next_action_at__isnull=True) | Q(next_action_at__lte=timezone.now())
+            )
+
+        if self.shards > 1:
+            qset = qset.annotate(shard=Mod("org_id", self.shards)).filter(
+                shard=self.shard_index
+            )
+
+        if self.resume:
+            qset = qset.exclude(
+                id__in=self.billing_run.subscription_set.values("subscription_id")
+            )
+
+        return qset.order_by("id")
+
     @catch_internal_processor_error
     def progress_subscription_cycles(self):
-        qset = Subscription.objects.filter(status="ok")
+        """
+        Progresses the subscription cycles of all due subscriptions,
+        checkpointing each subscription in the billing run
+
+        Returns True once all subscriptions have been processed
+        """
+
+        qset = self.subscription_queryset()
+
+        # the phases ahead of progressing the subscriptions only request
+        # usage and payment intents, they run outside of a transaction so
+        # none is held open across the requests
+
+        with self.phase("usage"):
+            self.prefetch_usage(qset)
+
+        with self.phase("pending_sync"):
+            self.reconcile_pending_charges(qset)
+
+        qset = (
+            qset.billing_state()
+            .select_related("org", "group")
+            .prefetch_related(
+                Prefetch(
+                    "subscription_product_set",
+                    queryset=SubscriptionProduct.objects.select_related(
+                        "product__component"
+                    ),
+                )
+            )
+        )
+
+        for subscription in qset.iterator(chunk_size=self.chunk_size):
+            with lock_subscription(subscription) as locked:
+                if not locked:
+                    self.log_info(
+                        f"subscription {subscription} ({subscription.id}) is locked by another worker, skipping ..."
+                    )
+                    continue
+
+                # each subscription is progressed in its own transaction
+                with reversion.create_revision():
+                    errors = len(self.critical_cycle_errors)
+
+                    self.progress_subscription_cycle(subscription)
+
+                    if len(self.critical_cycle_errors) > errors:
+                        self.billing_run.checkpoint(subscription, "error")
+                    else:
+                        self.billing_run.checkpoint(subscription)
+
+        return True
 
+    def progress_subscription_cycle(self, subscription):
+        # cycles saved and charged along the way do not update when the
+        # subscription needs to be processed next, it is updated once
+        with subscription.defer_next_action():
+            with self.phase("charge"):
+                self.charge_subscription_cycles(subscription)
+
+            with self.phase("pending_sync"):
+                self.sync_pending_charges(subscription)
+
+    def charge_subscription_cycles(self, subscription):
         errored = self.critical_cycle_errors
 
-        for subscription in qset:
+        self.log_info(f"checking subscription {subscription} ({subscription.id}) ...")
+
+        if not subscription.subscription_cycle:
+            subscription.start_subscription_cycle()
             self.log_info(
-                f"checking subscription {subscription} ({subscription.id}) ..."
+                f"-- started new billing subscription_cycle: {subscription.subscription_cycle}"
             )
+        else:
+            self.log_info(f"-- subscription_cycle: {subscription.subscription_cycle}")
 
-            if not subscription.subscription_cycle:
-                subscription.start_subscription_cycle()
-                self.log_info(
-                    f"-- started new billing subscription_cycle: {subscription.subscription_cycle}"
-                )
-            else:
+        for subscription_product in subscription.subscription_product_set.all():
+            self.collect(subscription_product, subscription.subscription_cycle)
+
+        for subscription_cycle in subscription.subscription_cycle_set.filter(
+            status__in=["open", "failed"]
+        ):
+            if not subscription_cycle.ended and subscription.charge_type == "end":
+                continue
+            if not subscription.payment_method_id:
+                Subscription.set_payment_method(subscription.org)
+            if not subscription.payment_method_id:
                 self.log_info(
-                    f"-- subscription_cycle: {subscription.subscription_cycle}"
+                    f"-- no payment method set, unable to charge subscription cycle for org {subscription.org}"
                 )
+                break
 
-            for subscription_product in subscription.subscription_product_set.all():
-                self.collect(subscription_product, subscription.subscription_cycle)
+            if not subscription_cycle.charged:
+                if (
+                    subscription_cycle.status == "open"
+                    and subscription.charge_type == "end"
+                ):
+                    # subscriptions are not progressed while their cycle
+                    # runs, so collect the usage of the ended cycle now
+                    self.collect_cycle_usage(subscription_cycle)
 
-            for subscription_cycle in subscription.subscription_cycle_set.filter(
-                status__in=["open", "failed"]
-            ):
-                if not subscription_cycle.ended and subscription.charge_type == "end":
-                    continue
-                if not subscription.payment_method_id:
-                    Subscription.set_payment_method(subscription.org)
-                if not subscription.payment_method_id:
-                    self.log_info(
-                        f"-- no payment method set, unable to charge subscription cycle for org {subscription.org}"
-                    )
-                    break
+                if subscription_cycle.status == "failed":
+                    # we are retrying a failed subscription cycle charge
 
-                if not subscription_cycle.charged:
-                    if subscription_cycle.status == "failed":
-                        # we are retrying a failed subscription cycle charge
+                    self.log_info("-- retrying failed subscription cycle charge")
 
-                        self.log_info("-- retrying failed subscription cycle charge")
+                self.log_info(
+                    f"-- charging ${subscription_cycle.price} for subscription cycle: {subscription_cycle}"
+                )
 
-                    self.log_info(
-                        f"-- charging ${subscription_cycle.price} for subscription cycle: {subscription_cycle}"
-                    )
+                try:
+                    with reversion.create_revision():
+                        subscription_cycle_charge = subscription_cycle.charge(
+                            commit=self.commit
+                        )
 
-                    try:
-                        with reversion.create_revision():
-                            subscription_cycle_charge = subscription_cycle.charge(
+                    with reversion.create_revision():
+                        if subscription_cycle_charge:
+                            subscription_cycle_charge.payment_charge.sync_status(
                                 commit=self.commit
                             )
-
-                        with reversion.create_revision():
-                            if subscription_cycle_charge:
-                                subscription_cycle_charge.payment_charge.sync_status(
-                                    commit=self.commit
-                                )
-                    except InternalProcessorError:
-                        # Errors like legacy payment methods, etc. that are handled
-                        # separately and don't lead to any actual charges made
-                        raise
-                    except Exception as exc:
-                        # DATABASE/DJANGO error where the charge may have been made
-                        #
-                        # subscription cycle will be set to `error` and manual
-                        # review wil be required.
-                        #
-                        # A proper error will be raised at the end of command
-                        # execution containing all errored subscriptions.
-                        #
-                        # Subscription cycles with status `error` will not be retried
-                        # and will require manual review.
-                        error_info = InternalErrorInfo(
-                            subscription_cycle=subscription_cycle,
-                            exc=exc,
-                            traceback=traceback.format_exc(),
-                        )
-                        errored.append(error_info)
-                        self.log_error(
-                            f"INTERNAL ERROR (possibly charged)\n{error_info}"
-                        )
-
-            # sync charge processing status
-
-            for subscription_cycle in subscription.subscription_cycle_set.filter(
-                subscription_cycle_charge_set__payment_charge__status__in=["pending"]
-            ).distinct("id"):
-                subscription_cycle_charges = (
-                    subscription_cycle.subscription_cycle_charge_set.filter(
-                        payment_charge__status="pending"
+                except InternalProcessorError:
+                    # Errors like legacy payment methods, etc. that are handled
+                    # separately and don't lead to any actual charges made
+                    raise
+                except Exception as exc:
+                    # DATABASE/DJANGO error where the charge may have been made
+                    #
+                    # subscription cycle will be set to `error` and manual
+                    # review wil be required.
+                    #
+                    # A proper error will be raised at the end of command
+                    # execution containing all errored subscriptions.
+                    #
+                    # Subscription cycles with status `error` will not be retried
+                    # and will require manual review.
+                    error_info = InternalErrorInfo(
+                        subscription_cycle=subscription_cycle,
+                        exc=exc,
+                        traceback=traceback.format_exc(),
                     )
+                    errored.append(error_info)
+                    self.log_error(f"INTERNAL ERROR (possibly charged)\n{error_info}")
+
+    def sync_pending_charges(self, subscription):
+        """
+        Syncs the processing status of pending subscription cycle charges
+        """
+
+        for subscription_cycle in subscription.subscription_cycle_set.filter(
+            subscription_cycle_charge_set__payment_charge__status__in=["pending"]
+        ).distinct("id"):
+            subscription_cycle_charges = (
+                subscription_cycle.subscription_cycle_charge_set.filter(
+                    payment_charge__status="pending"
                 )
-                for subscription_cycle_charge in subscription_cycle_charges:
-                    self.log_info(
-                        f"-- syncing pending subscription cycle charge: {subscription_cycle_charge}"
-                    )
-                    subscription_cycle_charge.payment_charge.sync_status(
-                        commit=self.commit
+            )
+            for subscription_cycle_charge in subscription_cycle_charges:
+                if (
+                    subscription_cycle_charge.payment_charge_id
+                    in self.reconciliation.reconciled_charges
+                ):
+                    # payment intent was loaded by the batch reconciliation
+                    self.reconciliation.sync_charge(
+                        subscription_cycle_charge.payment_charge
                     )
+                    continue
+
+                self.log_info(
+                    f"-- syncing pending subscription cycle charge: {subscription_cycle_charge}"
+                )
+                subscription_cycle_charge.payment_charge.sync_status(commit=self.commit)
+
+    def reconcile_pending_charges(self, subscriptions):
+        """
+        Loads the payment intents of the pending stripe charges of the
+        subscriptions in batch before the subscriptions are progressed
+
+        The charges are synced by `sync_pending_charges` while their
+        subscription is locked, from the loaded payment intent if there
+        is one, individually otherwise
+        """
+
+        # the processor is not contacted in pretend mode
+        if not self.commit:
+            return
+
+        qset = PaymentCharge.objects.filter(
+            status="pending",
+            payment_method__processor="stripe",
+            subscription_cycle_charge__subscription_cycle__subscription__in=subscriptions.values(
+                "id"
+            ),
+        ).select_related("payment_method__billing_contact__customer")
+
+        found = self.reconciliation.load_charges(qset)
+        self.log_info(
+            f"reconciled {found} pending charges with stripe "
+            f"({self.reconciliation.requests} requests)"
+        )
 
     def handle_cycle_errors(self, errored):
         if not errored:
@@ -200,6 +698,64 @@ class Command(CommandInterface):
             f"Critical errors occurred in {len(subscriptions)} subscriptions: \n\n{subscriptions}\n\nPlease review manually."
         )
 
+    def prefetch_usage(self, subscriptions):
+        """
+        Fetches usage of all metered products of the subscriptions
+        concurrently before the subscription cycles are progressed
+        """
+
+        qset = (
+            SubscriptionProduct.objects.filter(
+                subscription__in=subscriptions, product__component__isnull=False
+            )
+            .select_related("product__component", "subscription__org")
+            .order_by("id")
+        )
+
+        # usage pushed by the services for the current cycles and the ended
+        # cycles that are about to be charged does not need to be requested
+
+        today = datetime.date.today()
+        pushed = self.usage_collector.load_pushed(
+            SubscriptionCycle.objects.filter(subscription__in=subscriptions).filter(
+                Q(start__lte=today, end__gt=today) | Q(status="open", end__lte=today)
+            )
+        )
+        if pushed:
+            self.log_info(f"loaded pushed usage for {pushed} subscription products")
+
+        targets = {}
+        pulled = set()
+        for subscription_product in qset:
+            service = subscription_product.product.component
+            org = subscription_product.subscription.org
+            targets[(service.id, org.id)] = (service, org)
+            if subscription_product.id not in self.usage_collector.pushed_products:
+                pulled.add((service.id, org.id))
+
+        targets = {key: target for key, target in targets.items() if key in pulled}
+
+        if not targets:
+            return
+
+        t = time.monotonic()
+        fetched = self.usage_collector.prefetch(targets.values())
+        self.log_info(
+            f"prefetched usage for {fetched} organization services in {time.monotonic() - t:.2f}s"
+        )
+
+        for (service_id, org_id), exc in self.usage_collector.errors.items():
+            self.log_error(
+                f"usage prefetch failed for service {service_id}, org {org_id}: {exc}"
+            )
+
+    def log_usage_collection(self):
+        collector = self.usage_collector
+        self.log_info(
+            f"usage collection: {collector.requests} service requests "
+            f"for {collector.lookups} products ({collector.saved} saved)"
+        )
+
     def collect(self, subscription_product, subscription_cycle):
         org = subscription_cycle.subscription.org
 
@@ -207,22 +763,53 @@ class Command(CommandInterface):
         if not service:
             subscription_cycle.update_usage(subscription_product, None)
             return
-        bridge = service.bridge(org)
         product = subscription_product.product.name
 
+        usage = self.usage_collector.pushed_usage(
+            subscription_cycle, subscription_product
+        )
+        if usage is not None:
+            self.log_info(f"{org} -> {product}: {usage} (pushed)")
+            subscription_cycle.update_usage(subscription_product, usage)
+            return
+
         try:
-            usage = bridge.usage(product)
+            usage = self.usage_collector.usage(service, org, product)
             self.log_info(f"{org} -> {product}: {usage}")
             subscription_cycle.update_usage(subscription_product, usage)
         except KeyError as exc:
             self.log_error(f"{exc}")
 
+    def collect_cycle_usage(self, subscription_cycle):
+        """
+        Collects the usage of the products of an ended subscription cycle
+        before it is charged
+        """
+
+        qset = subscription_cycle.subscription_cycle_product_set.select_related(
+            "subscription_product__product__component"
+        )
+
+        for cycle_product in qset:
+            self.collect(cycle_product.subscription_product, subscription_cycle)
+
     def sync_open_invoices(self):
         qset = Invoice.objects.filter(status="pending").order_by("created")
 
+        if self.commit:
+            changed = self.reconciliation.sync_invoices(qset)
+            self.log_info(
+                f"reconciled {len(self.reconciliation.reconciled_invoices)} open invoices "
+                f"with stripe ({changed} changed)"
+            )
+
         for invoice in qset:
             if not invoice.data.get("stripe_invoice"):
                 continue
 
+            if invoice.id in self.reconciliation.reconciled_invoices:
+                continue
+
             self.log_info(f"syncing open invoice {invoice}")
-            invoice.sync_status(commit=self.commit)
+            with reversion.create_revision():
+                invoice.sync_status(commit=self.commit)
@@ -0,0 +1,58 @@
+from fullctl.django.management.commands.base import CommandInterface
+
+from billing.forecast import Forecast
+from billing.models import Subscription
+
+
+class Command(CommandInterface):
+    help = "Forecasts revenue and metered usage of subscriptions for the coming months"
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+
+        parser.add_argument(
+            "--months", type=int, default=12, help="Number of months to forecast"
+        )
+        parser.add_argument(
+            "--history",
+            type=int,
+            default=3,
+            help="Number of ended cycles the metered usage trend is computed from",
+        )
+        parser.add_argument(
+            "--org",
+            type=str,
+            default=None,
+            help="Only forecast this organization (slug)",
+        )
+
+    def run(self, *args, **kwargs):
+        qset = Subscription.objects.all()
+
+        if kwargs.get("org"):
+            qset = qset.filter(org__slug=kwargs.get("org"))
+
+        forecast = Forecast(
+            months=kwargs.get("months", 12),
+            history=kwargs.get("history", 3),
+            queryset=qset,
+        )
+
+        self.log_info(f"forecast for {forecast.subscriptions} subscriptions")
+        self.log_info(
+            f"{'period':<12} {'revenue':>12} {'mrr':>12} {'usage':>12} {'charges':>8}"
+        )
+
+        for period in forecast.periods:
+            self.log_info(
+                f"{period.start.isoformat():<12} {period.revenue:>12.2f} "
+                f"{period.mrr:>12.2f} {period.usage:>12.0f} {period.charges:>8}"
+            )
+
+        self.log_info(f"{'total':<12} {forecast.revenue:>12.2f}")
+
+        for expiry in forecast.expiries:
+            self.log_info(
+                f"expiring {expiry.kind} {expiry.date.isoformat()}: "
+                f"{expiry.description} ({expiry.org_name}, subscription {expiry.subscription_id})"
+            )
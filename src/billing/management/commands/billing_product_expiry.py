@@ -7,8 +7,15 @@ from billing.models import OrganizationProduct
 class Command(CommandInterface):
     help = "Handles organization product access expiry"
 
+    # number of rows read from the database at a time
+    chunk_size = 500
+
     def run(self, *args, **kwargs):
-        qset = OrganizationProduct.objects.filter(expires__lt=timezone.now())
-        for org_prod in qset:
+        qset = (
+            OrganizationProduct.objects.filter(expires__lt=timezone.now())
+            .select_related("org", "product")
+            .order_by("id")
+        )
+        for org_prod in qset.iterator(chunk_size=self.chunk_size):
             self.log_info(f"Expiring {org_prod.product} for {org_prod.org}")
             org_prod.delete()
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.11 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("billing", "0035_subscriptioncycle_error_information_and_more"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="subscription",
+            name="next_action_at",
+            field=models.DateTimeField(
+                blank=True,
+                db_index=True,
+                help_text="When billing needs to process this subscription next (cycle turnover, charge or charge sync) - maintained automatically. If not set, the subscription is processed on the next billing run.",
+                null=True,
+            ),
+        ),
+    ]
@@ -0,0 +1,43 @@
+from django.db import migrations, models
+
+
+def renumber(Model, field):
+    """
+    Renumbers all but the first (lowest id) of the instances that share
+    a value for `field`, by appending a `-<n>` suffix, so a unique
+    constraint can be added to the field
+    """
+
+    qset = Model._base_manager.all()
+
+    duplicates = list(
+        qset.order_by()
+        .values(field)
+        .annotate(count=models.Count("id"))
+        .filter(count__gt=1)
+        .values_list(field, flat=True)
+    )
+
+    for number in duplicates:
+        suffix = 1
+        for instance in qset.filter(**{field: number}).order_by("id")[1:]:
+            while qset.filter(**{field: f"{number}-{suffix}"}).exists():
+                suffix += 1
+            setattr(instance, field, f"{number}-{suffix}")
+            instance.save(update_fields=[field])
+            suffix += 1
+
+
+def forwards(apps, schema_editor):
+    renumber(apps.get_model("billing", "Order"), "order_number")
+    renumber(apps.get_model("billing", "Invoice"), "invoice_number")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("billing", "0036_subscription_next_action_at"),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, migrations.RunPython.noop),
+    ]
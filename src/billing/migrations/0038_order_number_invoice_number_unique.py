@@ -0,0 +1,28 @@
+# Generated by Django 4.2.11 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+import billing.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("billing", "0037_renumber_duplicate_numbers"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="order",
+            name="order_number",
+            field=models.CharField(
+                default=billing.models.unique_order_id, max_length=255, unique=True
+            ),
+        ),
+        migrations.AlterField(
+            model_name="invoice",
+            name="invoice_number",
+            field=models.CharField(
+                default=billing.models.unique_invoice_id, max_length=255, unique=True
+            ),
+        ),
+    ]
@@ -0,0 +1,122 @@
+# Generated by Django 4.2.11 on 2026-10-18 16:40
+
+import django.db.models.deletion
+import django.db.models.manager
+import django_handleref.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("billing", "0038_order_number_invoice_number_unique"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="BillingRun",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "created",
+                    django_handleref.models.CreatedDateTimeField(
+                        auto_now_add=True, verbose_name="Created"
+                    ),
+                ),
+                (
+                    "updated",
+                    django_handleref.models.UpdatedDateTimeField(
+                        auto_now=True, verbose_name="Updated"
+                    ),
+                ),
+                ("version", models.IntegerField(default=0)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("running", "Running"),
+                            ("completed", "Completed"),
+                            ("failed", "Failed"),
+                        ],
+                        default="running",
+                        max_length=32,
+                    ),
+                ),
+                (
+                    "options",
+                    models.JSONField(
+                        blank=True,
+                        default=dict,
+                        help_text="Command options of the run",
+                    ),
+                ),
+                (
+                    "phases",
+                    models.JSONField(
+                        blank=True,
+                        default=dict,
+                        help_text="Duration (seconds) of each phase of the run",
+                    ),
+                ),
+                ("finished", models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                "verbose_name": "Billing Run",
+                "verbose_name_plural": "Billing Runs",
+                "db_table": "billing_run",
+            },
+            managers=[("handleref", django.db.models.manager.Manager())],
+        ),
+        migrations.CreateModel(
+            name="BillingRunSubscription",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "created",
+                    django_handleref.models.CreatedDateTimeField(
+                        auto_now_add=True, verbose_name="Created"
+                    ),
+                ),
+                (
+                    "updated",
+                    django_handleref.models.UpdatedDateTimeField(
+                        auto_now=True, verbose_name="Updated"
+                    ),
+                ),
+                ("version", models.IntegerField(default=0)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("completed", "Completed"),
+                            ("error", "Critical error (Manually review)"),
+                        ],
+                        default="completed",
+                        max_length=32,
+                    ),
+                ),
+                (
+                    "run",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="subscription_set",
+                        to="billing.billingrun",
+                    ),
+                ),
+                (
+                    "subscription",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="billing_run_set",
+                        to="billing.subscription",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Billing Run Subscription",
+                "verbose_name_plural": "Billing Run Subscriptions",
+                "db_table": "billing_run_subscription",
+                "unique_together": {("run", "subscription")},
+            },
+            managers=[("handleref", django.db.models.manager.Manager())],
+        ),
+    ]
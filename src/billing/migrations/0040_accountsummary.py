@@ -0,0 +1,103 @@
+# Generated by Django 4.2.11 on 2026-10-18 17:02
+
+import django.db.models.deletion
+import django.db.models.manager
+import django_handleref.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0040_invitation_expiry"),
+        ("billing", "0039_billingrun_billingrunsubscription"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AccountSummary",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "created",
+                    django_handleref.models.CreatedDateTimeField(
+                        auto_now_add=True, verbose_name="Created"
+                    ),
+                ),
+                (
+                    "updated",
+                    django_handleref.models.UpdatedDateTimeField(
+                        auto_now=True, verbose_name="Updated"
+                    ),
+                ),
+                ("version", models.IntegerField(default=0)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("ok", "Ok"),
+                            ("pending", "Pending"),
+                            ("deactivated", "Deactivated"),
+                            ("failed", "Failed"),
+                            ("expired", "Expired"),
+                        ],
+                        default="ok",
+                        max_length=12,
+                    ),
+                ),
+                (
+                    "currency",
+                    models.CharField(
+                        choices=[("USD", "USD")], default="USD", max_length=255
+                    ),
+                ),
+                (
+                    "ordered",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "invoiced",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "paid",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "deposited",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "withdrawn",
+                    models.DecimalField(decimal_places=2, default=0, max_digits=14),
+                ),
+                (
+                    "balance",
+                    models.DecimalField(
+                        decimal_places=2,
+                        default=0,
+                        help_text="Payments and deposits minus invoiced amounts and withdrawals, negative if money is owed",
+                        max_digits=14,
+                    ),
+                ),
+                ("transactions", models.PositiveIntegerField(default=0)),
+                ("last_payment", models.DateTimeField(blank=True, null=True)),
+                (
+                    "org",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="account_summary_set",
+                        to="account.organization",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Account Summary",
+                "verbose_name_plural": "Account Summaries",
+                "db_table": "billing_account_summary",
+                "unique_together": {("org", "currency")},
+            },
+            managers=[
+                ("handleref", django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
@@ -0,0 +1,65 @@
+# Generated by Django 4.2.11 on 2026-10-18 17:27
+
+import django.db.models.deletion
+import django.db.models.manager
+import django_handleref.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("account", "0040_invitation_expiry"),
+        ("billing", "0040_accountsummary"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OrganizationEntitlement",
+            fields=[
+                ("id", models.AutoField(primary_key=True, serialize=False)),
+                (
+                    "created",
+                    django_handleref.models.CreatedDateTimeField(
+                        auto_now_add=True, verbose_name="Created"
+                    ),
+                ),
+                (
+                    "updated",
+                    django_handleref.models.UpdatedDateTimeField(
+                        auto_now=True, verbose_name="Updated"
+                    ),
+                ),
+                ("version", models.IntegerField(default=0)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("ok", "Ok"),
+                            ("pending", "Pending"),
+                            ("deactivated", "Deactivated"),
+                            ("failed", "Failed"),
+                            ("expired", "Expired"),
+                        ],
+                        default="ok",
+                        max_length=12,
+                    ),
+                ),
+                (
+                    "org",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="entitlement",
+                        to="account.organization",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Organization Entitlement",
+                "verbose_name_plural": "Organization Entitlements",
+                "db_table": "billing_org_entitlement",
+            },
+            managers=[
+                ("handleref", django.db.models.manager.Manager()),
+            ],
+        ),
+    ]
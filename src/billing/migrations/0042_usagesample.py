@@ -0,0 +1,52 @@
+# Generated by Django 4.2.11 on 2026-10-18 17:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("billing", "0041_organizationentitlement"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UsageSample",
+            fields=[
+                ("id", models.BigAutoField(primary_key=True, serialize=False)),
+                ("timestamp", models.DateTimeField()),
+                ("units", models.PositiveIntegerField()),
+                (
+                    "subscription_cycle",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="usage_sample_set",
+                        to="billing.subscriptioncycle",
+                    ),
+                ),
+                (
+                    "subscription_product",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="usage_sample_set",
+                        to="billing.subscriptionproduct",
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Usage Sample",
+                "verbose_name_plural": "Usage Samples",
+                "db_table": "billing_usage_sample",
+                "indexes": [
+                    models.Index(
+                        fields=[
+                            "subscription_cycle",
+                            "subscription_product",
+                            "timestamp",
+                        ],
+                        name="billing_usa_subscri_b3faa4_idx",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -1,5 +1,7 @@
+import contextlib
+import contextvars
 import datetime
-import secrets
+import decimal
 import uuid
 
 import dateutil.relativedelta
@@ -10,7 +12,8 @@ from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError
 from django.core.validators import EmailValidator
-from django.db import models, transaction
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.functions import Coalesce, Trunc
 from django.shortcuts import render
 from django.utils import timezone
 from django.utils.translation import gettext as _
@@ -29,6 +32,13 @@ from applications.service_bridge import get_client_bridge, get_client_bridge_cls
 from billing.exceptions import OrgProductAlreadyExists
 from common.email import email
 from common.models import HandleRefModel
+from common.unique import TokenAllocator
+
+# ids of the subscriptions whose `next_action_at` updates are deferred
+# (see `Subscription.defer_next_action`)
+deferred_next_action = contextvars.ContextVar(
+    "deferred_next_action", default=frozenset()
+)
 
 # Create your models here.
 
@@ -225,53 +235,14 @@ class Product(HandleRefModel):
     def can_add_to_org(self, org, component_object_id=None):
         """
         Checks whether or not this product can be added to the supplied org.
-        """
-
-        if self.component_billable_entity and not component_object_id:
-            # product requires a component_object_id but none was supplied
-
-            return False
-
-        if not self.component_billable_entity and component_object_id:
-            # product does not require a component_object_id but one was supplied
-            return False
-
-        org_product = org.products.filter(
-            product=self, component_object_id=component_object_id
-        )
 
-        if org_product.exists():
-            return False
-
-        # if product is trial of another product and org as the `real` product
-        # then we can't add the trial product
-
-        for trial_product in self.trial_of.all():
-            for org_product in org.products.filter(product=trial_product):
-                if org_product.component_object_id == component_object_id:
-                    return False
+        To check several products for the same org use `ProductEligibility`
+        """
 
-        most_recent = (
-            OrganizationProductHistory.objects.filter(
-                org=org, product=self, component_object_id=component_object_id
-            )
-            .order_by("-created")
-            .first()
+        return ProductEligibility(org, [self]).can_add(
+            self, component_object_id=component_object_id
         )
 
-        if not most_recent:
-            return True
-
-        if self.renewable == 0:
-            return True
-
-        if self.renewable == -1:
-            return False
-
-        tdiff = (timezone.now() - most_recent.created).total_seconds() / 86400
-
-        return tdiff > self.renewable
-
     def add_to_org(self, org, notes=None, component_object_id=None):
         """
         Attempts to add this product to the supplied org.
@@ -497,6 +468,35 @@ class ProductModifier(HandleRefModel):
         verbose_name_plural = _("Product Price Modifiers")
 
 
+class SubscriptionQuerySet(models.QuerySet):
+    def billing_state(self):
+        """
+        Resolves the current subscription cycle and the charge type of
+        the subscriptions with one query each, rather than one per
+        subscription (see `Subscription.subscription_cycle` and
+        `Subscription.charge_type`)
+        """
+
+        return self.annotate(
+            has_metered_product=models.Exists(
+                SubscriptionProduct.objects.filter(
+                    subscription=models.OuterRef("pk"),
+                    product__recurring_product__type="metered",
+                )
+            )
+        ).prefetch_related(
+            models.Prefetch(
+                "subscription_cycle_set",
+                # cycles that have not ended yet, the current one is picked
+                # on access so the prefetch stays valid past midnight
+                queryset=SubscriptionCycle.objects.filter(
+                    end__gt=datetime.date.today()
+                ).order_by("id"),
+                to_attr="prefetched_subscription_cycles",
+            )
+        )
+
+
 @reversion.register()
 @grainy_model("billing.services", realted="org")
 class Subscription(HandleRefModel):
@@ -536,6 +536,17 @@ class Subscription(HandleRefModel):
         default=dict, blank=True, help_text=_("Any extra data for the subscription")
     )
 
+    next_action_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text=_(
+            "When billing needs to process this subscription next (cycle turnover, charge or charge sync) - maintained automatically. If not set, the subscription is processed on the next billing run."
+        ),
+    )
+
+    objects = SubscriptionQuerySet.as_manager()
+
     class HandleRef:
         tag = "subscription"
 
@@ -566,7 +577,36 @@ class Subscription(HandleRefModel):
 
     @property
     def subscription_cycle(self):
-        return self.get_subscription_cycle(datetime.date.today())
+        """
+        Returns the current subscription cycle
+
+        The cycle is memoized on the instance for the day, and reset
+        by `clear_billing_cache` when cycles change. If there is no
+        current cycle it is looked up again on the next access, since
+        it may be started through another instance.
+        """
+
+        today = datetime.date.today()
+        cached = self.__dict__.get("_subscription_cycle")
+
+        if cached and cached[0] == today:
+            return cached[1]
+
+        if hasattr(self, "prefetched_subscription_cycles"):
+            subscription_cycle = next(
+                (
+                    subscription_cycle
+                    for subscription_cycle in self.prefetched_subscription_cycles
+                    if subscription_cycle.start <= today < subscription_cycle.end
+                ),
+                None,
+            )
+        else:
+            subscription_cycle = self.get_subscription_cycle(today)
+
+        if subscription_cycle:
+            self._subscription_cycle = (today, subscription_cycle)
+        return subscription_cycle
 
     @property
     def charge_description(self):
@@ -581,20 +621,123 @@ class Subscription(HandleRefModel):
 
         otherwise the charge type will be `start`, charges
         will process at the beginniung of the cyle
+
+        The charge type is memoized on the instance, and reset by
+        `clear_billing_cache` when subscription products change.
         """
 
-        if self.subscription_product_set.filter(
-            product__recurring_product__type="metered"
-        ).exists():
-            return "end"
-        return "start"
+        if "_charge_type" in self.__dict__:
+            return self._charge_type
+
+        if hasattr(self, "has_metered_product"):
+            metered = self.has_metered_product
+        else:
+            metered = self.subscription_product_set.filter(
+                product__recurring_product__type="metered"
+            ).exists()
+
+        self._charge_type = "end" if metered else "start"
+        return self._charge_type
 
     def __str__(self):
         return f"{self.group.name} : {self.org}"
 
+    def clear_billing_cache(self):
+        """
+        Resets the memoized subscription cycle and charge type, along
+        with their prefetched state and prefetched subscription products
+        """
+
+        for attr in [
+            "_subscription_cycle",
+            "_charge_type",
+            "prefetched_subscription_cycles",
+            "has_metered_product",
+        ]:
+            self.__dict__.pop(attr, None)
+
+        getattr(self, "_prefetched_objects_cache", {}).pop(
+            "subscription_product_set", None
+        )
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.clear_billing_cache()
+
     def get_subscription_cycle(self, date):
         return self.subscription_cycle_set.filter(start__lte=date, end__gt=date).first()
 
+    def get_next_action_at(self):
+        """
+        Returns when billing needs to process this subscription next
+
+        - now, if there is no active cycle, a cycle is due to be charged
+          or a charge is pending
+        - otherwise the end of the active cycle
+
+        Metered usage is not collected in between, billing collects it
+        into ended cycles right before charging them.
+        """
+
+        now = timezone.now()
+        subscription_cycle = self.subscription_cycle
+
+        if not subscription_cycle:
+            return now
+
+        if PaymentCharge.objects.filter(
+            subscription_cycle_charge__subscription_cycle__subscription=self,
+            status="pending",
+        ).exists():
+            return now
+
+        # cycles that still need to be charged, `end` charge type subscriptions
+        # are only charged once the cycle has ended
+
+        uncharged = self.subscription_cycle_set.filter(status__in=["open", "failed"])
+
+        if self.charge_type == "end":
+            uncharged = uncharged.filter(end__lte=datetime.date.today())
+
+        if uncharged.exists():
+            return now
+
+        return timezone.make_aware(
+            datetime.datetime.combine(subscription_cycle.end, datetime.time.min)
+        )
+
+    def update_next_action(self):
+        """
+        Updates `next_action_at` from the current billing state
+        of the subscription
+
+        Does nothing while updates are deferred (see `defer_next_action`)
+        """
+
+        if self.id in deferred_next_action.get():
+            return
+
+        self.next_action_at = self.get_next_action_at()
+        Subscription.objects.filter(id=self.id).update(
+            next_action_at=self.next_action_at
+        )
+
+    @contextlib.contextmanager
+    def defer_next_action(self):
+        """
+        Defers `next_action_at` updates (e.g., from cycles being saved
+        or charged) while the block runs and updates it once the block
+        completes, so billing the subscription updates it only once
+        """
+
+        token = deferred_next_action.set(deferred_next_action.get() | {self.id})
+        try:
+            yield
+        finally:
+            deferred_next_action.reset(token)
+
+        self.update_next_action()
+
     @reversion.create_revision()
     def add_product(self, product):
         subscription_product, _ = SubscriptionProduct.objects.get_or_create(
@@ -608,11 +751,13 @@ class Subscription(HandleRefModel):
         end current subscription subscription_cycle prematurely
         """
 
-        if not self.subscription_cycle:
+        subscription_cycle = self.subscription_cycle
+
+        if not subscription_cycle:
             return
-        self.subscription_cycle.end = datetime.date.today()
-        self.subscription_cycle.save()
-        self.subscription_cycle.charge()
+        subscription_cycle.end = datetime.date.today()
+        subscription_cycle.save()
+        subscription_cycle.charge()
         self.start_subscription_cycle()
 
     def start_subscription_cycle(self, start=None, force=False):
@@ -882,10 +1027,39 @@ class SubscriptionCycle(HandleRefModel):
         The current total of the subscription_cycle
         """
 
-        price = 0
-        for charge in self.subscription_cycle_product_set.all():
-            price += float(charge.price)
-        return price
+        return self.pricing().total
+
+    @classmethod
+    def pricing_prefetch(cls):
+        """
+        Returns a Prefetch for subscription cycle querysets that loads
+        everything needed to price the cycles (see `pricing`)
+        """
+
+        return models.Prefetch(
+            "subscription_cycle_product_set",
+            queryset=SubscriptionCycleProduct.objects.pricing(),
+        )
+
+    def pricing(self):
+        """
+        Returns the CyclePricing for the subscription_cycle
+
+        Uses the prefetched products if the cycle was loaded with
+        `pricing_prefetch`, otherwise loads them in a fixed number of
+        queries.
+        """
+
+        if "subscription_cycle_product_set" in getattr(
+            self, "_prefetched_objects_cache", {}
+        ):
+            cycle_products = self.subscription_cycle_product_set.all()
+        else:
+            cycle_products = SubscriptionCycleProduct.objects.pricing().filter(
+                subscription_cycle=self
+            )
+
+        return CyclePricing(cycle_products)
 
     @property
     def ended(self):
@@ -974,7 +1148,9 @@ class SubscriptionCycle(HandleRefModel):
         self.status = "paid"
         self.save()
 
-        if not self.price:
+        pricing = self.pricing()
+
+        if not pricing.total:
             return
 
         pending_payment_charge = self.subscription_cycle_charge_set.filter(
@@ -985,7 +1161,7 @@ class SubscriptionCycle(HandleRefModel):
 
         payment_charge = PaymentCharge.objects.create(
             payment_method=self.subscription.payment_method,
-            price=self.price,
+            price=pricing.total,
             description=self.subscription.charge_description,
         )
 
@@ -993,8 +1169,9 @@ class SubscriptionCycle(HandleRefModel):
             subscription_cycle=self, payment_charge=payment_charge, status="pending"
         )
 
-        order_number = self.create_orders()
-        invoice = self.create_invoice(order_number)
+        with transaction.atomic():
+            order_number = self.create_orders(pricing)
+            invoice = self.create_invoice(order_number, pricing)
 
         if commit:
             self.subscription.payment_method.processor_instance.charge(payment_charge)
@@ -1008,59 +1185,95 @@ class SubscriptionCycle(HandleRefModel):
         invoice.charge_object = payment_charge
         invoice.save()
 
+        # a pending charge needs to be synced
+
+        self.subscription.update_next_action()
+
         return subscription_cycle_charge
 
-    def create_invoice(self, order_number):
+    def create_invoice(self, order_number, pricing=None):
         org = self.subscription.org
-        invoice_number = unique_invoice_id()
-        return self._create_invoices(org, invoice_number, order_number)
+        return self._create_invoices(org, None, order_number, pricing)
 
-    def create_orders(self):
+    def create_orders(self, pricing=None):
         org = self.subscription.org
-        order_number = unique_order_id()
-        self._create_orders(org, order_number)
-        return order_number
+        return self._create_orders(org, None, pricing).order_number
 
     def create_transactions(self, org):
         # DEPRECATED
-        order_number = unique_order_id()
-        self._create_orders(org, order_number)
+        pricing = self.pricing()
 
-        invoice_number = unique_invoice_id()
-        self._create_invoices(org, invoice_number, order_number)
+        order = self._create_orders(org, None, pricing)
+        self._create_invoices(org, None, order.order_number, pricing)
 
-    def _create_orders(self, org, order_number):
-        order, _ = Order.objects.get_or_create(
-            org=org,
-            order_number=order_number,
-        )
+    def _create_orders(self, org, order_number, pricing=None):
+        """
+        Creates the order for the subscription_cycle, a new order number
+        is allocated if `order_number` is None
+        """
 
-        for cycle_product in self.subscription_cycle_product_set.all():
-            OrderLine.objects.create(
-                amount=cycle_product.price,
-                subscription=self.subscription,
-                subscription_cycle_product=cycle_product,
-                product=cycle_product.subscription_product.product,
-                description=cycle_product.subscription_product.description,
-                order=order,
+        if order_number is None:
+            order = order_numbers.create(org=org)
+        else:
+            order, _ = Order.objects.get_or_create(
+                org=org,
+                order_number=order_number,
             )
 
-    def _create_invoices(self, org, invoice_number, order_number):
-        invoice, _ = Invoice.objects.get_or_create(
-            org=org,
-            invoice_number=invoice_number,
-            order=Order.objects.get(order_number=order_number),
+        if pricing is None:
+            pricing = self.pricing()
+
+        bulk_create_transactions(
+            OrderLine,
+            [
+                OrderLine(
+                    amount=price,
+                    subscription=self.subscription,
+                    subscription_cycle_product=cycle_product,
+                    product=cycle_product.subscription_product.product,
+                    description=cycle_product.subscription_product.description,
+                    order=order,
+                )
+                for cycle_product, price in pricing.lines
+            ],
         )
 
-        for cycle_product in self.subscription_cycle_product_set.all():
-            InvoiceLine.objects.create(
-                amount=cycle_product.price,
-                subscription=self.subscription,
-                subscription_cycle_product=cycle_product,
-                product=cycle_product.subscription_product.product,
-                description=cycle_product.subscription_product.description,
-                invoice=invoice,
+        return order
+
+    def _create_invoices(self, org, invoice_number, order_number, pricing=None):
+        """
+        Creates the invoice for the subscription_cycle, a new invoice number
+        is allocated if `invoice_number` is None
+        """
+
+        order = Order.objects.get(order_number=order_number)
+
+        if invoice_number is None:
+            invoice = invoice_numbers.create(org=org, order=order)
+        else:
+            invoice, _ = Invoice.objects.get_or_create(
+                org=org,
+                invoice_number=invoice_number,
+                order=order,
             )
+
+        if pricing is None:
+            pricing = self.pricing()
+
+        bulk_create_transactions(
+            InvoiceLine,
+            [
+                InvoiceLine(
+                    amount=price,
+                    subscription=self.subscription,
+                    subscription_cycle_product=cycle_product,
+                    product=cycle_product.subscription_product.product,
+                    description=cycle_product.subscription_product.description,
+                    invoice=invoice,
+                )
+                for cycle_product, price in pricing.lines
+            ],
+        )
         return invoice
 
 
@@ -1097,6 +1310,45 @@ class SubscriptionCycleCharge(HandleRefModel):
         )
 
 
+class CyclePricing:
+    """
+    Prices of the products in a subscription cycle
+
+    Expects subscription cycle products loaded through
+    `SubscriptionCycleProduct.objects.pricing()` so pricing does not
+    query the database per product.
+
+    Attributes:
+
+    - lines (`list`): (subscription cycle product, price) tuples
+    - total (`float`): total price of the subscription cycle
+    """
+
+    def __init__(self, cycle_products):
+        self.lines = [
+            (cycle_product, cycle_product.price) for cycle_product in cycle_products
+        ]
+        self.total = sum(float(price) for _, price in self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+
+class SubscriptionCycleProductQuerySet(models.QuerySet):
+    def pricing(self):
+        """
+        Loads everything needed to price the subscription cycle products:
+        product, recurring product and subscription product modifiers
+        """
+
+        return self.select_related(
+            "subscription_product__product__recurring_product"
+        ).prefetch_related("subscription_product__modifier_set")
+
+
 @reversion.register()
 class SubscriptionCycleProduct(HandleRefModel):
 
@@ -1120,6 +1372,8 @@ class SubscriptionCycleProduct(HandleRefModel):
         help_text=_("Usage attributed to subscription_cycle for this product"),
     )
 
+    objects = SubscriptionCycleProductQuerySet.as_manager()
+
     class Meta:
         db_table = "billing_subscription_cycle_product"
         verbose_name = _("Subscription Cycle Product")
@@ -1159,6 +1413,106 @@ class SubscriptionCycleProduct(HandleRefModel):
         return f"{self.subscription_product}"
 
 
+class UsageSampleQuerySet(models.QuerySet):
+    def latest_per_product(self):
+        """
+        Returns the latest sample of each subscription product in each
+        subscription cycle, which is the usage billed for the cycle
+        """
+
+        latest = (
+            UsageSample.objects.filter(
+                subscription_cycle_id=models.OuterRef("subscription_cycle_id"),
+                subscription_product_id=models.OuterRef("subscription_product_id"),
+            )
+            .order_by("-timestamp", "-id")
+            .values("id")[:1]
+        )
+
+        return self.filter(id=models.Subquery(latest))
+
+    def downsample(self, bucket="day"):
+        """
+        Returns the highest usage of each subscription product per `bucket`
+        (`hour` or `day`) as dicts with `subscription_product_id`,
+        `timestamp` and `units`
+        """
+
+        return (
+            self.annotate(bucket=Trunc("timestamp", bucket))
+            .order_by()
+            .values("subscription_product_id", "bucket")
+            .annotate(units=models.Max("units"))
+            .order_by("subscription_product_id", "bucket")
+        )
+
+
+class UsageSample(models.Model):
+    """
+    Metered usage of a subscription product pushed by a service
+
+    Samples are append-only and stored in the subscription cycle they were
+    taken in. Billing uses the latest sample of a cycle (see
+    `UsageSampleQuerySet.latest_per_product`) instead of requesting the usage from the
+    service.
+
+    Unlike most models this does not extend `HandleRefModel`, the table
+    is kept narrow as it holds a row per sample.
+    """
+
+    id = models.BigAutoField(primary_key=True)
+
+    subscription_cycle = models.ForeignKey(
+        SubscriptionCycle,
+        on_delete=models.CASCADE,
+        related_name="usage_sample_set",
+    )
+    subscription_product = models.ForeignKey(
+        SubscriptionProduct,
+        on_delete=models.CASCADE,
+        related_name="usage_sample_set",
+    )
+    timestamp = models.DateTimeField()
+    units = models.PositiveIntegerField()
+
+    objects = UsageSampleQuerySet.as_manager()
+
+    class Meta:
+        db_table = "billing_usage_sample"
+        verbose_name = _("Usage Sample")
+        verbose_name_plural = _("Usage Samples")
+        indexes = [
+            models.Index(
+                fields=["subscription_cycle", "subscription_product", "timestamp"]
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.subscription_product} {self.timestamp}: {self.units}"
+
+
+def apply_price_modifier(modifier_type, value, price, unit_price=0):
+    """
+    Applies a subscription product modifier of `modifier_type` with `value`
+    to a given price and returns the modified price
+
+    Shared by `SubscriptionProductModifier.apply` and billing forecasts
+    (see `billing.forecast`)
+    """
+
+    if modifier_type == "free":
+        return 0
+
+    if modifier_type == "quantity":
+        price -= float(unit_price * value)
+    elif modifier_type == "reduction":
+        price -= value
+    elif modifier_type == "reduction_p":
+        price -= price * (value / 100.0)
+
+    return max(price, 0)
+
+
 @reversion.register()
 class SubscriptionProductModifier(HandleRefModel):
 
@@ -1195,17 +1549,96 @@ class SubscriptionProductModifier(HandleRefModel):
         applies modifier to a given price and returns the modified
         price
         """
-        if self.type == "free":
-            return 0
+        return apply_price_modifier(self.type, self.value, price, unit_price)
+
+
+class BillingRun(HandleRefModel):
+    """
+    Describes a run of the `billing_cycles` command
+
+    Progress is checkpointed per subscription (BillingRunSubscription) so an
+    interrupted run can be resumed.
+    """
+
+    status = models.CharField(
+        max_length=32,
+        choices=(
+            ("running", _("Running")),
+            ("completed", _("Completed")),
+            ("failed", _("Failed")),
+        ),
+        default="running",
+    )
+
+    options = models.JSONField(
+        default=dict, blank=True, help_text=_("Command options of the run")
+    )
+
+    phases = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text=_("Duration (seconds) of each phase of the run"),
+    )
+
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class HandleRef:
+        tag = "billing_run"
+
+    class Meta:
+        db_table = "billing_run"
+        verbose_name = _("Billing Run")
+        verbose_name_plural = _("Billing Runs")
+
+    def __str__(self):
+        return f"Billing run {self.id} ({self.status})"
+
+    def add_phase_duration(self, phase, duration):
+        self.phases[phase] = self.phases.get(phase, 0) + duration
+
+    def checkpoint(self, subscription, status="completed"):
+        """
+        Records that the subscription was processed in this run
+        """
+
+        BillingRunSubscription.objects.update_or_create(
+            run=self, subscription=subscription, defaults={"status": status}
+        )
+
+    def finish(self, status="completed"):
+        self.status = status
+        self.finished = timezone.now()
+        self.save()
+
+
+class BillingRunSubscription(HandleRefModel):
+    """
+    Describes the progress of a subscription in a billing run
+    """
+
+    run = models.ForeignKey(
+        BillingRun, on_delete=models.CASCADE, related_name="subscription_set"
+    )
+    subscription = models.ForeignKey(
+        Subscription, on_delete=models.CASCADE, related_name="billing_run_set"
+    )
+    status = models.CharField(
+        max_length=32,
+        choices=(
+            ("completed", _("Completed")),
+            ("error", _("Critical error (Manually review)")),
+        ),
+        default="completed",
+    )
 
-        if self.type == "quantity":
-            price -= float(unit_price * self.value)
-        elif self.type == "reduction":
-            price -= self.value
-        elif self.type == "reduction_p":
-            price -= price * (self.value / 100.0)
+    class HandleRef:
+        tag = "billing_run_subscription"
 
-        return max(price, 0)
+    class Meta:
+        db_table = "billing_run_subscription"
+        verbose_name = _("Billing Run Subscription")
+        verbose_name_plural = _("Billing Run Subscriptions")
+        unique_together = (("run", "subscription"),)
 
 
 @reversion.register()
@@ -1352,27 +1785,197 @@ class OrganizationProductHistory(HandleRefModel):
         verbose_name_plural = _("Organization Product Access History")
 
 
-def unique_id(Model, field, prefix=""):
-    i = 0
-    while i < 1000:
-        unique_id = f"{secrets.token_urlsafe(10)}"
+class OrganizationEntitlement(HandleRefModel):
 
-        if not Model.objects.filter(**{field: f"{prefix}{unique_id}"}).exists():
-            return unique_id
-        i += 1
-    raise OSError(f"Could not generate a unique {Model} id")
+    """
+    Version of the products an organization is entitled to
+
+    `version` is bumped whenever an organization product is saved or
+    deleted, or a product the organization has is changed, so services
+    can cache the entitlement snapshot and revalidate it by version
+    alone.
+    """
+
+    org = models.OneToOneField(
+        account.models.Organization,
+        on_delete=models.CASCADE,
+        related_name="entitlement",
+    )
+
+    class HandleRef:
+        tag = "org_entitlement"
+
+    class Meta:
+        db_table = "billing_org_entitlement"
+        verbose_name = _("Organization Entitlement")
+        verbose_name_plural = _("Organization Entitlements")
+
+    def __str__(self):
+        return f"{self.org} entitlement v{self.version}"
+
+    @classmethod
+    def bump(cls, org_ids):
+        """
+        Increments the version of the organizations in `org_ids`
+
+        Organizations without an entry are skipped, their entry is created
+        with the first snapshot, so there is no cached snapshot to
+        invalidate for them yet.
+        """
+
+        cls.objects.filter(org_id__in=org_ids).update(
+            version=models.F("version") + 1, updated=timezone.now()
+        )
+
+    @classmethod
+    def current_version(cls, org):
+        entitlement, created = cls.objects.get_or_create(org=org)
+        return entitlement.version
+
+    @classmethod
+    def etag(cls, org, version):
+        return f'"{org.id}-{version}"'
+
+    @classmethod
+    def snapshot(cls, org, version=None):
+        """
+        Returns the products `org` is entitled to at `version`
+
+        The version is read before the products, if a product changes in
+        between the next revalidation will pick it up.
+        """
+
+        if version is None:
+            version = cls.current_version(org)
+
+        products = [
+            {
+                "name": name,
+                "component": component.lower() if component else None,
+                "component_object_id": component_object_id,
+                "expires": expires,
+                "data": data,
+            }
+            for name, component, component_object_id, expires, data in (
+                OrganizationProduct.objects.filter(org=org, status="ok")
+                .order_by("id")
+                .values_list(
+                    "product__name",
+                    "product__component__name",
+                    "component_object_id",
+                    "expires",
+                    "product__data",
+                )
+            )
+        ]
+
+        return {"org": org.slug, "version": version, "products": products}
+
+
+class ProductEligibility:
+    """
+    Answers whether products can be added to an organization, for any
+    number of products with two queries
+
+    Arguments:
+
+    - org (`Organization`)
+    - products (`list`): `Product` instances that will be checked
+
+    A product cannot be added if
+
+    - it requires a component object id and none is supplied or the other
+      way around
+    - the org already has the product for the component object
+    - it is the trial of a product the org already has for the component
+      object
+    - the org had the product for the component object before and it is
+      not renewable (yet)
+    """
+
+    def __init__(self, org, products):
+        self.org = org
+        self.products = {product.id: product for product in products}
+
+        # (product id, component object id) the org has, a trial product
+        # counts as owned if the org has the product it is a trial of
+        self.owned = set()
+
+        for product_id, trial_product_id, component_object_id in (
+            OrganizationProduct.objects.filter(org=org)
+            .filter(
+                models.Q(product_id__in=self.products)
+                | models.Q(product__trial_product_id__in=self.products)
+            )
+            .values_list(
+                "product_id", "product__trial_product_id", "component_object_id"
+            )
+        ):
+            self.owned.add((product_id, component_object_id))
+            if trial_product_id:
+                self.owned.add((trial_product_id, component_object_id))
+
+        # (product id, component object id) -> when the org last had it
+        self.last_owned = {
+            (entry["product_id"], entry["component_object_id"]): entry["last"]
+            for entry in OrganizationProductHistory.objects.filter(
+                org=org, product_id__in=self.products
+            )
+            .order_by()
+            .values("product_id", "component_object_id")
+            .annotate(last=models.Max("created"))
+        }
+
+    def can_add(self, product, component_object_id=None):
+        """
+        Checks whether or not `product` can be added to the org
+
+        `product` needs to be one of the products the eligibility was
+        created for.
+        """
+
+        product = self.products[product.id]
+
+        # ids may come in as strings from request data
+        component_object_id = int(component_object_id) if component_object_id else None
+
+        if product.component_billable_entity and not component_object_id:
+            # product requires a component_object_id but none was supplied
+            return False
+
+        if not product.component_billable_entity and component_object_id:
+            # product does not require a component_object_id but one was supplied
+            return False
+
+        if (product.id, component_object_id) in self.owned:
+            return False
+
+        last_owned = self.last_owned.get((product.id, component_object_id))
+
+        if not last_owned:
+            return True
+
+        if product.renewable == 0:
+            return True
+
+        if product.renewable == -1:
+            return False
+
+        tdiff = (timezone.now() - last_owned).total_seconds() / 86400
+
+        return tdiff > product.renewable
 
 
 def unique_order_history_id():
-    return unique_id(OrderHistory, "order_id")
+    return order_history_ids()
 
 
 def unique_order_id():
-    return unique_id(Order, "order_number")
+    return order_numbers()
 
 
 def unique_invoice_id():
-    return unique_id(Invoice, "invoice_number")
+    return invoice_numbers()
 
 
 @reversion.register()
@@ -1462,6 +2065,9 @@ class OrderHistory(HandleRefModel):
             return "-"
 
 
+order_history_ids = TokenAllocator(OrderHistory, "order_id", nbytes=10)
+
+
 @reversion.register()
 class OrderHistoryItem(HandleRefModel):
     order = models.ForeignKey(
@@ -1638,6 +2244,81 @@ class PaymentMethod(HandleRefModel):
         return self.name
 
 
+def amount_total(queryset, group_by):
+    """
+    Returns a subquery summing up the `amount` of the transactions in
+    `queryset` grouped by `group_by`, 0.00 if there are none
+
+    The sum is computed by the database on the decimal column, so it is
+    exact (unlike summing up floats in python).
+    """
+
+    total = (
+        queryset.order_by()
+        .values(group_by)
+        .annotate(total=models.Sum("amount"))
+        .values("total")
+    )
+    return Coalesce(
+        models.Subquery(total),
+        models.Value(decimal.Decimal("0.00")),
+        output_field=models.DecimalField(max_digits=14, decimal_places=2),
+    )
+
+
+class PaymentChargeQuerySet(models.QuerySet):
+    def references(self):
+        """
+        Resolves the invoice number, order number and subscription cycle
+        of the payment charges with the charges query, rather than with
+        several queries per charge (see `PaymentCharge.invoice_number`,
+        `PaymentCharge.order_number` and `PaymentCharge.details`)
+        """
+
+        # a charge without an invoice of its own is invoiced through the
+        # first product of its subscription cycle
+        cycle_product = (
+            SubscriptionCycleProduct.objects.filter(
+                subscription_cycle__subscription_cycle_charge_set__payment_charge=models.OuterRef(
+                    models.OuterRef("pk")
+                )
+            )
+            .order_by("id")
+            .values("id")[:1]
+        )
+
+        return (
+            self.annotate(
+                annotated_invoice_number=Coalesce(
+                    models.Subquery(
+                        Invoice.objects.filter(
+                            charge_object=models.OuterRef("pk")
+                        ).values("invoice_number")[:1]
+                    ),
+                    models.Subquery(
+                        InvoiceLine.objects.filter(
+                            subscription_cycle_product=models.Subquery(cycle_product)
+                        )
+                        .order_by("id")
+                        .values("invoice__invoice_number")[:1]
+                    ),
+                )
+            )
+            .annotate(
+                annotated_order_number=models.Subquery(
+                    InvoiceLine.objects.filter(
+                        invoice__invoice_number=models.OuterRef(
+                            "annotated_invoice_number"
+                        )
+                    )
+                    .order_by("id")
+                    .values("invoice__order__order_number")[:1]
+                )
+            )
+            .select_related("subscription_cycle_charge__subscription_cycle")
+        )
+
+
 @reversion.register()
 class PaymentCharge(HandleRefModel):
     payment_method = models.ForeignKey(
@@ -1670,6 +2351,8 @@ class PaymentCharge(HandleRefModel):
         default="pending",
     )
 
+    objects = PaymentChargeQuerySet.as_manager()
+
     class Meta:
         db_table = "billing_charge"
         verbose_name = _("Payment Charge")
@@ -1687,9 +2370,11 @@ class PaymentCharge(HandleRefModel):
 
         details = [self.description, ""]
 
-        if self.subscription_cycle_charge:
+        try:
             cycle = self.subscription_cycle_charge.subscription_cycle
             details += [f"Period {cycle.start} - {cycle.end}", ""]
+        except SubscriptionCycleCharge.DoesNotExist:
+            pass
 
         for invoice_line in self.invoice_lines:
             details.append(
@@ -1704,16 +2389,25 @@ class PaymentCharge(HandleRefModel):
 
     @property
     def invoice_number(self):
+        # resolved by `PaymentCharge.objects.references()`
+        if hasattr(self, "annotated_invoice_number"):
+            return self.annotated_invoice_number
+
         try:
             return self.invoice.invoice_number
         except Invoice.DoesNotExist:
             pass
 
-        if self.subscription_cycle_charge:
+        try:
             return self.subscription_cycle_charge.invoice_number
+        except SubscriptionCycleCharge.DoesNotExist:
+            return None
 
     @property
     def order_number(self):
+        if hasattr(self, "annotated_order_number"):
+            return self.annotated_order_number
+
         try:
             return (
                 InvoiceLine.objects.filter(invoice__invoice_number=self.invoice_number)
@@ -1752,16 +2446,21 @@ class PaymentCharge(HandleRefModel):
         OrderHistory.create_from_payment_charge(self)
 
     @reversion.create_revision()
-    def sync_status(self, commit=True):
+    def sync_status(self, commit=True, **kwargs):
         if self.status == "pending":
             if commit:
-                self.payment_method.processor_instance.sync_charge(self)
+                self.payment_method.processor_instance.sync_charge(self, **kwargs)
             if self.status == "ok":
                 self.capture()
 
         if self.status == "ok":
             self.create_payment_transaction()
 
+        try:
+            self.subscription_cycle_charge.subscription_cycle.subscription.update_next_action()
+        except SubscriptionCycleCharge.DoesNotExist:
+            pass
+
         return self.status
 
     @reversion.create_revision()
@@ -1833,6 +2532,20 @@ class PaymentCharge(HandleRefModel):
         self.save()
 
 
+class OrderQuerySet(models.QuerySet):
+    def totals(self):
+        """
+        Sums up the order lines of the orders with the orders query,
+        rather than with a query per order (see `Order.price`)
+        """
+
+        return self.annotate(
+            annotated_price=amount_total(
+                OrderLine.objects.filter(order=models.OuterRef("pk")), "order"
+            )
+        )
+
+
 @reversion.register
 class Order(HandleRefModel):
 
@@ -1847,7 +2560,11 @@ class Order(HandleRefModel):
         null=True,
     )
 
-    order_number = models.CharField(max_length=255, default=unique_order_id)
+    order_number = models.CharField(
+        max_length=255, default=unique_order_id, unique=True
+    )
+
+    objects = OrderQuerySet.as_manager()
 
     class HandleRef:
         tag = "order"
@@ -1862,9 +2579,13 @@ class Order(HandleRefModel):
 
     @property
     def price(self):
-        price = 0
+        # summed up by `Order.objects.totals()`
+        if hasattr(self, "annotated_price"):
+            return self.annotated_price
+
+        price = decimal.Decimal("0.00")
         for order_line in self.order_line_set.all():
-            price += order_line.price
+            price += order_line.amount
         return price
 
     @property
@@ -1913,6 +2634,32 @@ class Order(HandleRefModel):
         )
 
 
+order_numbers = TokenAllocator(Order, "order_number", nbytes=10)
+
+
+class InvoiceQuerySet(models.QuerySet):
+    def totals(self):
+        """
+        Resolves the price, currency and payment date of the invoices with
+        the invoices query, rather than with a query each per invoice (see
+        `Invoice.price`, `Invoice.currency` and `Invoice.paid`)
+        """
+
+        invoice_lines = InvoiceLine.objects.filter(invoice=models.OuterRef("pk"))
+
+        return self.annotate(
+            annotated_price=amount_total(invoice_lines, "invoice"),
+            annotated_currency=models.Subquery(
+                invoice_lines.order_by("id").values("currency")[:1]
+            ),
+            annotated_paid=models.Subquery(
+                Payment.objects.filter(invoice_number=models.OuterRef("invoice_number"))
+                .order_by("id")
+                .values("created")[:1]
+            ),
+        )
+
+
 @reversion.register
 class Invoice(HandleRefModel):
 
@@ -1941,7 +2688,9 @@ class Invoice(HandleRefModel):
         related_name="invoice",
     )
 
-    invoice_number = models.CharField(max_length=255, default=unique_invoice_id)
+    invoice_number = models.CharField(
+        max_length=255, default=unique_invoice_id, unique=True
+    )
 
     data = models.JSONField(default=dict, blank=True, help_text=_("Any extra data"))
 
@@ -1955,6 +2704,8 @@ class Invoice(HandleRefModel):
         default="pending",
     )
 
+    objects = InvoiceQuerySet.as_manager()
+
     class HandleRef:
         tag = "invoice"
 
@@ -1975,13 +2726,20 @@ class Invoice(HandleRefModel):
 
     @property
     def price(self):
-        price = 0
+        # summed up by `Invoice.objects.totals()`
+        if hasattr(self, "annotated_price"):
+            return self.annotated_price
+
+        price = decimal.Decimal("0.00")
         for invoice_line in self.invoice_line_set.all():
-            price += invoice_line.price
+            price += invoice_line.amount
         return price
 
     @property
     def currency(self):
+        if hasattr(self, "annotated_currency"):
+            return self.annotated_currency or "USD"
+
         try:
             return self.invoice_line_set.first().currency
         except AttributeError:
@@ -1993,6 +2751,9 @@ class Invoice(HandleRefModel):
         Date this invoice was paid
         """
 
+        if hasattr(self, "annotated_paid"):
+            return self.annotated_paid
+
         try:
             return (
                 Payment.objects.filter(invoice_number=self.invoice_number)
@@ -2070,13 +2831,13 @@ class Invoice(HandleRefModel):
         self.save()
 
     @reversion.create_revision()
-    def sync_status(self, commit=True):
+    def sync_status(self, commit=True, **kwargs):
         if self.status == "pending":
             # invoice is still open
 
             if commit:
                 # sync invoice status from stripe
-                self.payment_method.processor_instance.sync_invoice(self)
+                self.payment_method.processor_instance.sync_invoice(self, **kwargs)
 
             if self.status == "ok":
                 # invoice has been paid, capture the payment
@@ -2091,6 +2852,9 @@ class Invoice(HandleRefModel):
         return self.status
 
 
+invoice_numbers = TokenAllocator(Invoice, "invoice_number", nbytes=10)
+
+
 class Transaction(HandleRefModel):
     # Should this be auto_now_add ? Or is default=now better.
     created = models.DateTimeField(
@@ -2105,6 +2869,12 @@ class Transaction(HandleRefModel):
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        # the ledger entry and account summary are updated by the
+        # `post_save` signal, within the same database transaction
+        with transaction.atomic(savepoint=False):
+            super().save(*args, **kwargs)
+
 
 class MoneyTransaction(Transaction):
     billing_contact = models.ForeignKey(
@@ -2318,3 +3088,309 @@ class Ledger(HandleRefModel):
         db_table = "billing_ledgers"
         verbose_name = _("Ledger")
         verbose_name_plural = _("Ledger")
+
+    @classmethod
+    def entry(cls, txn):
+        """
+        Returns an unsaved ledger entry for a transaction object
+        """
+
+        return cls(
+            content_object=txn,
+            invoice_number=getattr(txn, "invoice_number", None),
+            order_number=getattr(txn, "order_number", None),
+            org=txn.org,
+        )
+
+
+class AccountSummary(HandleRefModel):
+    """
+    Running totals of an organization's transactions in a currency
+
+    Updated along with each new transaction (see `apply`), so balances
+    and totals can be read without walking the ledger. Summaries can be
+    rebuilt from the ledger with the `billing_account_summary` command.
+    """
+
+    org = models.ForeignKey(
+        account.models.Organization,
+        on_delete=models.CASCADE,
+        related_name="account_summary_set",
+    )
+    currency = models.CharField(
+        max_length=255, choices=const.CURRENCY_TYPES, default="USD"
+    )
+
+    ordered = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    invoiced = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    paid = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    deposited = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    withdrawn = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    balance = models.DecimalField(
+        max_digits=14,
+        decimal_places=2,
+        default=0,
+        help_text=_(
+            "Payments and deposits minus invoiced amounts and withdrawals, negative if money is owed"
+        ),
+    )
+
+    transactions = models.PositiveIntegerField(default=0)
+    last_payment = models.DateTimeField(null=True, blank=True)
+
+    # first key of the two-part postgres advisory locks guarding summaries
+    # (second key is the org id, 0 for the summaries of all organizations)
+    lock_namespace = 0x73756D6D
+
+    # transaction model name -> (total field, sign in the balance)
+    totals = {
+        "orderline": ("ordered", 0),
+        "invoiceline": ("invoiced", -1),
+        "payment": ("paid", 1),
+        "deposit": ("deposited", 1),
+        "withdrawal": ("withdrawn", -1),
+    }
+
+    class HandleRef:
+        tag = "account_summary"
+
+    class Meta:
+        db_table = "billing_account_summary"
+        verbose_name = _("Account Summary")
+        verbose_name_plural = _("Account Summaries")
+        unique_together = (("org", "currency"),)
+
+    def __str__(self):
+        return f"{self.org} {self.currency}"
+
+    @property
+    def outstanding(self):
+        """
+        Amount owed by the organization
+        """
+        return max(-self.balance, 0)
+
+    @classmethod
+    def lock(cls, org_ids, shared=True):
+        """
+        Takes transaction level advisory locks on the summaries of the
+        organizations, 0 locking the summaries of all organizations
+
+        Transactions are applied under shared locks that include 0, so
+        rebuilds can lock an organization or all of them exclusively.
+
+        No-op on database backends that do not support advisory locks
+        """
+
+        if connection.vendor != "postgresql":
+            return
+
+        fn = "pg_advisory_xact_lock_shared" if shared else "pg_advisory_xact_lock"
+
+        # locks are taken in order in a single query
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {fn}(%s, key) FROM unnest(%s::int[]) AS key ORDER BY key",
+                [cls.lock_namespace, sorted(org_ids)],
+            )
+
+    @classmethod
+    def apply(cls, transactions):
+        """
+        Adds newly created transactions to the summaries of their
+        organizations
+
+        Totals are incremented in the database, so concurrent updates to
+        the same summary do not overwrite each other.
+        """
+
+        changes = {}
+
+        for txn in transactions:
+            field, sign = cls.totals[txn._meta.model_name]
+            org = txn.org
+
+            if not org:
+                continue
+
+            amount = txn._meta.get_field("amount").to_python(txn.amount)
+            amount = amount.quantize(decimal.Decimal("0.01"))
+
+            change = changes.setdefault(
+                (org.id, txn.currency),
+                {"totals": {}, "balance": 0, "transactions": 0, "last_payment": None},
+            )
+            change["totals"][field] = change["totals"].get(field, 0) + amount
+            change["balance"] += sign * amount
+            change["transactions"] += 1
+
+            if field == "paid" and (
+                not change["last_payment"] or change["last_payment"] < txn.created
+            ):
+                change["last_payment"] = txn.created
+
+        if not changes:
+            return
+
+        with transaction.atomic(savepoint=False):
+            cls.lock({0} | {org_id for org_id, currency in changes})
+
+            for (org_id, currency), change in changes.items():
+                cls.apply_change(org_id, currency, change)
+
+    @classmethod
+    def apply_change(cls, org_id, currency, change):
+        """
+        Increments the totals of a summary in a single update, the summary
+        is created if it does not exist yet
+        """
+
+        update = {
+            "balance": models.F("balance") + change["balance"],
+            "transactions": models.F("transactions") + change["transactions"],
+        }
+        update.update(
+            {
+                field: models.F(field) + amount
+                for field, amount in change["totals"].items()
+            }
+        )
+
+        last_payment = change["last_payment"]
+        if last_payment:
+            update["last_payment"] = models.Case(
+                models.When(
+                    models.Q(last_payment__isnull=True)
+                    | models.Q(last_payment__lt=last_payment),
+                    then=models.Value(last_payment),
+                ),
+                default=models.F("last_payment"),
+            )
+
+        qset = cls.objects.filter(org_id=org_id, currency=currency)
+
+        if qset.update(**update):
+            return
+
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    org_id=org_id,
+                    currency=currency,
+                    balance=change["balance"],
+                    transactions=change["transactions"],
+                    last_payment=last_payment,
+                    **change["totals"],
+                )
+        except IntegrityError:
+            # created concurrently
+            qset.update(**update)
+
+    @classmethod
+    def compute(cls, org=None):
+        """
+        Computes the summaries from the transactions in the ledger,
+        with one aggregate query per transaction type
+
+        Returns a dict of unsaved summaries keyed by (org id, currency)
+        """
+
+        sources = [
+            (OrderLine, "order__org"),
+            (InvoiceLine, "invoice__org"),
+            (Payment, "org"),
+            (Deposit, "org"),
+            (Withdrawal, "org"),
+        ]
+
+        summaries = {}
+
+        for Model, org_field in sources:
+            field, sign = cls.totals[Model._meta.model_name]
+
+            qset = Model.objects.filter(
+                id__in=Ledger.objects.filter(
+                    content_type=ContentType.objects.get_for_model(Model)
+                ).values("object_id")
+            )
+
+            if org:
+                qset = qset.filter(**{org_field: org})
+
+            for org_id, currency, total, count, last in (
+                qset.order_by()
+                .values(org_field, "currency")
+                .annotate(
+                    total=models.Sum("amount"),
+                    count=models.Count("id"),
+                    last=models.Max("created"),
+                )
+                .values_list(org_field, "currency", "total", "count", "last")
+            ):
+                if not org_id:
+                    continue
+
+                summary = summaries.setdefault(
+                    (org_id, currency), cls(org_id=org_id, currency=currency)
+                )
+                setattr(summary, field, total)
+                summary.balance += sign * total
+                summary.transactions += count
+
+                if field == "paid":
+                    summary.last_payment = last
+
+        return summaries
+
+    @classmethod
+    def rebuild(cls, org=None):
+        """
+        Replaces the summaries (of `org` or all organizations) with
+        summaries computed from the ledger
+
+        The summaries are locked (see `lock`) before the ledger is read,
+        so transactions applied concurrently are either part of the
+        computed summaries or applied to them once the rebuild is committed,
+        including transactions that create a summary.
+
+        Returns the new summaries
+        """
+
+        with transaction.atomic():
+            # waits for transactions being applied
+            cls.lock([org.id if org else 0], shared=False)
+
+            qset = cls.objects.all()
+            if org:
+                qset = qset.filter(org=org)
+
+            summaries = list(cls.compute(org).values())
+
+            qset.delete()
+            cls.objects.bulk_create(summaries)
+
+        return summaries
+
+
+def bulk_create_transactions(Model, transactions):
+    """
+    Creates transaction objects (e.g., order or invoice lines) and their
+    ledger entries in bulk.
+
+    The same as saving the objects one by one (ledger entries and account
+    summaries are normally updated by the `post_save` signal), but in a
+    fixed number of queries.
+    Objects are added to the active revision (if any).
+    """
+
+    with transaction.atomic():
+        Model.objects.bulk_create(transactions)
+        Ledger.objects.bulk_create([Ledger.entry(txn) for txn in transactions])
+        AccountSummary.apply(transactions)
+
+    if reversion.is_active():
+        for txn in transactions:
+            reversion.add_to_revision(txn)
+
+    return transactions
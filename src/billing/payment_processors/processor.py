@@ -82,12 +82,12 @@ class PaymentProcessor:
         self.billing_contact_customer.save()
 
     @reversion.create_revision()
-    def sync_charge(self, payment_charge):
+    def sync_charge(self, payment_charge, **kwargs):
         if payment_charge.status == "pending":
-            return self._sync_charge(payment_charge)
+            return self._sync_charge(payment_charge, **kwargs)
         return payment_charge.status
 
-    def _sync_charge(self, payment_charge, status=None):
+    def _sync_charge(self, payment_charge, status=None, **kwargs):
         if status:
             payment_charge.status = status
             payment_charge.save()
@@ -101,12 +101,12 @@ class PaymentProcessor:
         return status
 
     @reversion.create_revision()
-    def sync_invoice(self, invoice):
+    def sync_invoice(self, invoice, **kwargs):
         if invoice.status == "pending":
-            return self._sync_invoice(invoice)
+            return self._sync_invoice(invoice, **kwargs)
         return invoice.status
 
-    def _sync_invoice(self, invoice, status=None):
+    def _sync_invoice(self, invoice, status=None, **kwargs):
         if status:
             invoice.status = status
             invoice.save()
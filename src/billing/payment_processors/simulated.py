@@ -0,0 +1,326 @@
+"""
+Simulated payment processor
+
+Charges and invoices are kept in an in-memory ledger instead of a remote
+service, with configurable latency, decline rate, rate limiting and the
+number of status syncs a charge stays pending before it settles.
+
+Remote objects are shaped like their stripe counterparts (payment intents
+and invoices) so `Invoice.capture` can process invoices paid through the
+simulation unchanged.
+
+Enable it with the `BILLING_SIMULATED_PROCESSOR` setting, or add it to
+`billing.payment_processors.PROCESSORS` at runtime (see `billing.workload`).
+It never moves money, do not enable it in production.
+"""
+
+import random
+import threading
+import time
+
+import reversion
+from django.utils.translation import gettext as _
+
+from billing.payment_processors.processor import PaymentProcessor, register
+
+
+class SimulatedRateLimitError(Exception):
+    """
+    Simulated counterpart of a stripe rate limit error
+
+    Not an `InternalProcessorError`, which would abort billing runs.
+    Rate limited charges fail, rate limited status syncs leave their
+    charge or invoice pending for the next sync.
+    """
+
+    def __init__(self, operation):
+        super().__init__(f"Simulated rate limit exceeded ({operation})")
+
+
+class SimulatedLedger:
+    """
+    In-memory state of the simulated remote processor
+
+    Records every request made to it along with the payment intents and
+    invoices it holds.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = []
+        self.payment_intents = {}
+        self.invoices = {}
+        self.rate_limited = 0
+        self.declined = 0
+
+    def next_id(self, prefix, objects):
+        return f"sim_{prefix}_{len(objects) + 1}"
+
+    def requests_for(self, operation):
+        """
+        Returns the number of requests made for `operation`
+        """
+        return len([r for r in self.requests if r[0] == operation])
+
+
+@register
+class Simulated(PaymentProcessor):
+    """
+    Payment processor answering from an in-memory ledger
+
+    Configure it through `Simulated.configure`, which also resets the
+    ledger. Configuration and ledger are shared by all instances, as a
+    new processor instance is created for every payment method access.
+    """
+
+    id = "simulated"
+    name = _("Simulated")
+
+    # seconds each request to the simulated processor takes
+    latency = 0
+
+    # share of charges and invoices that are declined
+    failure_rate = 0
+
+    # number of status syncs a charge or invoice stays pending before
+    # it settles, 0 settles on the first sync
+    settle_after = 0
+
+    # share of requests answered with a rate limit error
+    rate_limit_rate = 0
+
+    rnd = random.Random()
+    ledger = SimulatedLedger()
+
+    @classmethod
+    def configure(
+        cls,
+        latency=0,
+        failure_rate=0,
+        settle_after=0,
+        rate_limit_rate=0,
+        seed=None,
+    ):
+        """
+        Sets the simulation parameters and resets the ledger
+
+        Returns the new `SimulatedLedger`
+        """
+
+        cls.latency = latency
+        cls.failure_rate = failure_rate
+        cls.settle_after = settle_after
+        cls.rate_limit_rate = rate_limit_rate
+        cls.rnd = random.Random(seed)
+        cls.ledger = SimulatedLedger()
+        return cls.ledger
+
+    @property
+    def source(self):
+        # stored under the stripe key so `Invoice.capture` can match the
+        # payment method of a paid invoice
+        return self.data.get("stripe_payment_method")
+
+    def request(self, operation, object_id=None):
+        """
+        Records a request to the simulated processor, waits for `latency`
+        and raises `SimulatedRateLimitError` for `rate_limit_rate` of them
+        """
+
+        ledger = self.ledger
+
+        with ledger.lock:
+            ledger.requests.append((operation, object_id))
+            rate_limited = self.rnd.random() < self.rate_limit_rate
+            if rate_limited:
+                ledger.rate_limited += 1
+
+        time.sleep(self.latency)
+
+        if rate_limited:
+            raise SimulatedRateLimitError(operation)
+
+    def declined(self):
+        with self.ledger.lock:
+            declined = self.rnd.random() < self.failure_rate
+            if declined:
+                self.ledger.declined += 1
+        return declined
+
+    def settle(self, remote_object):
+        """
+        Counts down the pending syncs of a payment intent or invoice and
+        settles it once they are exhausted
+        """
+
+        with self.ledger.lock:
+            if remote_object.get("pending_syncs", 0) > 0:
+                remote_object["pending_syncs"] -= 1
+            elif "settles_to" in remote_object:
+                remote_object["status"] = remote_object.pop("settles_to")
+
+        return remote_object
+
+    def create_payment_intent(self, amount, description, status):
+        ledger = self.ledger
+
+        with ledger.lock:
+            payment_intent_id = ledger.next_id("pi", ledger.payment_intents)
+            payment_intent = {
+                "id": payment_intent_id,
+                "amount": amount,
+                "currency": self.default_currency,
+                "description": description,
+                "payment_method": self.source,
+                "receipt_url": f"https://simulated.localhost/receipts/{payment_intent_id}",
+                "status": status,
+            }
+            ledger.payment_intents[payment_intent_id] = payment_intent
+
+        return payment_intent
+
+    @reversion.create_revision()
+    def setup_billing(self, **kwargs):
+        if not self.source:
+            self.data["stripe_payment_method"] = f"sim_pm_{self.payment_method.id}"
+        self.payment_method.status = "ok"
+        self.save()
+
+    @reversion.create_revision()
+    def charge(self, payment_charge):
+        if not self.source:
+            raise ValueError("Payment method not setup.")
+
+        try:
+            self.request("charge", payment_charge.id)
+            declined = self.declined()
+        except SimulatedRateLimitError as e:
+            # same handling as a failed stripe payment intent
+            payment_charge.status = "failed"
+            payment_charge.data["processor_failure"] = str(e)
+            payment_charge.save()
+            return
+
+        payment_intent = self.create_payment_intent(
+            int(payment_charge.price * 100),
+            payment_charge.description,
+            "failed" if declined else "processing",
+        )
+
+        if declined:
+            payment_charge.status = "failed"
+            payment_charge.data["processor_failure"] = "Simulated card declined"
+            payment_charge.save()
+            return
+
+        with self.ledger.lock:
+            payment_intent["pending_syncs"] = self.settle_after
+            payment_intent["settles_to"] = "succeeded"
+
+        payment_charge.status = "pending"
+        payment_charge.data["processor_txn_id"] = payment_intent["id"]
+        payment_charge.save()
+
+    def _sync_charge(self, payment_charge, status=None, **kwargs):
+        """
+        Syncs the payment charge status from its simulated payment intent
+
+        The charge stays pending if the sync is rate limited, it is
+        retried on the next sync
+        """
+
+        reversion.set_comment("Simulated charge status sync")
+
+        payment_intent_id = payment_charge.data.get("processor_txn_id")
+        payment_intent = self.ledger.payment_intents.get(payment_intent_id)
+
+        if not payment_intent:
+            return super()._sync_charge(payment_charge, "failed")
+
+        try:
+            self.request("sync_charge", payment_intent_id)
+        except SimulatedRateLimitError:
+            return super()._sync_charge(payment_charge)
+
+        self.settle(payment_intent)
+
+        if payment_intent["status"] == "succeeded":
+            payment_charge.data["receipt_url"] = payment_intent["receipt_url"]
+            return super()._sync_charge(payment_charge, "ok")
+
+        elif payment_intent["status"] == "failed":
+            return super()._sync_charge(payment_charge, "failed")
+
+    def create_invoice(self, invoice, charge_automatically=False):
+        """
+        Creates a simulated invoice from an aaactl Invoice instance
+        """
+
+        if invoice.data.get("simulated_invoice"):
+            raise ValueError("Simulated invoice already created")
+
+        self.request("create_invoice", invoice.id)
+
+        amount = sum(
+            int(invoice_line.amount * 100)
+            for invoice_line in invoice.invoice_line_set.all()
+        )
+
+        settles_to = "uncollectible" if self.declined() else "paid"
+
+        ledger = self.ledger
+
+        with ledger.lock:
+            simulated_invoice = {
+                "id": ledger.next_id("in", ledger.invoices),
+                "amount": amount,
+                "description": "FullCtl Invoice",
+                "status": "open",
+                "payment_intent": None,
+                "pending_syncs": self.settle_after,
+                "settles_to": settles_to,
+            }
+            ledger.invoices[simulated_invoice["id"]] = simulated_invoice
+
+        invoice.data["simulated_invoice"] = simulated_invoice["id"]
+        invoice.save()
+
+        return simulated_invoice
+
+    def _sync_invoice(self, invoice, status=None, **kwargs):
+        """
+        Syncs the invoice status from its simulated invoice
+
+        The invoice stays pending if the sync is rate limited, it is
+        retried on the next sync
+        """
+
+        reversion.set_comment("Simulated invoice status sync")
+
+        simulated_invoice = self.ledger.invoices.get(
+            invoice.data.get("simulated_invoice")
+        )
+
+        if not simulated_invoice:
+            return super()._sync_invoice(invoice, "failed")
+
+        try:
+            self.request("sync_invoice", simulated_invoice["id"])
+        except SimulatedRateLimitError:
+            return super()._sync_invoice(invoice)
+
+        self.settle(simulated_invoice)
+
+        if simulated_invoice["status"] == "paid":
+            if not simulated_invoice["payment_intent"]:
+                simulated_invoice["payment_intent"] = self.create_payment_intent(
+                    simulated_invoice["amount"],
+                    simulated_invoice["description"],
+                    "succeeded",
+                )
+
+            invoice.data["stripe_payment_intent"] = simulated_invoice["payment_intent"]
+            return super()._sync_invoice(invoice, "ok")
+
+        elif simulated_invoice["status"] == "uncollectible":
+            return super()._sync_invoice(invoice, "failed")
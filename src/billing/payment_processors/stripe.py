@@ -1,7 +1,11 @@
+import datetime
+
 import reversion
 import stripe
+import structlog
 from django import forms
 from django.conf import settings
+from django.utils import timezone
 from django.utils.translation import gettext as _
 
 from billing.payment_processors.processor import (
@@ -171,43 +175,66 @@ class Stripe(PaymentProcessor):
 
         payment_charge.save()
 
-    def _sync_charge(self, payment_charge, status=None):
+    def _sync_charge(self, payment_charge, status=None, payment_intent=None):
+        """
+        Syncs the payment charge status from its stripe payment intent
+
+        If `payment_intent` is passed (e.g., fetched during a
+        `Reconciliation`) it is used instead of retrieving the payment
+        intent from stripe.
+        """
+
         reversion.set_comment("Stripe charge status sync")
 
         if not payment_charge.data.get("stripe_payment_intent"):
             return super()._sync_charge(payment_charge, "failed")
 
-        payment_intent = stripe.PaymentIntent.retrieve(
-            payment_charge.data["stripe_payment_intent"], api_key=self.api_key
-        )
+        if not payment_intent:
+            payment_intent = stripe.PaymentIntent.retrieve(
+                payment_charge.data["stripe_payment_intent"], api_key=self.api_key
+            )
 
         if payment_intent["status"] == "succeeded":
             # set receupt url from latest_charge
-            if payment_intent.get("latest_charge"):
-                payment_charge.data["receipt_url"] = stripe.Charge.retrieve(
-                    payment_intent["latest_charge"]
-                )["receipt_url"]
+            latest_charge = payment_intent.get("latest_charge")
+            if latest_charge:
+                if isinstance(latest_charge, str):
+                    latest_charge = stripe.Charge.retrieve(latest_charge)
+                payment_charge.data["receipt_url"] = latest_charge["receipt_url"]
             return super()._sync_charge(payment_charge, "ok")
 
         elif payment_intent["status"] == "failed":
             return super()._sync_charge(payment_charge, "failed")
 
-    def _sync_invoice(self, invoice, **kwargs):
+    def _sync_invoice(self, invoice, stripe_invoice=None, **kwargs):
+        """
+        Syncs the invoice status from its stripe invoice
+
+        If `stripe_invoice` is passed (e.g., fetched during a
+        `Reconciliation`) it is used instead of retrieving the invoice
+        from stripe.
+        """
+
         reversion.set_comment("Stripe invoice status sync")
 
         if not invoice.data.get("stripe_invoice"):
             return super()._sync_invoice(invoice, "failed")
 
-        stripe_invoice = stripe.Invoice.retrieve(
-            invoice.data["stripe_invoice"], api_key=self.api_key
-        )
+        if not stripe_invoice:
+            stripe_invoice = stripe.Invoice.retrieve(
+                invoice.data["stripe_invoice"], api_key=self.api_key
+            )
 
         if not stripe_invoice["payment_intent"]:
             return
 
-        stripe_payment_intent = stripe.Charge.retrieve(
-            stripe_invoice["payment_intent"], api_key=self.api_key
-        )
+        # charge is expanded on invoices listed during reconciliation
+        stripe_payment_intent = stripe_invoice.get("charge")
+
+        if not stripe_payment_intent or isinstance(stripe_payment_intent, str):
+            stripe_payment_intent = stripe.Charge.retrieve(
+                stripe_invoice["payment_intent"], api_key=self.api_key
+            )
 
         if stripe_invoice["status"] == "paid":
             invoice.data["stripe_payment_intent"] = stripe_payment_intent
@@ -255,3 +282,247 @@ class Stripe(PaymentProcessor):
         invoice.save()
 
         return stripe_invoice
+
+
+class Reconciliation:
+    """
+    Reconciles pending payment charges and open invoices with stripe
+    in batch
+
+    Rather than retrieving every object from stripe on its own, stripe's
+    list endpoints are paged through - filtered by the creation window of
+    the local objects and, if there are only a few of them, by customer -
+    and the results are matched to the local objects in memory.
+
+    Objects that could not be matched, or that are older than `max_age`,
+    are left alone, so they can still be synced individually.
+
+    Statuses are applied per object through `sync_status`, so the usual
+    revisions and side effects of a status change apply.
+    """
+
+    # stripe's maximum page size
+    page_size = 100
+
+    # list per customer if there are at most this many customers,
+    # otherwise list everything created in the window
+    max_customers = 10
+
+    # stripe objects are created after their local counterparts, the
+    # window is extended by this margin to allow for clock drift
+    window_margin = datetime.timedelta(hours=1)
+
+    # objects older than this are not reconciled in batch, so a single
+    # old object does not widen the listed window to the whole history
+    max_age = datetime.timedelta(days=31)
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key or settings.STRIPE_SECRET_KEY
+        self.log = structlog.get_logger("django")
+
+        # number of list requests made
+        self.requests = 0
+
+        # ids of the local objects matched to a stripe object
+        self.reconciled_charges = set()
+        self.reconciled_invoices = set()
+
+        # payment charge id -> stripe payment intent
+        self.payment_intents = {}
+
+    def recent(self, objects):
+        """
+        Returns the objects that were created within `max_age`
+        """
+
+        since = timezone.now() - self.max_age
+        return [obj for obj in objects if obj.created >= since]
+
+    def list(self, resource, ids, customers, created, **params):
+        """
+        Pages through the list endpoint of a stripe resource and returns
+        the objects with the specified `ids` as a dict keyed by id
+
+        Arguments:
+
+        - resource: stripe resource class (e.g., `stripe.PaymentIntent`)
+        - ids (`set`): stripe ids of the objects to find
+        - customers (`set`): stripe customer ids the objects belong to
+        - created (`datetime`): creation date of the oldest local object
+
+        Paging stops as soon as all objects have been found.
+        """
+
+        found = {}
+
+        if not ids:
+            return found
+
+        params.update(
+            limit=self.page_size,
+            created={"gte": int((created - self.window_margin).timestamp())},
+            api_key=self.api_key,
+        )
+
+        if customers and len(customers) <= self.max_customers:
+            filters = [{"customer": customer} for customer in sorted(customers)]
+        else:
+            filters = [{}]
+
+        for customer_filter in filters:
+            page = resource.list(**customer_filter, **params)
+
+            while True:
+                self.requests += 1
+
+                for obj in page["data"]:
+                    if obj["id"] in ids:
+                        found[obj["id"]] = obj
+
+                if len(found) == len(ids) or not page["has_more"]:
+                    break
+
+                page = resource.list(
+                    **customer_filter, **params, starting_after=page["data"][-1]["id"]
+                )
+
+            if len(found) == len(ids):
+                break
+
+        return found
+
+    def load_charges(self, payment_charges):
+        """
+        Loads the stripe payment intents of pending payment charges, so
+        their status can be synced with `sync_charge` without further
+        requests
+
+        `payment_charges` should select the related payment method,
+        billing contact and customer data.
+
+        Returns the number of payment charges a payment intent was found for
+        """
+
+        payment_charges = [
+            payment_charge
+            for payment_charge in self.recent(payment_charges)
+            if payment_charge.data.get("stripe_payment_intent")
+        ]
+
+        if not payment_charges:
+            return 0
+
+        payment_intents = self.list(
+            stripe.PaymentIntent,
+            ids={
+                payment_charge.data["stripe_payment_intent"]
+                for payment_charge in payment_charges
+            },
+            customers={
+                payment_charge.payment_method.processor_instance.customer
+                for payment_charge in payment_charges
+            }
+            - {None},
+            created=min(payment_charge.created for payment_charge in payment_charges),
+            expand=["data.latest_charge"],
+        )
+
+        found = 0
+
+        for payment_charge in payment_charges:
+            payment_intent = payment_intents.get(
+                payment_charge.data["stripe_payment_intent"]
+            )
+
+            if payment_intent:
+                self.payment_intents[payment_charge.id] = payment_intent
+                self.reconciled_charges.add(payment_charge.id)
+                found += 1
+
+        return found
+
+    def sync_charge(self, payment_charge):
+        """
+        Syncs the status of a pending payment charge from the payment
+        intent loaded by `load_charges`
+
+        Returns whether the status changed
+        """
+
+        payment_intent = self.payment_intents.get(payment_charge.id)
+
+        if not payment_intent:
+            return False
+
+        if payment_intent["status"] not in ("succeeded", "failed"):
+            return False
+
+        # succeeded charges are captured
+        payment_charge.sync_status(payment_intent=payment_intent)
+        return True
+
+    def sync_charges(self, payment_charges):
+        """
+        Syncs the status of pending payment charges from their stripe
+        payment intents
+
+        Returns the number of payment charges whose status changed
+        """
+
+        payment_charges = list(payment_charges)
+        self.load_charges(payment_charges)
+
+        return sum(
+            self.sync_charge(payment_charge) for payment_charge in payment_charges
+        )
+
+    def sync_invoices(self, invoices):
+        """
+        Syncs the status of open invoices from their stripe invoices
+
+        Returns the number of invoices whose status changed
+        """
+
+        from billing.models import CustomerData
+
+        invoices = [
+            invoice
+            for invoice in self.recent(invoices)
+            if invoice.data.get("stripe_invoice")
+        ]
+
+        if not invoices:
+            return 0
+
+        customers = CustomerData.objects.filter(
+            billing_contact__org_id__in={invoice.org_id for invoice in invoices}
+        ).values_list("data__stripe_customer", flat=True)
+
+        stripe_invoices = self.list(
+            stripe.Invoice,
+            ids={invoice.data["stripe_invoice"] for invoice in invoices},
+            customers=set(customers) - {None},
+            created=min(invoice.created for invoice in invoices),
+            expand=["data.charge"],
+        )
+
+        changed = 0
+
+        for invoice in invoices:
+            stripe_invoice = stripe_invoices.get(invoice.data["stripe_invoice"])
+
+            if not stripe_invoice:
+                continue
+
+            self.reconciled_invoices.add(invoice.id)
+
+            if not stripe_invoice["payment_intent"]:
+                continue
+
+            if stripe_invoice["status"] in ("paid", "uncollectible"):
+                # paid invoices are captured, each in its own transaction
+                with reversion.create_revision():
+                    invoice.sync_status(stripe_invoice=stripe_invoice)
+                changed += 1
+
+        return changed
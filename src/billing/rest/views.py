@@ -11,6 +11,7 @@ from account.rest.decorators import set_org
 from billing.rest.route import route
 from billing.rest.serializers import Serializers
 from common.rest.decorators import grainy_endpoint
+from common.rest.pagination import KeysetPagination
 
 
 @route
@@ -117,7 +118,7 @@ class Organization(viewsets.ViewSet):
     @set_org
     @grainy_endpoint("billing.{org.id}", explicit=False)
     def services(self, request, pk, org):
-        queryset = models.Subscription.objects.filter(org=org)
+        queryset = models.Subscription.objects.filter(org=org).billing_state()
         serializer = Serializers.subscription(queryset, many=True)
         return Response(serializer.data)
 
@@ -178,23 +179,33 @@ class Organization(viewsets.ViewSet):
     def orders(self, request, pk, org):
         queryset = models.OrderHistory.objects.filter(billing_contact__org=org)
         queryset = queryset.prefetch_related("order_history_item_set").select_related(
-            "billing_contact"
+            "billing_contact", "payment_charge"
         )
-        queryset = queryset.order_by("-processed")
-        serializer = Serializers.order_history(queryset, many=True)
-        return Response(serializer.data)
+        paginator = KeysetPagination("processed")
+        instances = paginator.paginate_queryset(queryset, request)
+        serializer = Serializers.order_history(instances, many=True)
+        return paginator.get_paginated_response(Response(serializer.data))
 
     @action(detail=True, methods=["GET"])
     @set_org
     @grainy_endpoint("billing.{org.id}", explicit=False)
     def open_invoices(self, request, pk, org):
-        queryset = models.Invoice.objects.filter(org=org)
-        queryset = queryset.order_by("-created")[:25]
+        queryset = models.Invoice.objects.filter(org=org).totals()
+        queryset = queryset.filter(annotated_paid__isnull=True)
+
+        paginator = KeysetPagination("created")
 
-        instances = [invoice for invoice in queryset if not invoice.paid]
+        if not paginator.paginated(request):
+            # unpaginated requests only look at the 25 most recent invoices
+            queryset = queryset.filter(
+                id__in=models.Invoice.objects.filter(org=org)
+                .order_by("-created", "-id")[:25]
+                .values("id")
+            )
 
+        instances = paginator.paginate_queryset(queryset, request)
         serializer = Serializers.invoice(instances, many=True)
-        return Response(serializer.data)
+        return paginator.get_paginated_response(Response(serializer.data))
 
 
 @route
@@ -3,13 +3,17 @@ from django.dispatch import receiver
 from fullctl.django import auditlog
 
 from billing.models import (
+    AccountSummary,
     Deposit,
     InvoiceLine,
     Ledger,
     OrderLine,
+    OrganizationEntitlement,
     OrganizationProduct,
     OrganizationProductHistory,
     Payment,
+    Product,
+    SubscriptionCycle,
     SubscriptionProduct,
     Withdrawal,
 )
@@ -26,6 +30,8 @@ def handle_orgproduct_save(sender, **kwargs):
 
     org_product = kwargs.get("instance")
 
+    OrganizationEntitlement.bump([org_product.org_id])
+
     for managed_permission_grant in org_product.product.managed_permissions.all():
         managed_permission_grant.apply(org_product)
 
@@ -46,11 +52,32 @@ def handle_orgproduct_delete(sender, **kwargs):
 
     org_product = kwargs.get("instance")
 
+    OrganizationEntitlement.bump([org_product.org_id])
+
     with auditlog.Context() as log:
         log.set("org", org_product.org)
         log.log("product_removed_from_org", log_object=org_product.product)
 
 
+@receiver(post_save, sender=Product)
+def handle_product_save(sender, **kwargs):
+    """
+    Product data is part of the entitlement snapshot, bump the
+    entitlement version of the organizations that have the product
+    """
+
+    if kwargs.get("created"):
+        return
+
+    product = kwargs.get("instance")
+
+    OrganizationEntitlement.bump(
+        OrganizationProduct.objects.filter(product=product).values_list(
+            "org_id", flat=True
+        )
+    )
+
+
 @receiver(post_save, sender=SubscriptionProduct)
 def handle_subscription_product_save(sender, **kwargs):
     """
@@ -58,11 +85,14 @@ def handle_subscription_product_save(sender, **kwargs):
     the necessary OrganizationProduct instances
     """
 
+    sub_product = kwargs.get("instance")
+
+    # the product may change the subscription's charge type
+    sub_product.subscription.clear_billing_cache()
+
     if not kwargs.get("created"):
         return
 
-    sub_product = kwargs.get("instance")
-
     component_object_id = sub_product.component_object_id
     component_object_name = sub_product.component_object_name
     sub_product.update_expires()
@@ -82,6 +112,10 @@ def handle_subscription_product_save(sender, **kwargs):
             sub_product
         )
 
+    # adding a product may change the subscription's charge type
+
+    sub_product.subscription.update_next_action()
+
 
 @receiver(post_delete, sender=SubscriptionProduct)
 def handle_subscription_product_delete(sender, **kwargs):
@@ -92,6 +126,8 @@ def handle_subscription_product_delete(sender, **kwargs):
 
     sub_product = kwargs.get("instance")
 
+    sub_product.subscription.clear_billing_cache()
+
     qset = OrganizationProduct.objects.filter(
         subscription=sub_product.subscription,
         subscription_product=sub_product,
@@ -101,6 +137,39 @@ def handle_subscription_product_delete(sender, **kwargs):
     for org_product in qset:
         org_product.delete()
 
+    # removing a product may change the subscription's charge type
+
+    sub_product.subscription.update_next_action()
+
+
+@receiver(post_save, sender=SubscriptionCycle)
+def handle_subscription_cycle_save(sender, **kwargs):
+    """
+    When a subscription cycle is started, charged or otherwise changed
+    update when billing needs to process its subscription next
+
+    Billing runs defer the update to the end of each subscription
+    (see `Subscription.defer_next_action`), so this covers changes
+    made outside of them, e.g. in the admin
+    """
+
+    subscription_cycle = kwargs.get("instance")
+    subscription_cycle.subscription.clear_billing_cache()
+    subscription_cycle.subscription.update_next_action()
+
+
+@receiver(post_delete, sender=SubscriptionCycle)
+def handle_subscription_cycle_delete(sender, **kwargs):
+    """
+    Reset the memoized current subscription cycle of the subscription
+    when a subscription cycle is removed
+    """
+
+    subscription_cycle = kwargs.get("instance")
+
+    if SubscriptionCycle.subscription.is_cached(subscription_cycle):
+        subscription_cycle.subscription.clear_billing_cache()
+
 
 for TransactionModel in [InvoiceLine, OrderLine, Payment, Deposit, Withdrawal]:
 
@@ -110,9 +179,5 @@ for TransactionModel in [InvoiceLine, OrderLine, Payment, Deposit, Withdrawal]:
         if not created:
             return
         txn = kwargs.get("instance")
-        Ledger.objects.create(
-            content_object=txn,
-            invoice_number=getattr(txn, "invoice_number", None),
-            order_number=getattr(txn, "order_number", None),
-            org=txn.org,
-        )
+        Ledger.entry(txn).save()
+        AccountSummary.apply([txn])
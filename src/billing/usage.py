@@ -0,0 +1,294 @@
+"""
+Metered usage collection from service applications
+
+Usage is either pushed by the services as samples (see `ingest_usage`)
+or, for services that do not push it, requested from them during the
+billing run (see `UsageCollector`).
+"""
+
+import asyncio
+import collections
+
+import requests.exceptions
+from django.utils import timezone
+from fullctl.service_bridge.client import AuthError, ServiceBridgeError
+
+from applications.service_bridge import usage_from_document
+from billing.models import SubscriptionCycle, SubscriptionProduct, UsageSample
+
+
+def retryable(exc):
+    """
+    Returns whether a failed usage request should be retried
+    (connection errors, timeouts and server errors)
+    """
+
+    if isinstance(exc, AuthError):
+        return False
+    if isinstance(exc, ServiceBridgeError):
+        return exc.status >= 500
+    return isinstance(exc, (requests.exceptions.RequestException, asyncio.TimeoutError))
+
+
+class UsageCollector:
+    """
+    Collects metered product usage from service applications during a
+    billing run.
+
+    The usage document of an organization is fetched from each service
+    only once and then memoized, so organizations with multiple metered
+    products of the same service only cost a single request.
+
+    Documents can be fetched ahead of time and concurrently with
+    `prefetch`.
+
+    Arguments:
+
+    - concurrency (`int`): max concurrent requests per service
+    - timeout (`float`): request timeout in seconds
+    - retries (`int`): number of times a failed request is retried
+    - retry_backoff (`float`): seconds to wait before the first retry,
+      doubled for each following retry
+    """
+
+    def __init__(self, concurrency=4, timeout=10, retries=2, retry_backoff=0.5):
+        # (service id, org id) -> usage document
+        self.documents = {}
+
+        # (subscription cycle id, subscription product id) -> latest
+        # pushed usage
+        self.pushed = {}
+        self.pushed_products = set()
+
+        # (service id, org id) -> exception raised while prefetching
+        self.errors = {}
+
+        self.requests = 0
+        self.lookups = 0
+
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+    @property
+    def saved(self):
+        """
+        Number of service requests saved by memoization
+        """
+        return self.lookups - self.requests
+
+    def document(self, service, org):
+        """
+        Returns the usage document for the organization from the service
+
+        Re-raises the error if prefetching the document failed.
+        """
+
+        key = (service.id, org.id)
+
+        if key in self.errors:
+            raise self.errors[key]
+
+        if key not in self.documents:
+            self.requests += 1
+            self.documents[key] = service.bridge(org).usage_document(
+                timeout=self.timeout
+            )
+
+        return self.documents[key]
+
+    def usage(self, service, org, product_name):
+        """
+        Returns the usage for the product in the organization
+        """
+
+        self.lookups += 1
+        return usage_from_document(self.document(service, org), product_name)
+
+    def load_pushed(self, subscription_cycles):
+        """
+        Loads the latest usage pushed for the subscription cycles
+
+        Returns the number of subscription cycle products that have pushed
+        usage
+        """
+
+        for cycle_id, subscription_product_id, units in (
+            UsageSample.objects.filter(subscription_cycle__in=subscription_cycles)
+            .latest_per_product()
+            .values_list("subscription_cycle_id", "subscription_product_id", "units")
+        ):
+            self.pushed[(cycle_id, subscription_product_id)] = units
+            self.pushed_products.add(subscription_product_id)
+
+        return len(self.pushed)
+
+    def pushed_usage(self, subscription_cycle, subscription_product):
+        """
+        Returns the latest usage pushed for the subscription product in
+        the subscription cycle, None if none was pushed
+        """
+
+        return self.pushed.get((subscription_cycle.id, subscription_product.id))
+
+    def prefetch(self, targets):
+        """
+        Fetches the usage documents for all (service, org) targets
+        concurrently
+
+        Requests are limited to `concurrency` in-flight requests per service.
+        Errors are retried and, if they persist, recorded so they are
+        raised when the document is requested.
+
+        Returns the number of documents fetched
+        """
+
+        # bridges are set up here since they need the database,
+        # only the requests themselves are run concurrently
+        pending = collections.defaultdict(list)
+
+        for service, org in targets:
+            key = (service.id, org.id)
+            if key in self.documents or key in self.errors:
+                continue
+            try:
+                bridge = service.bridge(org)
+                path = bridge.usage_path()
+            except Exception as exc:
+                self.errors[key] = exc
+                continue
+            pending[service.id].append((key, bridge, path))
+
+        if not pending:
+            return 0
+
+        fetched = asyncio.run(self._prefetch(pending))
+        self.requests += fetched
+        return fetched
+
+    async def _prefetch(self, pending):
+        results = await asyncio.gather(
+            *[
+                self._prefetch_service(service_requests)
+                for service_requests in pending.values()
+            ]
+        )
+        return sum(results)
+
+    async def _prefetch_service(self, service_requests):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(key, bridge, path):
+            async with semaphore:
+                try:
+                    self.documents[key] = await self._fetch(bridge, path)
+                except Exception as exc:
+                    self.errors[key] = exc
+            return 1
+
+        results = await asyncio.gather(
+            *[fetch(*request) for request in service_requests]
+        )
+        return sum(results)
+
+    async def _fetch(self, bridge, path):
+        attempt = 0
+        while True:
+            try:
+                return await asyncio.wait_for(
+                    asyncio.to_thread(bridge.get, path, timeout=self.timeout),
+                    self.timeout,
+                )
+            except Exception as exc:
+                if attempt >= self.retries or not retryable(exc):
+                    raise
+                await asyncio.sleep(self.retry_backoff * 2**attempt)
+                attempt += 1
+
+
+def ingest_usage(service, samples):
+    """
+    Stores usage samples pushed by a service
+
+    Each sample is a dict with
+
+    - org (`str`): organization slug
+    - product (`str`): product name, the product needs to belong to
+      `service`
+    - units (`int`)
+    - timestamp (`datetime`, optional): defaults to now
+
+    A sample is stored for each subscription product of the organization
+    for the product, in the subscription cycle the sample was taken in.
+    Samples without a matching subscription product or cycle are ignored.
+
+    Returns a (stored, ignored) tuple of sample counts
+    """
+
+    now = timezone.now()
+    samples = [
+        dict(sample, timestamp=sample.get("timestamp") or now) for sample in samples
+    ]
+
+    if not samples:
+        return 0, 0
+
+    # (org slug, product name) -> [(subscription product id, subscription id)]
+    targets = collections.defaultdict(list)
+
+    for (
+        sub_product_id,
+        subscription_id,
+        org_slug,
+        product_name,
+    ) in SubscriptionProduct.objects.filter(
+        subscription__org__slug__in={sample["org"] for sample in samples},
+        product__name__in={sample["product"] for sample in samples},
+        product__component=service,
+    ).values_list(
+        "id", "subscription_id", "subscription__org__slug", "product__name"
+    ):
+        targets[(org_slug, product_name)].append((sub_product_id, subscription_id))
+
+    # subscription id -> [(start, end, cycle id)]
+    cycles = collections.defaultdict(list)
+    dates = [timezone.localdate(sample["timestamp"]) for sample in samples]
+
+    for cycle_id, subscription_id, start, end in SubscriptionCycle.objects.filter(
+        subscription_id__in={
+            subscription_id
+            for target in targets.values()
+            for _, subscription_id in target
+        },
+        start__lte=max(dates),
+        end__gt=min(dates),
+    ).values_list("id", "subscription_id", "start", "end"):
+        cycles[subscription_id].append((start, end, cycle_id))
+
+    usage_samples = []
+    ignored = 0
+
+    for sample, date in zip(samples, dates):
+        stored = False
+        for sub_product_id, subscription_id in targets.get(
+            (sample["org"], sample["product"]), []
+        ):
+            for start, end, cycle_id in cycles[subscription_id]:
+                if start <= date < end:
+                    usage_samples.append(
+                        UsageSample(
+                            subscription_cycle_id=cycle_id,
+                            subscription_product_id=sub_product_id,
+                            timestamp=sample["timestamp"],
+                            units=sample["units"],
+                        )
+                    )
+                    stored = True
+                    break
+        if not stored:
+            ignored += 1
+
+    UsageSample.objects.bulk_create(usage_samples, batch_size=500)
+
+    return len(samples) - ignored, ignored
@@ -0,0 +1,258 @@
+"""
+Synthetic billing workloads for benchmarking billing runs
+
+- `generate_workload` creates organizations with subscriptions, products,
+  modifiers and payment methods that are due to be billed
+- `FakeServiceBridge` is a local service application answering usage
+  requests with configurable latency
+
+Payments go through the simulated payment processor
+(`billing.payment_processors.simulated.Simulated`).
+"""
+
+import dataclasses
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import dateutil.relativedelta
+from django.utils import timezone
+
+import billing.payment_processors
+from account.models import InternalAPIKey, Organization
+from applications.models import Service
+from billing.models import (
+    BillingContact,
+    OrganizationProduct,
+    PaymentMethod,
+    Product,
+    ProductGroup,
+    RecurringProduct,
+    Subscription,
+    SubscriptionProductModifier,
+)
+from billing.payment_processors.simulated import Simulated
+
+
+class FakeServiceBridgeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.requests += 1
+
+        time.sleep(server.latency)
+
+        body = json.dumps({"data": server.usage}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeServiceBridge:
+    """
+    Local service application answering usage requests for all
+    organizations with the same usage document after `latency` seconds
+
+    Use as a context manager, the server is shut down on exit.
+    """
+
+    def __init__(self, latency=0, usage=None):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServiceBridgeHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.latency = latency
+        self.server.usage = usage or []
+        self.server.requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@dataclasses.dataclass
+class Workload:
+    orgs: list
+    subscriptions: list
+    service: Service
+    fixed_product: Product
+    metered_product: Product
+    trial_products: list
+
+    @property
+    def usage(self):
+        """
+        Usage document the service application should answer with
+        """
+        return [{"name": self.metered_product.name, "units": 100}]
+
+
+def generate_workload(
+    orgs=100,
+    subscriptions_per_org=1,
+    metered_ratio=0.5,
+    modifier_ratio=0.25,
+    expired_per_org=1,
+    service_url="http://localhost",
+    prefix="benchmark",
+    seed=None,
+):
+    """
+    Creates a synthetic billing workload
+
+    Every subscription has a fixed price product, `metered_ratio` of them
+    also a metered product that is collected from the service application
+    at `service_url` and `modifier_ratio` of them a price reduction.
+
+    Subscriptions are started with a cycle that ended yesterday so the
+    next billing run charges every one of them and starts a new cycle.
+
+    Each organization also has `expired_per_org` expired trial products
+    that are due to be replaced.
+
+    Payment methods use the `Simulated` payment processor, which is
+    registered as a payment processor. Configure it through
+    `Simulated.configure` before billing the workload.
+
+    Arguments:
+
+    - orgs (`int`): number of organizations
+    - subscriptions_per_org (`int`): subscriptions (product groups) per
+      organization
+    - metered_ratio (`float`): share of subscriptions with a metered product
+    - modifier_ratio (`float`): share of subscriptions with a modifier
+    - expired_per_org (`int`): expired trial products per organization
+    - service_url (`str`): api url of the service application metered
+      usage is collected from
+    - prefix (`str`): prefix for the names of the generated objects
+    - seed: random seed
+
+    Returns a `Workload`
+    """
+
+    rnd = random.Random(seed)
+
+    # service bridge requests are authenticated with the internal api key
+    InternalAPIKey.require()
+
+    service = Service.objects.create(
+        slug=f"{prefix}_service", name=f"{prefix} service", api_url=service_url
+    )
+
+    groups = [
+        ProductGroup.objects.create(name=f"{prefix} group {i}")
+        for i in range(subscriptions_per_org)
+    ]
+
+    fixed_product = Product.objects.create(
+        name=f"{prefix}.fixed", group=groups[0], price=0
+    )
+    RecurringProduct.objects.create(product=fixed_product, type="fixed", price=99.99)
+
+    metered_product = Product.objects.create(
+        name=f"{prefix}.metered", group=groups[0], price=0, component=service
+    )
+    RecurringProduct.objects.create(product=metered_product, type="metered", price=0.25)
+
+    trial_products = [
+        Product.objects.create(
+            name=f"{prefix}.trial.{i}",
+            group=groups[0],
+            price=0,
+            expiry_replacement_product=Product.objects.create(
+                name=f"{prefix}.trial.{i}.replacement", group=groups[0], price=0
+            ),
+        )
+        for i in range(expired_per_org)
+    ]
+
+    billing.payment_processors.PROCESSORS[Simulated.id] = Simulated
+
+    today = datetime.date.today()
+    cycle_start = today - dateutil.relativedelta.relativedelta(months=1, days=1)
+    expired = timezone.now() - datetime.timedelta(days=1)
+
+    workload = Workload(
+        orgs=[],
+        subscriptions=[],
+        service=service,
+        fixed_product=fixed_product,
+        metered_product=metered_product,
+        trial_products=trial_products,
+    )
+
+    for i in range(orgs):
+        org = Organization.objects.create(
+            name=f"{prefix} org {i}", slug=f"{prefix}_org_{i}"
+        )
+        workload.orgs.append(org)
+
+        billing_contact = BillingContact.objects.create(
+            org=org,
+            name=f"{prefix} contact {i}",
+            email=f"{prefix}_{i}@localhost",
+            phone_number="+16044011234",
+        )
+
+        payment_method = PaymentMethod.objects.create(
+            billing_contact=billing_contact,
+            custom_name=f"{prefix} payment method {i}",
+            processor=Simulated.id,
+            holder=billing_contact.name,
+            country="US",
+            city="Chicago",
+            address1="3400 Test Ave",
+            postal_code="60600",
+            state="IL",
+        )
+        payment_method.processor_instance.setup_billing()
+
+        for group in groups:
+            subscription = Subscription.objects.create(
+                org=org, group=group, payment_method=payment_method
+            )
+            workload.subscriptions.append(subscription)
+
+            subscription_product = subscription.add_product(fixed_product)
+
+            if rnd.random() < metered_ratio:
+                subscription.add_product(metered_product)
+
+            if rnd.random() < modifier_ratio:
+                SubscriptionProductModifier.objects.create(
+                    subscription_product=subscription_product,
+                    type="reduction",
+                    value=10,
+                    valid=timezone.now() + datetime.timedelta(days=30),
+                    source=prefix,
+                )
+
+            subscription.start_subscription_cycle(cycle_start)
+
+        for trial_product in trial_products:
+            OrganizationProduct.objects.create(
+                org=org, product=trial_product, expires=expired
+            )
+
+    return workload
@@ -3,6 +3,8 @@ from django.contrib.auth import get_user_model
 from django_grainy.decorators import grainy_rest_viewset_response
 from rest_framework.response import Response
 
+from account.permissions import CachedPermissions
+
 
 class user_endpoint:
     def __call__(self, fn):
@@ -31,6 +33,7 @@ class grainy_endpoint:
             namespace_instance=decorator.namespace,
             explicit=decorator.explicit,
             ignore_grant_all=True,
+            permissions_cls=CachedPermissions,
         )
         def wrapped(self, request, *args, **kwargs):
             if decorator.require_auth and not request.user.is_authenticated:
@@ -0,0 +1,148 @@
+"""
+Keyset (cursor) pagination for list endpoints
+
+Pages are selected with a `WHERE (field, id) < (value, id)` condition on
+the last row of the previous page instead of an offset, so fetching a page
+costs the same no matter how deep into the history it is.
+
+The response body stays a plain list, the next page is announced through
+a `Link: <url>; rel="next"` header and is absent on the last page.
+
+Pagination is opt-in, requests without any of the query parameters below
+get all rows (endpoints may bound those).
+
+Query parameters:
+
+- limit: number of rows per page
+- cursor: opaque cursor of the page to fetch, as found in the `Link` header
+"""
+
+import base64
+import json
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import DateTimeField, Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import ValidationError
+
+
+class KeysetPagination:
+    """
+    Paginates a queryset in descending order of `field` and `id`
+
+    Arguments:
+
+    - field (`str`): datetime field to order by, it may not be nullable
+    - default_limit (`int`): page size if no `limit` is requested
+    - max_limit (`int`): largest page size that can be requested
+    """
+
+    def __init__(self, field, default_limit=25, max_limit=100):
+        self.field = field
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+        self.next_cursor = None
+
+    def encode_cursor(self, instance):
+        value = getattr(instance, self.field)
+        cursor = json.dumps([value.isoformat(), instance.id])
+        return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            value, pk = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            value = parse_datetime(value)
+            pk = int(pk)
+        except (TypeError, ValueError):
+            value = None
+
+        if value is None:
+            raise ValidationError({"cursor": ["Invalid cursor"]})
+
+        return value, pk
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.GET.get("limit", self.default_limit))
+        except ValueError:
+            raise ValidationError({"limit": ["Must be an integer"]})
+
+        return max(1, min(limit, self.max_limit))
+
+    def check_field(self, model):
+        """
+        Raises `ImproperlyConfigured` if `field` is not a non-nullable
+        datetime field of `model`, cursors hold a datetime value
+        """
+
+        field = model._meta.get_field(self.field)
+
+        if not isinstance(field, DateTimeField) or field.null:
+            raise ImproperlyConfigured(
+                f"{model.__name__}.{self.field} needs to be a non-nullable "
+                "datetime field to be used for keyset pagination"
+            )
+
+    def paginated(self, request):
+        """
+        Returns whether the request asks for a page
+        """
+
+        return "limit" in request.GET or "cursor" in request.GET
+
+    def paginate_queryset(self, queryset, request):
+        """
+        Returns the rows of the requested page as a list and remembers the
+        cursor of the next page
+
+        Returns all rows if the request does not ask for a page
+        """
+
+        self.check_field(queryset.model)
+
+        self.request = request
+        self.next_cursor = None
+
+        if not self.paginated(request):
+            return list(queryset.order_by(f"-{self.field}", "-id"))
+
+        limit = self.get_limit(request)
+        cursor = request.GET.get("cursor")
+
+        if cursor:
+            value, pk = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(**{f"{self.field}__lt": value})
+                | Q(**{self.field: value, "id__lt": pk})
+            )
+
+        # one extra row tells whether there is a next page
+        rows = list(queryset.order_by(f"-{self.field}", "-id")[: limit + 1])
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            self.next_cursor = self.encode_cursor(rows[-1])
+        else:
+            self.next_cursor = None
+
+        return rows
+
+    def get_next_link(self):
+        if not self.next_cursor:
+            return None
+
+        params = self.request.GET.copy()
+        params["cursor"] = self.next_cursor
+        return self.request.build_absolute_uri(
+            f"{self.request.path}?{params.urlencode()}"
+        )
+
+    def get_paginated_response(self, response):
+        """
+        Adds the `Link` header of the next page to `response`
+        """
+
+        next_link = self.get_next_link()
+        if next_link:
+            response["Link"] = f'<{next_link}>; rel="next"'
+        return response
@@ -0,0 +1,60 @@
+import secrets
+
+from django.db import IntegrityError, transaction
+
+
+def unique_token(nbytes=None, lower=False):
+    """
+    Returns an unguessable url-safe token to be used as a unique value
+    (order numbers, api keys, secrets etc.)
+
+    Tokens carry enough entropy that a collision is negligible, so no
+    query is made to check whether the value is already taken - the unique
+    constraint on the field is the authority (see `TokenAllocator.create`)
+    """
+
+    token = secrets.token_urlsafe(nbytes)
+    if lower:
+        return token.lower()
+    return token
+
+
+class TokenAllocator:
+    """
+    Allocates unique tokens for a model field
+
+    Calling the allocator returns a new token, `create` inserts an instance
+    with a new token and retries if it collides.
+    """
+
+    def __init__(self, Model, field, nbytes=None, lower=False):
+        self.Model = Model
+        self.field = field
+        self.nbytes = nbytes
+        self.lower = lower
+
+    def __call__(self):
+        return unique_token(self.nbytes, self.lower)
+
+    def create(self, attempts=10, **kwargs):
+        """
+        Creates an instance of the model with a newly allocated token
+        for the field
+
+        If the token is already taken (the insert violates the unique
+        constraint) another token is allocated and the insert retried.
+        """
+
+        Model = self.Model
+
+        for i in range(attempts):
+            token = self()
+            try:
+                with transaction.atomic():
+                    return Model.objects.create(**{self.field: token}, **kwargs)
+            except IntegrityError:
+                # only retry if the token collided, raise other violations
+                if not Model.objects.filter(**{self.field: token}).exists():
+                    raise
+
+        raise OSError(f"Could not allocate a unique {Model.__name__} {self.field}")
@@ -47,6 +47,33 @@ class Service(ModelSerializer):
             return None
         return obj.trial_product.name
 
+    def trial_eligibility(self, org, obj):
+        """
+        Returns the `ProductEligibility` of the trial products of all the
+        services being serialized, so they are checked together rather than
+        once per service
+        """
+
+        eligibility = self.context.get("trial_eligibility")
+
+        if eligibility is None or obj.trial_product_id not in eligibility.products:
+            if isinstance(self.parent, serializers.ListSerializer):
+                services = self.parent.instance
+            else:
+                services = [obj]
+
+            eligibility = billing_models.ProductEligibility(
+                org,
+                [
+                    service.trial_product
+                    for service in services
+                    if service.trial_product_id
+                ],
+            )
+            self.context["trial_eligibility"] = eligibility
+
+        return eligibility
+
     def get_org_can_trial(self, obj):
         org = self.context.get("org")
         if not org:
@@ -55,7 +82,7 @@ class Service(ModelSerializer):
         if not obj.trial_product_id:
             return False
 
-        return obj.trial_product.can_add_to_org(org)
+        return self.trial_eligibility(org, obj).can_add(obj.trial_product)
 
     def get_org_has_access(self, obj):
         org = self.context.get("org")
@@ -111,6 +138,37 @@ class OrganizationCanTrialForObject(serializers.Serializer):
         return trial_product.can_add_to_org(org, component_object_id=obj["object_id"])
 
 
+class UsagePushSample(serializers.Serializer):
+    org = serializers.CharField()
+    product = serializers.CharField()
+    units = serializers.IntegerField(min_value=0)
+    timestamp = serializers.DateTimeField(required=False, allow_null=True, default=None)
+
+
+@register
+class UsagePush(serializers.Serializer):
+
+    """
+    Usage samples pushed by a service
+    """
+
+    service_slug = serializers.CharField()
+    samples = UsagePushSample(many=True, allow_empty=False, max_length=1000)
+
+    ref_tag = "usage_push"
+
+    class Meta:
+        fields = ["service_slug", "samples"]
+
+    def validate_service_slug(self, value):
+        try:
+            service = application_models.Service.objects.get(slug=value)
+        except application_models.Service.DoesNotExist:
+            raise serializers.ValidationError("Unknown service")
+        self.context.update(service=service)
+        return value
+
+
 @register
 class User(ModelSerializer):
     ref_tag = "user"
@@ -1,14 +1,21 @@
+import datetime
+
 from django.contrib.auth import get_user_model
+from django.http import HttpResponseNotModified
+from django.shortcuts import get_object_or_404
+from django.utils.http import parse_etags
 from fullctl.django.rest.core import BadRequest
 from fullctl.django.rest.route.service_bridge import route
 from fullctl.django.rest.views.service_bridge import DataViewSet, SystemViewSet
 from oauth2_provider.models import AccessToken
+from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_framework.response import Response
 
 import account.models as account_models
 import applications.models as application_models
 import billing.models as billing_models
+from billing.usage import ingest_usage
 from common.rest.decorators import grainy_endpoint
 from django_aaactl.rest.serializers.service_bridge import Serializers
 
@@ -60,7 +67,9 @@ class Service(AaactlDataViewSet):
     autocomplete = "name"
     allow_unfiltered = True
 
-    queryset = application_models.Service.objects.filter(status="ok")
+    queryset = application_models.Service.objects.filter(status="ok").select_related(
+        "trial_product"
+    )
     serializer_class = Serializers.service_application
 
     def serializer_context(self, request, context):
@@ -120,6 +129,116 @@ class OrganizationProduct(AaactlDataViewSet):
     serializer_class = Serializers.org_product
 
 
+@route
+class OrganizationEntitlement(viewsets.ViewSet):
+
+    """
+    Entitlement snapshot of an organization: the products it has, with
+    their component object ids, expiry and product data
+
+    Responses carry the entitlement version as `ETag`, services caching
+    the snapshot revalidate it with `If-None-Match` and get an empty
+    304 response if it did not change.
+    """
+
+    path_prefix = "/data"
+    allowed_http_methods = ["GET"]
+    ref_tag = "org_entitlement"
+
+    @grainy_endpoint("service_bridge")
+    def retrieve(self, request, pk):
+        org = get_object_or_404(account_models.Organization, slug=pk)
+
+        version = billing_models.OrganizationEntitlement.current_version(org)
+        etag = billing_models.OrganizationEntitlement.etag(org, version)
+
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+
+        if etag in if_none_match or "*" in if_none_match:
+            response = Response({}, status=304)
+        else:
+            response = Response(
+                billing_models.OrganizationEntitlement.snapshot(org, version)
+            )
+
+        response["ETag"] = etag
+        return response
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        # not modified responses have no body, skip rendering
+        if response.status_code == 304:
+            not_modified = HttpResponseNotModified()
+            not_modified["ETag"] = response["ETag"]
+            return not_modified
+
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+@route
+class Usage(viewsets.ViewSet):
+
+    """
+    Metered usage pushed by services
+
+    POST stores a batch of usage samples for a service, the key needs
+    create permissions to the service (`service.<slug>`). GET returns the
+    usage of an organization's product in its current subscription cycles,
+    downsampled to the highest usage per `bucket` (`hour` or `day`).
+    """
+
+    path_prefix = "/data"
+    allowed_http_methods = ["GET", "POST"]
+    ref_tag = "usage"
+
+    @grainy_endpoint("service_bridge")
+    def create(self, request, *args, **kwargs):
+        serializer = Serializers.usage_push(data=request.data)
+
+        if not serializer.is_valid():
+            return BadRequest(serializer.errors)
+
+        service = serializer.context["service"]
+
+        # usage can only be pushed for services the key has access to
+        if not request.perms.check(service, "c", explicit=True):
+            return Response(
+                {"service_slug": ["No permission to push usage for this service"]},
+                status=403,
+            )
+
+        stored, ignored = ingest_usage(service, serializer.validated_data["samples"])
+
+        return Response({"stored": stored, "ignored": ignored})
+
+    @grainy_endpoint("service_bridge")
+    def list(self, request, *args, **kwargs):
+        org = request.GET.get("org")
+        product = request.GET.get("product")
+        bucket = request.GET.get("bucket", "day")
+
+        if not org or not product:
+            return BadRequest({"non_field_errors": ["org and product are required"]})
+
+        if bucket not in ("hour", "day"):
+            return BadRequest({"bucket": ["Must be `hour` or `day`"]})
+
+        today = datetime.date.today()
+
+        qset = billing_models.UsageSample.objects.filter(
+            subscription_cycle__subscription__org__slug=org,
+            subscription_cycle__start__lte=today,
+            subscription_cycle__end__gt=today,
+            subscription_product__product__name=product,
+        )
+
+        return Response(
+            [
+                {"timestamp": row["bucket"], "units": row["units"]}
+                for row in qset.downsample(bucket)
+            ]
+        )
+
+
 @route
 class User(AaactlDataViewSet):
     path_prefix = "/data"
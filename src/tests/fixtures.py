@@ -436,7 +436,7 @@ def order(billing_objects):
 
 @pytest.fixture
 def invoice(billing_objects, order):
-    from billing.models import Invoice, InvoiceLine, Order
+    from billing.models import Invoice, InvoiceLine
 
     data = create_transaction_data(billing_objects)
     data.update(
@@ -445,9 +445,8 @@ def invoice(billing_objects, order):
             "description": "This subscription is helpful",
         }
     )
-    order = Order.objects.create(org=billing_objects.org, order_number=132)
     invoice = Invoice.objects.create(
-        order=order, invoice_number=312, org=billing_objects.org
+        order=order.order, invoice_number=312, org=billing_objects.org
     )
     invoice_line = InvoiceLine.objects.create(invoice=invoice, **data)
     return invoice_line
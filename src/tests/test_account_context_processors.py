@@ -1,5 +1,11 @@
+from django.db import connection
+from django.template import engines
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from account.context_processors import PermissionsContext
+from account.permissions import CachedPermissions
+
 
 def test_permissions(db, account_objects, data_account_ctxp_perms):
     response = account_objects.client.get(reverse("account:controlpanel"))
@@ -7,3 +13,39 @@ def test_permissions(db, account_objects, data_account_ctxp_perms):
     permissions = response.context["permissions"]
 
     assert permissions == data_account_ctxp_perms.expected
+
+
+def test_permissions_lazy(db, account_objects):
+    response = account_objects.client.get(reverse("account:controlpanel"))
+    request = response.wsgi_request
+    org = request.selected_org
+
+    permissions = PermissionsContext(request)
+
+    # nothing is computed until read
+    assert permissions._context is None
+
+    # the managed permission namespaces are loaded once, permissions are
+    # checked against the loaded permission set
+    with CaptureQueriesContext(connection) as ctx:
+        assert permissions["read_org_billing"]
+    assert len(ctx.captured_queries) <= 1
+
+    for namespace in org.permission_namespaces:
+        name = namespace.replace(".{org_id}", "").replace(".", "__")
+        for op, flag in [("create", "c"), ("read", "r"), ("update", "u")]:
+            assert permissions[f"{op}_org_{name}"] == request.perms.check(
+                namespace.format(org_id=org.id), flag, ignore_grant_all=True
+            )
+
+
+def test_permissions_no_prior_check(db, account_objects):
+    response = account_objects.client.get(reverse("account:controlpanel"))
+    request = response.wsgi_request
+
+    # permissions that were not loaded by a permission check yet
+    request.perms = CachedPermissions(request.user)
+    assert not request.perms.loaded
+
+    template = engines["django"].from_string("{{ permissions.read_org_billing }}")
+    assert template.render(request=request) == "True"
@@ -1,3 +1,5 @@
+import datetime
+
 import pytest
 import reversion
 from django_grainy.util import Permissions
@@ -6,10 +8,13 @@ from grainy.const import PERM_CRUD
 from account.models import (
     ManagedPermission,
     ManagedPermissionRoleAutoGrant,
+    OrganizationManagedPermission,
     OrganizationRole,
+    PendingPermissionUpdate,
     Role,
     UpdatePermissions,
 )
+from account.tasks import Delay
 
 
 @pytest.mark.django_db
@@ -54,3 +59,107 @@ def test_managed_permission_role_auto_grant_add_and_delete(account_objects):
     UpdatePermissions.objects.last()._run()
 
     assert not Permissions(account_objects.user).check("test.mperm", "r")
+
+
+@pytest.mark.django_db
+def test_permission_update_queue(account_objects, settings):
+    org = account_objects.org
+    other_org = account_objects.other_org
+    user = account_objects.user
+
+    mperm = ManagedPermission.objects.create(
+        namespace="test.{org_id}.mperm",
+        status="ok",
+        group="test",
+        grant_mode="restricted",
+        description="test",
+        managable=True,
+    )
+    ManagedPermissionRoleAutoGrant.objects.create(
+        managed_permission=mperm,
+        role=Role.objects.get(name="admin"),
+        permissions=PERM_CRUD,
+    )
+
+    update_permissions_count = UpdatePermissions.objects.count()
+
+    # repeated changes to an organization are merged into one entry and
+    # a single task
+    for i in range(3):
+        OrganizationManagedPermission.objects.create(
+            org=org, managed_permission=mperm, reason=f"test {i}"
+        )
+    OrganizationManagedPermission.objects.create(
+        org=other_org, managed_permission=mperm, reason="test"
+    )
+    PendingPermissionUpdate.queue(org=org, user=user)
+
+    assert sorted(
+        PendingPermissionUpdate.objects.values_list("org_id", "user_id")
+    ) == sorted([(org.id, None), (other_org.id, None)])
+    assert UpdatePermissions.objects.count() == update_permissions_count + 1
+
+    task = UpdatePermissions.objects.last()
+
+    # the task waits for more changes before it runs
+    settings.PERMISSION_UPDATE_DELAY = 10
+    assert not Delay().check(task)
+    task.created -= datetime.timedelta(seconds=11)
+    assert Delay().check(task)
+
+    task._run()
+    task.refresh_from_db()
+
+    assert task.output == "2 organizations, 0 users"
+    assert not PendingPermissionUpdate.objects.exists()
+    assert Permissions(user).check(f"test.{org.id}.mperm", "crud")
+
+    # a global recompute absorbs the queued organizations
+    PendingPermissionUpdate.queue(org=org)
+    PendingPermissionUpdate.queue()
+    PendingPermissionUpdate.queue(org=other_org, user=user)
+
+    assert list(PendingPermissionUpdate.objects.values_list("org_id", "user_id")) == [
+        (None, None)
+    ]
+
+    task = UpdatePermissions.objects.last()
+    task._run()
+    task.refresh_from_db()
+
+    assert task.output == "all users"
+
+
+@pytest.mark.django_db
+def test_permission_update_queue_drain(account_objects, monkeypatch):
+    org = account_objects.org
+    other_org = account_objects.other_org
+
+    apply_roles_org = ManagedPermission.apply_roles_org
+
+    def fail(org):
+        raise ValueError("test")
+
+    # entries stay queued if the recompute fails
+    PendingPermissionUpdate.queue(org=org, create_task=False)
+    monkeypatch.setattr(ManagedPermission, "apply_roles_org", fail)
+
+    with pytest.raises(ValueError):
+        PendingPermissionUpdate.drain()
+
+    assert list(PendingPermissionUpdate.objects.values_list("org_id", "user_id")) == [
+        (org.id, None)
+    ]
+
+    # changes queued during the recompute are left for the next run
+    def queue_during(org):
+        apply_roles_org(org)
+        PendingPermissionUpdate.queue(org=org, create_task=False)
+        PendingPermissionUpdate.queue(org=other_org, create_task=False)
+
+    monkeypatch.setattr(ManagedPermission, "apply_roles_org", queue_during)
+
+    assert PendingPermissionUpdate.drain() == "1 organizations, 0 users"
+    assert sorted(
+        PendingPermissionUpdate.objects.values_list("org_id", "user_id")
+    ) == sorted([(org.id, None), (other_org.id, None)])
@@ -1,7 +1,10 @@
 import pytest
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_grainy.models import UserPermission
 from django_grainy.util import Permissions
-from grainy.const import PERM_CRUD
+from grainy.const import PERM_CRUD, PERM_READ
 
 from account.models import (
     ManagedPermission,
@@ -9,6 +12,7 @@ from account.models import (
     OrganizationManagedPermission,
     OrganizationRole,
     Role,
+    UserPermissionOverride,
 )
 
 
@@ -160,6 +164,147 @@ def test_grant_mode_restricted_add_user_granted(account_objects, role_objects):
     assert not Permissions(user_2).check("test.mperm", "r")
 
 
+@pytest.mark.django_db
+def test_apply_roles_all_diff(account_objects, role_objects):
+    org = account_objects.org
+    user = account_objects.user
+
+    OrganizationRole.objects.create(org=org, user=user, role=role_objects.test_role)
+
+    mperm = ManagedPermission.objects.create(
+        namespace="test.{org_id}.mperm",
+        status="ok",
+        group="test",
+        description="test",
+        managable=True,
+    )
+    auto_grant = ManagedPermissionRoleAutoGrant.objects.create(
+        managed_permission=mperm, role=role_objects.test_role, permissions=PERM_CRUD
+    )
+
+    ManagedPermission.apply_roles_all()
+
+    ns = f"test.{org.id}.mperm"
+    row = user.grainy_permissions.get(namespace=ns)
+    assert row.permission == PERM_CRUD
+
+    # changed grants update the existing row, permissions no longer
+    # granted are removed
+    user.grainy_permissions.add_permission("test.stale", PERM_READ)
+    auto_grant.permissions = PERM_READ
+    auto_grant.save()
+    UserPermissionOverride.objects.create(
+        user=user, org=org, namespace="test.override", permissions=PERM_CRUD
+    )
+
+    ManagedPermission.apply_roles_all()
+
+    assert user.grainy_permissions.get(namespace=ns).id == row.id
+    assert user.grainy_permissions.get(namespace=ns).permission == PERM_READ
+    assert user.grainy_permissions.get(namespace="test.override").permission == (
+        PERM_CRUD
+    )
+    assert not user.grainy_permissions.filter(namespace="test.stale").exists()
+
+    # unchanged permissions are not written and the number of queries
+    # does not grow with the number of members
+
+    with CaptureQueriesContext(connection) as ctx:
+        ManagedPermission.apply_roles_all()
+    queries = len(ctx.captured_queries)
+
+    for i in range(5):
+        member = get_user_model().objects.create_user(
+            username=f"member_{i}", email=f"member_{i}@localhost", password="member"
+        )
+        org.add_user(member)
+        OrganizationRole.objects.create(
+            org=org, user=member, role=role_objects.test_role
+        )
+
+    ManagedPermission.apply_roles_all()
+    assert UserPermission.objects.filter(namespace=ns).count() == 6
+
+    with CaptureQueriesContext(connection) as ctx:
+        ManagedPermission.apply_roles_all()
+    assert len(ctx.captured_queries) == queries
+
+
+@pytest.mark.django_db
+def test_apply_roles_incremental(account_objects, role_objects):
+    org = account_objects.org
+    other_org = account_objects.other_org
+    user = account_objects.user
+
+    OrganizationRole.objects.create(org=org, user=user, role=role_objects.test_role)
+
+    for i in range(3):
+        mperm = ManagedPermission.objects.create(
+            namespace=f"test.{{org_id}}.mperm{i}",
+            status="ok",
+            group="test",
+            description="test",
+            managable=True,
+        )
+        ManagedPermissionRoleAutoGrant.objects.create(
+            managed_permission=mperm, role=role_objects.test_role, permissions=PERM_CRUD
+        )
+
+    UserPermissionOverride.objects.create(
+        user=user, org=other_org, namespace="test.other", permissions=PERM_CRUD
+    )
+
+    ManagedPermission.apply_roles(org, user)
+
+    rows = dict(user.grainy_permissions.values_list("namespace", "id"))
+    for i in range(3):
+        assert Permissions(user).check(f"test.{org.id}.mperm{i}", "crud")
+
+    # overrides of other organizations are left alone
+    assert "test.other" not in rows
+
+    # nothing changed, nothing is written and the number of queries does
+    # not depend on the number of managed namespaces
+    with CaptureQueriesContext(connection) as ctx:
+        ManagedPermission.apply_roles(org, user)
+    assert not [
+        query for query in ctx.captured_queries if not query["sql"].startswith("SELECT")
+    ]
+    queries = len(ctx.captured_queries)
+
+    ManagedPermission.objects.create(
+        namespace="test.{org_id}.unused",
+        status="ok",
+        group="test",
+        description="test",
+        managable=True,
+    )
+    with CaptureQueriesContext(connection) as ctx:
+        ManagedPermission.apply_roles(org, user)
+    assert len(ctx.captured_queries) == queries
+
+    assert dict(user.grainy_permissions.values_list("namespace", "id")) == rows
+
+    # overrides of the organization are applied on top of the roles
+    UserPermissionOverride.objects.create(
+        user=user, org=org, namespace=f"test.{org.id}.mperm0", permissions=PERM_READ
+    )
+    ManagedPermission.apply_roles(org, user)
+
+    row = user.grainy_permissions.get(namespace=f"test.{org.id}.mperm0")
+    assert row.id == rows[f"test.{org.id}.mperm0"]
+    assert row.permission == PERM_READ
+
+    # permissions the roles no longer grant are removed
+    OrganizationRole.objects.filter(org=org, user=user).delete()
+
+    assert list(
+        user.grainy_permissions.filter(namespace__startswith="test.").values_list(
+            "namespace", flat=True
+        )
+    ) == [f"test.{org.id}.mperm0"]
+
+
 class RoleObjects:
     def __init__(self):
         self.test_role = Role.objects.create(
@@ -0,0 +1,136 @@
+from unittest.mock import patch
+
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import reverse
+from django_grainy.util import Permissions
+from grainy.const import PERM_CRUD, PERM_READ
+
+from account.models import (
+    ManagedPermission,
+    OrganizationAPIKey,
+    OrganizationAPIKeyPermission,
+)
+from account.permissions import CachedPermissions, check_cache
+
+
+@pytest.fixture
+def permissions_cache(settings):
+    settings.CACHES = {
+        **settings.CACHES,
+        "permissions": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    }
+    settings.PERMISSIONS_CACHE = "permissions"
+
+
+@pytest.mark.django_db
+def test_cached_permissions_user(
+    account_objects, permissions_cache, django_assert_num_queries
+):
+    user = account_objects.user
+    org = account_objects.org
+
+    assert CachedPermissions(user).check(f"billing.{org.id}", "crud")
+
+    # permission rows and groups are not queried again
+    with django_assert_num_queries(0):
+        assert CachedPermissions(user).check(f"billing.{org.id}", "crud")
+
+    # changes apply to the next load
+    user.grainy_permissions.add_permission("test.cache", PERM_READ)
+    assert CachedPermissions(user).check("test.cache", "r")
+
+    user.grainy_permissions.delete_permission("test.cache")
+    assert not CachedPermissions(user).check("test.cache", "r")
+
+    # bulk writes when roles are reapplied
+    user.grainy_permissions.filter(namespace=f"billing.{org.id}").update(
+        permission=PERM_READ
+    )
+    ManagedPermission.apply_roles(org, user)
+    assert CachedPermissions(user).check(f"billing.{org.id}", "crud")
+
+    # other users are cached separately
+    assert not CachedPermissions(account_objects.user_unpermissioned).check(
+        f"billing.{org.id}", "c"
+    )
+
+
+@pytest.mark.django_db
+def test_cached_permissions_api_key(account_objects, permissions_cache):
+    org = account_objects.org
+    api_key = OrganizationAPIKey.objects.create(org=org, email="key@localhost")
+
+    assert not CachedPermissions(api_key).check(f"billing.{org.id}", "r")
+
+    OrganizationAPIKeyPermission.objects.create(
+        api_key=api_key, namespace=f"billing.{org.id}", permission=PERM_CRUD
+    )
+    assert CachedPermissions(api_key).check(f"billing.{org.id}", "crud")
+
+
+@pytest.mark.django_db
+def test_cached_permissions_request(account_objects, permissions_cache):
+    client = account_objects.client
+    user = account_objects.user
+
+    response = client.get(reverse("account:controlpanel"))
+    assert not response.wsgi_request.perms.check("test.cache", "r")
+
+    user.grainy_permissions.add_permission("test.cache", PERM_READ)
+
+    response = client.get(reverse("account:controlpanel"))
+    assert isinstance(response.wsgi_request.perms, CachedPermissions)
+    assert response.wsgi_request.perms.check("test.cache", "r")
+
+
+@pytest.mark.django_db
+def test_cached_permissions_rest_endpoint(account_objects, permissions_cache):
+    url = reverse("account_api:org-detail", args=(account_objects.org.slug,))
+
+    assert account_objects.api_client.get(url).status_code == 200
+
+    # permission sets are loaded from the cache by grainy endpoints
+    with patch.object(Permissions, "load") as load:
+        assert account_objects.api_client.get(url).status_code == 200
+
+    load.assert_not_called()
+
+
+@pytest.mark.django_db
+def test_cached_permissions_disabled(account_objects, settings):
+    settings.PERMISSIONS_CACHE = None
+    user = account_objects.user
+
+    with patch("account.permissions.caches") as caches:
+        assert not CachedPermissions(user).check("test.cache", "r")
+
+        user.grainy_permissions.add_permission("test.cache", PERM_READ)
+        assert CachedPermissions(user).check("test.cache", "r")
+
+    caches.__getitem__.assert_not_called()
+
+
+def test_check_permissions_cache(settings):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "redis": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": "redis://127.0.0.1:6379",
+        },
+    }
+
+    settings.PERMISSIONS_CACHE = None
+    check_cache()
+
+    settings.PERMISSIONS_CACHE = "redis"
+    check_cache()
+
+    # local memory caches are not shared between processes
+    settings.PERMISSIONS_CACHE = "default"
+    with pytest.raises(ImproperlyConfigured):
+        check_cache()
+
+    settings.PERMISSIONS_CACHE = "missing"
+    with pytest.raises(ImproperlyConfigured):
+        check_cache()
@@ -1,7 +1,12 @@
 import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from rest_framework.test import APIClient
 
 import billing.models as models
+from common.rest.pagination import KeysetPagination
 from tests.helpers import strip_api_fields
 
 
@@ -217,6 +222,152 @@ def test_get_orders(billing_objects, charge_objects):
     assert response.status_code == 200
 
 
+def follow_pages(client, url, **params):
+    """
+    Requests all pages of a keyset paginated endpoint and returns the
+    rows of each page
+    """
+
+    pages = []
+    response = client.get(url, params)
+
+    while True:
+        assert response.status_code == 200
+        pages.append(response.json()["data"])
+
+        link = response.get("Link")
+        if not link:
+            return pages
+
+        assert link.startswith("<") and link.endswith('>; rel="next"')
+        response = client.get(link[1:].split(">")[0])
+
+
+def count_queries(client, url, **params):
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(url, params)
+    assert response.status_code == 200
+    return len(context.captured_queries)
+
+
+@pytest.mark.django_db
+def test_get_orders_paginated(billing_objects, charge_objects):
+    payment_method = billing_objects.payment_method
+
+    for i in range(4):
+        order_history = models.OrderHistory.objects.create(
+            billing_contact=payment_method.billing_contact,
+            payment_charge=models.PaymentCharge.objects.create(
+                payment_method=payment_method,
+                price=10,
+                description=f"Order {i}",
+            ),
+            billed_to=payment_method.name,
+            processed=charge_objects["order_history"].processed,
+        )
+        models.OrderHistoryItem.objects.create(
+            order=order_history, description=f"Item {i}", price=10
+        )
+
+    url = reverse("billing_api:org-orders", args=[billing_objects.org.slug])
+
+    pages = follow_pages(billing_objects.api_client, url, limit=2)
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+
+    # newest first, orders processed at the same time are ordered by id
+    # and none are skipped or repeated across pages
+    order_ids = [order["order_id"] for page in pages for order in page]
+    assert order_ids == list(
+        models.OrderHistory.objects.order_by("-processed", "-id").values_list(
+            "order_id", flat=True
+        )
+    )
+    assert pages[0][0]["items"] == [{"description": "Item 3", "price": 10.0}]
+
+    # the number of queries does not depend on the page size
+    assert count_queries(billing_objects.api_client, url, limit=1) == count_queries(
+        billing_objects.api_client, url, limit=5
+    )
+
+    response = billing_objects.api_client.get(url, {"cursor": "invalid"})
+    assert response.status_code == 400
+
+    # requests that do not ask for a page get all orders
+    response = billing_objects.api_client.get(url)
+    assert response.status_code == 200
+    assert not response.get("Link")
+    assert [order["order_id"] for order in response.json()["data"]] == order_ids
+
+
+@pytest.mark.django_db
+def test_get_open_invoices(billing_objects):
+    org = billing_objects.org
+
+    for i in range(5):
+        invoice = models.Invoice.objects.create(
+            org=org, order=models.Order.objects.create(org=org)
+        )
+        for amount in (10, i):
+            models.InvoiceLine.objects.create(
+                invoice=invoice, amount=amount, currency="EUR"
+            )
+
+    # paid invoices are not listed
+    paid = models.Invoice.objects.order_by("id")[1]
+    models.Payment.objects.create(
+        org=org, amount=10, invoice_number=paid.invoice_number
+    )
+
+    url = reverse("billing_api:org-open-invoices", args=[org.slug])
+
+    pages = follow_pages(billing_objects.api_client, url, limit=3)
+
+    invoices = [invoice for page in pages for invoice in page]
+
+    assert [len(page) for page in pages] == [3, 1]
+    assert paid.invoice_number not in [i["invoice_number"] for i in invoices]
+    assert [i["price"] for i in invoices] == [14.0, 13.0, 12.0, 10.0]
+    assert {i["currency"] for i in invoices} == {"EUR"}
+
+    assert count_queries(billing_objects.api_client, url, limit=1) == count_queries(
+        billing_objects.api_client, url, limit=4
+    )
+
+    # requests that do not ask for a page only look at the 25 most
+    # recent invoices
+    response = billing_objects.api_client.get(url)
+    assert response.status_code == 200
+    assert not response.get("Link")
+    assert [i["invoice_number"] for i in response.json()["data"]] == [
+        i["invoice_number"] for i in invoices
+    ]
+
+    for i in range(25):
+        models.Invoice.objects.create(
+            org=org, order=models.Order.objects.create(org=org)
+        )
+
+    response = billing_objects.api_client.get(url)
+    assert len(response.json()["data"]) == 25
+    assert invoices[0]["invoice_number"] not in [
+        i["invoice_number"] for i in response.json()["data"]
+    ]
+
+    pages = follow_pages(billing_objects.api_client, url, limit=100)
+    assert len(pages[0]) == 29
+
+
+def test_keyset_pagination_field():
+    KeysetPagination("created").check_field(models.Invoice)
+
+    with pytest.raises(ImproperlyConfigured):
+        KeysetPagination("status").check_field(models.Invoice)
+
+    with pytest.raises(ImproperlyConfigured):
+        KeysetPagination("last_payment").check_field(models.AccountSummary)
+
+
 @pytest.mark.django_db
 def test_get_products(billing_objects, data_billing_api_product):
     response = billing_objects.api_client.get(reverse("billing_api:product-list"))
@@ -224,3 +375,75 @@ def test_get_products(billing_objects, data_billing_api_product):
     assert strip_api_fields(response.json()) == strip_api_fields(
         data_billing_api_product.expected
     )
+
+
+@pytest.mark.django_db
+def test_org_entitlement(billing_objects):
+    org = billing_objects.org
+    client = billing_objects.api_client
+    billing_objects.user.grainy_permissions.add_permission("service_bridge", 1)
+
+    url = reverse(
+        "service_bridge_api:service-bridge-data-org_entitlement-detail",
+        args=[org.slug],
+    )
+
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response["ETag"]
+
+    snapshot = response.json()["data"][0]
+    assert snapshot["org"] == org.slug
+    products = snapshot["products"]
+    assert len(products) == org.products.count()
+
+    # unchanged
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+    assert not response.content
+
+    # adding a product bumps the version
+    org_product = models.OrganizationProduct.objects.create(
+        org=org, product=billing_objects.product, component_object_id=1
+    )
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+    etag = response["ETag"]
+
+    snapshot = response.json()["data"][0]
+    assert snapshot["version"] == 1
+    assert snapshot["products"] == products + [
+        {
+            "name": billing_objects.product.name,
+            "component": None,
+            "component_object_id": 1,
+            "expires": None,
+            "data": billing_objects.product.data,
+        }
+    ]
+
+    # as does changing the product data
+    billing_objects.product.data = {"seats": 5}
+    billing_objects.product.save()
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["data"][0]["products"][-1]["data"] == {"seats": 5}
+    etag = response["ETag"]
+
+    # and removing the product
+    org_product.delete()
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["data"][0] == {
+        "org": org.slug,
+        "version": 3,
+        "products": products,
+    }
+
+    response = APIClient().get(url)
+    assert response.status_code in (401, 403)
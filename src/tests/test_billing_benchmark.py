@@ -0,0 +1,105 @@
+import io
+
+import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from account.models import Organization
+from billing.models import OrganizationProduct, SubscriptionCycle
+from billing.workload import generate_workload
+
+# max queries per subscription billing_cycles may make for the benchmark
+# workload, lower this as billing gets cheaper
+BILLING_CYCLES_QUERY_BUDGET = 220
+
+
+@pytest.mark.django_db
+def test_generate_workload():
+    workload = generate_workload(
+        orgs=3, subscriptions_per_org=2, metered_ratio=1, expired_per_org=2
+    )
+
+    assert len(workload.orgs) == 3
+    assert len(workload.subscriptions) == 6
+
+    for subscription in workload.subscriptions:
+        assert subscription.payment_method.processor == "simulated"
+        assert subscription.subscription_product_set.count() == 2
+        assert subscription.charge_type == "end"
+
+        # the only cycle has ended and is due to be charged
+        subscription_cycle = SubscriptionCycle.objects.get(subscription=subscription)
+        assert subscription_cycle.ended
+        assert not subscription_cycle.charged
+        assert subscription.subscription_cycle is None
+
+    assert (
+        OrganizationProduct.objects.filter(
+            product__in=workload.trial_products, expires__lt=timezone.now()
+        ).count()
+        == 6
+    )
+
+
+@pytest.mark.django_db
+def test_billing_benchmark():
+    out = io.StringIO()
+    call_command(
+        "billing_benchmark",
+        orgs=10,
+        query_budget=BILLING_CYCLES_QUERY_BUDGET,
+        stdout=out,
+    )
+    output = out.getvalue()
+
+    assert "generated 10 organizations with 10 subscriptions" in output
+    assert "billing_product_expiry: " in output
+    assert "billing_cycles: " in output
+    assert "declined: 0, rate limited: 0" in output
+
+    # the workload is rolled back
+    assert not Organization.objects.filter(slug__startswith="benchmark").exists()
+
+
+@pytest.mark.django_db
+def test_billing_benchmark_query_budget():
+    with pytest.raises(CommandError, match="Query budget exceeded"):
+        call_command("billing_benchmark", orgs=2, query_budget=1, stdout=io.StringIO())
+
+
+@pytest.mark.django_db
+def test_billing_benchmark_processor_failures():
+    out = io.StringIO()
+    call_command(
+        "billing_benchmark",
+        orgs=4,
+        processor_failure_rate=0.5,
+        processor_rate_limit_rate=0.5,
+        stdout=out,
+    )
+    output = out.getvalue()
+
+    # processor errors are logged by billing_cycles, the benchmark
+    # still reports its results
+    assert "rate limited: 1" in output
+    assert "billing_cycles: " in output
+
+
+@pytest.mark.django_db
+def test_billing_benchmark_errors(mocker):
+    # errors in the measured commands fail the benchmark
+    mocker.patch(
+        "billing.management.commands.billing_cycles.Command.run",
+        side_effect=ValueError("test"),
+    )
+    with pytest.raises(CommandError, match="billing_cycles errored"):
+        call_command("billing_benchmark", orgs=1, stdout=io.StringIO())
+
+    # as do errors that keep a command from being measured
+    mocker.patch(
+        "billing.management.commands.billing_benchmark.generate_workload",
+        side_effect=ValueError("test"),
+    )
+    with pytest.raises(CommandError, match="produced no result"):
+        call_command("billing_benchmark", orgs=1, stdout=io.StringIO())
@@ -0,0 +1,167 @@
+import datetime
+import io
+
+import dateutil.relativedelta
+import pytest
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from billing.forecast import Forecast
+from billing.models import (
+    Subscription,
+    SubscriptionCycle,
+    SubscriptionCycleProduct,
+    SubscriptionProduct,
+    SubscriptionProductModifier,
+)
+
+
+def month(months):
+    return dateutil.relativedelta.relativedelta(months=months)
+
+
+@pytest.mark.django_db
+def test_forecast_metered(billing_objects, django_assert_num_queries):
+    today = datetime.date.today()
+    subscription = billing_objects.monthly_subscription
+    subscription_product = subscription.subscription_product_set.get()
+
+    # three ended cycles with growing usage and the current cycle
+    start = today - datetime.timedelta(days=10)
+    for i, usage in enumerate([100, 200, 300]):
+        cycle = SubscriptionCycle.objects.create(
+            subscription=subscription,
+            start=start - month(3 - i),
+            end=start - month(2 - i),
+        )
+        SubscriptionCycleProduct.objects.create(
+            subscription_cycle=cycle,
+            subscription_product=subscription_product,
+            usage=usage,
+        )
+
+    current_cycle = SubscriptionCycle.objects.create(
+        subscription=subscription, start=start, end=start + month(1)
+    )
+
+    SubscriptionProductModifier.objects.create(
+        subscription_product=subscription_product,
+        type="reduction_p",
+        value=10,
+        valid=timezone.now() + datetime.timedelta(days=35),
+        source="test",
+    )
+    SubscriptionProductModifier.objects.create(
+        subscription_product=subscription_product,
+        type="reduction",
+        value=5,
+        valid=timezone.now() + datetime.timedelta(days=365),
+        source="test",
+    )
+
+    # subscriptions, cycles, products, modifiers and usage history
+    with django_assert_num_queries(5):
+        forecast = Forecast(
+            months=3, queryset=Subscription.objects.filter(id=subscription.id)
+        )
+
+    assert forecast.subscriptions == 1
+
+    # usage trends up by 100 per cycle, the current cycle is charged at
+    # its end with both modifiers applied: 400 * 0.5 - 10% - 5
+    current, following, last = forecast.periods
+    assert current.usage == 400
+    assert current.revenue == pytest.approx(175)
+    assert current.charges == 1
+
+    # the percentage reduction is no longer valid when the next cycle is
+    # charged: 500 * 0.5 - 5
+    assert following.usage == 500
+    assert following.revenue == pytest.approx(245)
+
+    assert last.revenue == pytest.approx(295)
+    assert forecast.revenue == pytest.approx(175 + 245 + 295)
+
+    # same price as the cycle product would be charged
+    cycle_product = SubscriptionCycleProduct.objects.create(
+        subscription_cycle=current_cycle,
+        subscription_product=subscription_product,
+        usage=400,
+    )
+    assert cycle_product.price == pytest.approx(current.revenue)
+
+    assert [expiry.kind for expiry in forecast.expiries] == ["modifier"]
+    assert forecast.expiries[0].description == (
+        "reduction_p 10 on test.subscription.metered"
+    )
+
+
+@pytest.mark.django_db
+def test_forecast_fixed(billing_objects):
+    today = datetime.date.today()
+    subscription = billing_objects.yearly_subscription
+    subscription.subscription_product_set.all().delete()
+    subscription.add_product(billing_objects.product_subscription_fixed)
+
+    trial = SubscriptionProduct.objects.create(
+        subscription=subscription,
+        product=billing_objects.product_subscription_metered,
+        expires=timezone.now() + datetime.timedelta(days=20),
+    )
+    trial.product.recurring_product.type = "fixed"
+    trial.product.recurring_product.save()
+
+    SubscriptionCycle.objects.create(
+        subscription=subscription,
+        start=today - month(1),
+        end=today - month(1) + dateutil.relativedelta.relativedelta(years=1),
+    )
+
+    forecast = Forecast(
+        months=12, queryset=Subscription.objects.filter(id=subscription.id)
+    )
+
+    # charged at the start of the cycle 11 months from now, the expiring
+    # product is no longer charged by then
+    charged = [period for period in forecast.periods if period.charges]
+    assert len(charged) == 1
+    assert charged[0].start == today + month(11)
+    assert charged[0].revenue == pytest.approx(125.99)
+
+    # yearly cycles are normalized to monthly recurring revenue
+    assert forecast.periods[0].mrr == pytest.approx((125.99 + 0.5) / 12)
+    assert forecast.periods[-1].mrr == pytest.approx(125.99 / 12)
+
+    assert [(expiry.kind, expiry.description) for expiry in forecast.expiries] == [
+        ("product", "test.subscription.metered")
+    ]
+
+
+@pytest.mark.django_db
+def test_billing_forecast_command(billing_objects):
+    out = io.StringIO()
+    call_command("billing_forecast", months=2, org=billing_objects.org.slug, stdout=out)
+    output = out.getvalue()
+
+    assert "forecast for 2 subscriptions" in output
+    assert datetime.date.today().isoformat() in output
+    assert "total" in output
+
+
+@pytest.mark.django_db
+def test_billing_forecast_admin(billing_objects, client):
+    admin_user = get_user_model().objects.create_superuser(
+        username="forecast_admin", email="forecast_admin@localhost", password="test"
+    )
+    client.force_login(admin_user)
+
+    response = client.get(reverse("admin:billing_subscription_changelist"))
+    assert response.status_code == 200
+    assert reverse("admin:billing_subscription_forecast") in response.content.decode()
+
+    response = client.get(reverse("admin:billing_subscription_forecast"), {"months": 3})
+    assert response.status_code == 200
+    assert len(response.context["forecast"].periods) == 3
+    assert "Revenue forecast" in response.content.decode()
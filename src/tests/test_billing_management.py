@@ -6,8 +6,15 @@ from unittest.mock import patch
 
 import pytest
 from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 
+from applications.models import Service
+from billing.management.commands.billing_cycles import lock_subscription
+from billing.usage import ingest_usage
+
 STRIPE_CARD_ERROR = "CardError(message='The zip code you supplied failed validation.', param='address_zip', code='incorrect_zip', http_status=402, request_id='req_nVPxvQvGIjDtHe')"
 
 
@@ -227,3 +234,406 @@ def test_billing_cycle_critical_errors(billing_objects_w_pay, mock_stripe):
 
             # assert that next time will not retry charge
             assert_no_retrying_charge()
+
+
+@pytest.mark.django_db
+def test_billing_cycles_shards(billing_objects, mock_stripe):
+    """
+    Test that subscriptions are only progressed by the shard
+    their organization belongs to
+    """
+
+    shards = 2
+    own_shard = billing_objects.org.id % shards
+    other_shard = (own_shard + 1) % shards
+
+    call_command("billing_cycles", commit=True, shards=shards, shard_index=other_shard)
+    assert billing_objects.monthly_subscription.subscription_cycle is None
+
+    call_command("billing_cycles", commit=True, shards=shards, shard_index=own_shard)
+    assert billing_objects.monthly_subscription.subscription_cycle is not None
+
+
+@pytest.mark.django_db
+def test_billing_cycles_invalid_shard_index(billing_objects):
+    """
+    Test that shard index needs to be within the shard count
+    """
+
+    with pytest.raises(CommandError):
+        call_command("billing_cycles", shards=2, shard_index=2)
+
+    with pytest.raises(CommandError):
+        call_command("billing_cycles", workers=0)
+
+
+def held_advisory_locks():
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT count(*) FROM pg_locks WHERE locktype = 'advisory' AND pid = pg_backend_pid()"
+        )
+        return cursor.fetchone()[0]
+
+
+@pytest.mark.django_db
+def test_billing_cycles_lock_subscription(billing_objects):
+    """
+    Test that subscription locks are released once the subscription is
+    progressed, even inside an open transaction (pretend mode)
+    """
+
+    if connection.vendor != "postgresql":
+        pytest.skip("advisory locks need postgresql")
+
+    for subscription in [
+        billing_objects.monthly_subscription,
+        billing_objects.yearly_subscription,
+    ]:
+        with lock_subscription(subscription) as locked:
+            assert locked
+            assert held_advisory_locks() == 1
+
+    assert held_advisory_locks() == 0
+
+
+@pytest.mark.django_db
+def test_billing_cycles_progress_shard_errors(billing_objects_w_pay, mock_stripe):
+    """
+    Test that a pool worker returns its critical errors so they
+    can be merged into the report of the parent process
+    """
+
+    from billing.management.commands.billing_cycles import progress_shard
+
+    call_command("billing_cycles", commit=True)
+
+    billing_cycle = billing_objects_w_pay.monthly_subscription.subscription_cycle
+    billing_cycle.start = billing_cycle.start - timezone.timedelta(days=32)
+    billing_cycle.end = billing_cycle.end - timezone.timedelta(days=32)
+    billing_cycle.save()
+
+    with patch("billing.models.PaymentCharge.sync_status") as mock_sync_status:
+        mock_sync_status.side_effect = Exception("Critical error")
+        result = progress_shard(1, 0, True)
+
+    assert result["shard_index"] == 0
+    assert "-- charging " in result["output"]
+
+    subscription_cycle_id, subscription_id, tb = result["errors"][0]
+
+    assert subscription_cycle_id == billing_cycle.id
+    assert subscription_id == billing_objects_w_pay.monthly_subscription.id
+    assert "Critical error" in tb
+
+
+@pytest.mark.django_db
+def test_billing_cycles_skip_idle_subscriptions(billing_objects, mock_stripe):
+    """
+    Test that subscriptions without due billing work are not progressed
+    unless --all is passed
+    """
+
+    call_command("billing_cycles", commit=True)
+
+    subscription = billing_objects.monthly_subscription
+    subscription.refresh_from_db()
+
+    assert subscription.next_action_at.date() == subscription.subscription_cycle.end
+
+    out = io.StringIO()
+    call_command("billing_cycles", commit=True, stdout=out)
+    assert f"checking subscription {subscription} ({subscription.id})" not in (
+        out.getvalue()
+    )
+
+    out = io.StringIO()
+    call_command("billing_cycles", commit=True, all=True, stdout=out)
+    assert f"checking subscription {subscription} ({subscription.id})" in (
+        out.getvalue()
+    )
+
+
+@pytest.mark.django_db
+def test_billing_cycles_charge_metered_after_skipped_period(
+    billing_objects_w_pay, mock_stripe
+):
+    """
+    Test that the usage of a metered cycle is collected before it is
+    charged, even though the subscription was skipped while the cycle ran
+    """
+
+    service = Service.objects.create(
+        slug="usage", name="usage", api_url="https://usage.localhost"
+    )
+    billing_objects_w_pay.product_subscription_metered.component = service
+    billing_objects_w_pay.product_subscription_metered.save()
+
+    subscription = billing_objects_w_pay.monthly_subscription
+
+    with patch("billing.usage.UsageCollector.prefetch", return_value=0), patch(
+        "billing.usage.UsageCollector.usage", return_value=0
+    ):
+        call_command("billing_cycles", commit=True)
+
+    billing_cycle = subscription.subscription_cycle
+
+    # the cycle ran its course without the subscription being progressed
+    billing_cycle.start = billing_cycle.start - timezone.timedelta(days=32)
+    billing_cycle.end = billing_cycle.end - timezone.timedelta(days=32)
+    billing_cycle.save()
+
+    with patch("billing.usage.UsageCollector.prefetch", return_value=0), patch(
+        "billing.usage.UsageCollector.usage", return_value=100
+    ):
+        call_command("billing_cycles", commit=True)
+
+    cycle_product = billing_cycle.subscription_cycle_product_set.get(
+        subscription_product__product=billing_objects_w_pay.product_subscription_metered
+    )
+    assert cycle_product.usage == 100
+
+    assert billing_cycle.charged
+
+    payment_charge = billing_cycle.subscription_cycle_charge_set.first().payment_charge
+    assert float(payment_charge.price) == billing_cycle.price
+    assert float(payment_charge.price) > 125.99
+
+
+@pytest.mark.django_db
+def test_billing_cycles_charge_pushed_usage(billing_objects_w_pay, mock_stripe):
+    """
+    Test that an ended metered cycle is charged with the usage pushed for it
+    """
+
+    service = Service.objects.create(
+        slug="usage", name="usage", api_url="https://usage.localhost"
+    )
+    billing_objects_w_pay.product_subscription_metered.component = service
+    billing_objects_w_pay.product_subscription_metered.save()
+
+    subscription = billing_objects_w_pay.monthly_subscription
+    subscription.start_subscription_cycle()
+    billing_cycle = subscription.subscription_cycle
+
+    ingest_usage(
+        service,
+        [
+            {
+                "org": billing_objects_w_pay.org.slug,
+                "product": "test.subscription.metered",
+                "units": 40,
+            }
+        ],
+    )
+
+    billing_cycle.start = billing_cycle.start - timezone.timedelta(days=32)
+    billing_cycle.end = billing_cycle.end - timezone.timedelta(days=32)
+    billing_cycle.save()
+
+    with patch("billing.usage.UsageCollector.prefetch", return_value=0), patch(
+        "billing.usage.UsageCollector.usage", return_value=0
+    ):
+        call_command("billing_cycles", commit=True)
+
+    cycle_product = billing_cycle.subscription_cycle_product_set.get(
+        subscription_product__product=billing_objects_w_pay.product_subscription_metered
+    )
+    assert cycle_product.usage == 40
+    assert billing_cycle.charged
+
+
+@pytest.mark.django_db
+def test_billing_cycles_reconcile_pending_charges(billing_objects_w_pay, mock_stripe):
+    """
+    Test that pending charges are reconciled with stripe in batch
+    """
+
+    payment_intent = dict(mock_stripe["stripe.PaymentIntent.retrieve"].return_value)
+    mock_stripe["stripe.PaymentIntent.retrieve"].return_value = dict(
+        payment_intent, status="processing"
+    )
+
+    result = run_billing_cycle_with_cutover(billing_objects_w_pay)
+
+    cycle_charge = result["billing_cycle"].subscription_cycle_charge_set.first()
+    payment_charge = cycle_charge.payment_charge
+    assert payment_charge.status == "pending"
+
+    mock_stripe["stripe.PaymentIntent.retrieve"].reset_mock()
+    mock_stripe["stripe.Charge.retrieve"].reset_mock()
+
+    with patch(
+        "billing.payment_processors.stripe.stripe.PaymentIntent.list",
+        return_value={
+            "data": [
+                dict(
+                    payment_intent,
+                    latest_charge={"id": "ch_1", "receipt_url": "receipt_url"},
+                )
+            ],
+            "has_more": False,
+        },
+    ) as list_payment_intents:
+        out = io.StringIO()
+        call_command("billing_cycles", commit=True, stdout=out)
+
+    assert list_payment_intents.call_count == 1
+    assert not mock_stripe["stripe.PaymentIntent.retrieve"].called
+    assert not mock_stripe["stripe.Charge.retrieve"].called
+    assert "-- syncing pending subscription cycle charge" not in out.getvalue()
+
+    payment_charge.refresh_from_db()
+    cycle_charge.refresh_from_db()
+
+    assert payment_charge.status == "ok"
+    assert payment_charge.data["receipt_url"] == "receipt_url"
+    assert cycle_charge.status == "ok"
+    assert payment_charge.payment_transaction
+
+
+@pytest.mark.django_db
+def test_billing_cycles_billing_run(billing_objects, mock_stripe):
+    """
+    Test that billing runs record per-subscription progress and phase
+    durations
+    """
+
+    from billing.models import BillingRun
+
+    call_command("billing_cycles", commit=True)
+
+    billing_run = BillingRun.objects.get()
+
+    assert billing_run.status == "completed"
+    assert billing_run.finished
+
+    for phase in ["expiry", "usage", "charge", "pending_sync", "invoice_sync"]:
+        assert phase in billing_run.phases
+
+    assert {row.subscription for row in billing_run.subscription_set.all()} == {
+        billing_objects.monthly_subscription,
+        billing_objects.yearly_subscription,
+    }
+
+
+@pytest.mark.django_db(transaction=True)
+def test_billing_cycles_resume(billing_objects, mock_stripe):
+    """
+    Test that an interrupted billing run keeps the progress of the
+    subscriptions it finished and can be resumed
+    """
+
+    from billing.management.commands.billing_cycles import Command
+    from billing.models import BillingRun
+
+    monthly = billing_objects.monthly_subscription
+    yearly = billing_objects.yearly_subscription
+
+    with patch.object(
+        Command, "sync_pending_charges", side_effect=[None, Exception("interrupted")]
+    ):
+        call_command("billing_cycles", commit=True)
+
+    billing_run = BillingRun.objects.get()
+
+    assert billing_run.status == "failed"
+    assert [row.subscription for row in billing_run.subscription_set.all()] == [monthly]
+
+    # work done for the finished subscription was committed
+    assert monthly.subscription_cycle is not None
+    assert yearly.subscription_cycle is None
+
+    out = io.StringIO()
+    call_command(
+        "billing_cycles", commit=True, all=True, resume=billing_run.id, stdout=out
+    )
+
+    assert f"checking subscription {monthly} ({monthly.id})" not in out.getvalue()
+    assert f"checking subscription {yearly} ({yearly.id})" in out.getvalue()
+
+    billing_run.refresh_from_db()
+
+    assert billing_run.status == "completed"
+    assert billing_run.subscription_set.count() == 2
+    assert yearly.subscription_cycle is not None
+    assert BillingRun.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_billing_cycles_resume_invalid(billing_objects):
+    with pytest.raises(CommandError):
+        call_command("billing_cycles", resume=1234)
+
+
+@pytest.mark.django_db
+def test_billing_cycles_product_expiry(billing_objects):
+    """
+    Test that expired organization products are removed and replaced
+    """
+
+    from account.models import Organization
+    from billing.models import OrganizationProduct, Product
+
+    trial = Product.objects.create(
+        name="test.trial",
+        group=billing_objects.product_group,
+        expiry_replacement_product=billing_objects.product,
+    )
+
+    orgs = [
+        Organization.objects.create(name=f"Trial Org {i}", slug=f"trial_org_{i}")
+        for i in range(3)
+    ]
+
+    for org in orgs:
+        OrganizationProduct.objects.create(
+            org=org,
+            product=trial,
+            expires=timezone.now() - timezone.timedelta(days=1),
+        )
+
+    with CaptureQueriesContext(connection) as ctx:
+        call_command("billing_cycles", commit=True)
+
+    # expired products are read along with their product, replacement
+    # product and organization
+    (expiry_query,) = [
+        query["sql"]
+        for query in ctx.captured_queries
+        if query["sql"].startswith("SELECT")
+        and 'FROM "billing_org_product"' in query["sql"]
+        and '"billing_org_product"."expires" <' in query["sql"]
+    ]
+    assert 'JOIN "billing_product"' in expiry_query
+    assert 'JOIN "account_organization"' in expiry_query
+
+    assert not OrganizationProduct.objects.filter(product=trial).exists()
+
+    for org in orgs:
+        assert org.products.filter(product=billing_objects.product).exists()
+
+
+@pytest.mark.django_db
+def test_billing_account_summary(billing_objects, ledger):
+    """
+    Test that account summaries are rebuilt from the ledger
+    """
+
+    from billing.models import AccountSummary
+
+    org = billing_objects.org
+    summary = AccountSummary.objects.get(org=org)
+    expected = (summary.invoiced, summary.withdrawn, summary.balance)
+
+    summary.balance = 0
+    summary.withdrawn = 0
+    summary.save()
+
+    out = io.StringIO()
+    call_command("billing_account_summary", org=org.slug, commit=True, stdout=out)
+
+    assert f"{summary}: balance 0.00 -> {expected[2]}" in out.getvalue()
+    assert "rebuilt 1 account summaries" in out.getvalue()
+
+    summary = AccountSummary.objects.get(org=org)
+    assert (summary.invoiced, summary.withdrawn, summary.balance) == expected
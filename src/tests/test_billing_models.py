@@ -1,16 +1,30 @@
 import uuid
 from datetime import datetime, timedelta, timezone
+from decimal import Decimal
 
 import pytest
 from django.contrib.contenttypes.models import ContentType
+from django.db import connection
 from django.db.models import ProtectedError
+from django.test.utils import CaptureQueriesContext
 
+from applications.models import Service
 from billing.models import (
+    AccountSummary,
+    Deposit,
+    Invoice,
     InvoiceLine,
     Ledger,
+    Order,
     OrderHistory,
     OrderLine,
+    OrganizationProduct,
+    OrganizationProductHistory,
     Payment,
+    PaymentCharge,
+    Product,
+    ProductEligibility,
+    Subscription,
     SubscriptionCycle,
     SubscriptionCycleProduct,
     SubscriptionProduct,
@@ -97,6 +111,122 @@ def test_subscription_cycle(db, billing_objects):
     assert SubscriptionCycle.objects.count() == 2
 
 
+def test_subscription_next_action_at(db, billing_objects):
+    """
+    Test that the subscription's next billing action is maintained
+    as cycles are started
+    """
+    subscription = billing_objects.monthly_subscription
+    subscription.refresh_from_db()
+
+    # no cycle yet, due now
+    assert subscription.next_action_at <= datetime.now(timezone.utc)
+
+    subscription.start_subscription_cycle()
+    subscription.refresh_from_db()
+
+    # metered subscription, next action is the end of the cycle
+    assert subscription.next_action_at.date() == subscription.subscription_cycle.end
+
+    # adding a fixed price product makes the open cycle due to be charged
+    subscription.add_product(billing_objects.product_subscription_fixed)
+    subscription.refresh_from_db()
+
+    assert subscription.charge_type == "end"
+    assert subscription.next_action_at.date() == subscription.subscription_cycle.end
+
+    # ending the cycle prematurely makes it due
+    subscription_cycle = subscription.subscription_cycle
+    subscription_cycle.end = datetime.now(timezone.utc).date()
+    subscription_cycle.save()
+    subscription.refresh_from_db()
+
+    assert subscription.next_action_at <= datetime.now(timezone.utc)
+
+
+def test_subscription_defer_next_action(db, billing_objects):
+    """
+    Test that next action updates are deferred to the end of the block
+    """
+    subscription = billing_objects.monthly_subscription
+    subscription.start_subscription_cycle()
+    subscription.refresh_from_db()
+    next_action_at = subscription.next_action_at
+
+    with subscription.defer_next_action():
+        subscription_cycle = subscription.subscription_cycle
+        subscription_cycle.end = datetime.now(timezone.utc).date()
+        subscription_cycle.save()
+
+        assert (
+            Subscription.objects.get(id=subscription.id).next_action_at
+            == next_action_at
+        )
+
+    subscription.refresh_from_db()
+    assert subscription.next_action_at <= datetime.now(timezone.utc)
+
+
+def test_subscription_billing_cache(db, billing_objects, django_assert_num_queries):
+    """
+    Test that the current cycle and charge type are memoized and reset
+    when cycles or products change
+    """
+    billing_objects.yearly_subscription.start_subscription_cycle()
+    subscription = Subscription.objects.get(id=billing_objects.yearly_subscription.id)
+
+    with django_assert_num_queries(2):
+        subscription_cycle = subscription.subscription_cycle
+        assert subscription.subscription_cycle == subscription_cycle
+        assert subscription.charge_type == "end"
+        assert subscription.charge_type == "end"
+
+    # cycle changes reset the memoized cycle
+    subscription_cycle.end = datetime.now(timezone.utc).date()
+    subscription_cycle.save()
+    assert subscription.subscription_cycle is None
+
+    subscription_cycle = subscription.start_subscription_cycle()
+    assert subscription.subscription_cycle == subscription_cycle
+
+    # removing the metered product changes the charge type
+    subscription.subscription_product_set.get().delete()
+    assert subscription.charge_type == "start"
+
+    subscription_cycle.delete()
+    assert subscription.subscription_cycle is None
+
+
+def test_subscription_billing_state(db, billing_objects, django_assert_num_queries):
+    """
+    Test that the current cycle and charge type of many subscriptions
+    are resolved in a fixed number of queries
+    """
+    billing_objects.monthly_subscription.start_subscription_cycle()
+    billing_objects.yearly_subscription.start_subscription_cycle()
+
+    fixed = Subscription.objects.create(
+        org=billing_objects.org, group=billing_objects.other_product_group
+    )
+
+    with django_assert_num_queries(2):
+        subscriptions = {
+            subscription.id: subscription
+            for subscription in Subscription.objects.billing_state()
+        }
+        for subscription in subscriptions.values():
+            subscription.subscription_cycle
+            subscription.charge_type
+
+    assert (
+        subscriptions[billing_objects.monthly_subscription.id].subscription_cycle
+        == billing_objects.monthly_subscription.subscription_cycle
+    )
+    assert subscriptions[billing_objects.yearly_subscription.id].charge_type == "end"
+    assert subscriptions[fixed.id].subscription_cycle is None
+    assert subscriptions[fixed.id].charge_type == "start"
+
+
 def test_end_subscription_cycle(db, billing_objects, mocker):
     # Overrides creating the charge on Stripe's end.
     mocker.patch(
@@ -111,10 +241,15 @@ def test_end_subscription_cycle(db, billing_objects, mocker):
     subscription.payment_method = billing_objects.payment_method
     subscription.save()
 
-    # FIXME - This doesn't seem to be the test we want
-    # but currently there is no way to force end a subscription_cycle (?)
-    with pytest.raises(OSError):
-        subscription.end_subscription_cycle()
+    subscription_cycle = subscription.subscription_cycle
+    subscription.end_subscription_cycle()
+
+    # the cycle is ended today and a new one is started
+    subscription_cycle.refresh_from_db()
+    assert subscription_cycle.end == datetime.now(timezone.utc).date()
+
+    assert subscription.subscription_cycle != subscription_cycle
+    assert subscription.subscription_cycle.start == subscription_cycle.end
 
 
 def test_subscription_cycle_charge(db, billing_objects, mocker):
@@ -228,6 +363,63 @@ def test_calc_subscription_charge(db, billing_objects):
     """
 
 
+def test_subscription_cycle_pricing(db, billing_objects, django_assert_num_queries):
+    """
+    Test that cycle pricing loads the pricing graph in a fixed number
+    of queries and matches the per-product prices
+    """
+
+    subscription = billing_objects.monthly_subscription
+    two_months_ago = (datetime.now(timezone.utc) - timedelta(days=60)).date()
+    subscription_cycle = subscription.start_subscription_cycle(two_months_ago)
+
+    subscription.add_product(billing_objects.product_subscription_fixed)
+
+    valid = datetime.now(timezone.utc) + timedelta(days=30)
+    expired = datetime.now(timezone.utc) - timedelta(days=1)
+
+    metered = billing_objects.product_subscription_metered.subscription_set.get(
+        subscription=subscription
+    )
+    fixed = billing_objects.product_subscription_fixed.subscription_set.get(
+        subscription=subscription
+    )
+
+    for type, value in [("quantity", 10), ("reduction", 5), ("reduction_p", 50)]:
+        metered.modifier_set.create(type=type, value=value, valid=valid, source="test")
+
+    fixed.modifier_set.create(type="reduction", value=25, valid=valid, source="test")
+
+    # expired modifiers are ignored
+    fixed.modifier_set.create(type="free", value=0, valid=expired, source="test")
+
+    subscription_cycle.update_usage(metered, 50)
+    subscription_cycle.update_usage(fixed, None)
+
+    expected = {
+        cycle_product.id: cycle_product.price
+        for cycle_product in subscription_cycle.subscription_cycle_product_set.all()
+    }
+    assert len(expected) == 2
+
+    with django_assert_num_queries(2):
+        pricing = subscription_cycle.pricing()
+
+    assert {
+        cycle_product.id: price for cycle_product, price in pricing.lines
+    } == expected
+    assert pricing.total == sum(float(price) for price in expected.values())
+    # metered: ((50 - 10) * 0.5 - 5) * 0.5, fixed: 125.99 - 25
+    assert pricing.total == pytest.approx(7.5 + 100.99)
+
+    cycle = SubscriptionCycle.objects.prefetch_related(
+        SubscriptionCycle.pricing_prefetch()
+    ).get(id=subscription_cycle.id)
+
+    with django_assert_num_queries(0):
+        assert cycle.price == pricing.total
+
+
 def test_order_history(db, billing_objects, mocker):
     mocker.patch(
         "billing.payment_processors.stripe.stripe.PaymentIntent.create",
@@ -272,6 +464,262 @@ def test_create_transactions_from_subscription_cycle(charge_objects, billing_obj
     )
 
 
+@pytest.mark.django_db
+def test_create_transactions_ledger(charge_objects, billing_objects):
+    """
+    Order and invoice lines for a subscription cycle are created in bulk,
+    ledger entries need to match the ones created when saving individually
+    """
+
+    subscription_cycle = charge_objects["subscription_cycle"]
+
+    lines = list(
+        OrderLine.objects.filter(order__org=billing_objects.org).order_by("id")
+    ) + list(
+        InvoiceLine.objects.filter(invoice__org=billing_objects.org).order_by("id")
+    )
+
+    assert len(lines) == 2 * subscription_cycle.subscription_cycle_product_set.count()
+
+    for line in lines:
+        entry = Ledger.objects.get(
+            content_type=ContentType.objects.get_for_model(line), object_id=line.id
+        )
+        assert entry.org == billing_objects.org
+        assert entry.order_number == line.order_number
+        assert entry.invoice_number == getattr(line, "invoice_number", None)
+
+    assert float(
+        sum(line.amount for line in lines if isinstance(line, OrderLine))
+    ) == pytest.approx(subscription_cycle.price)
+
+
+@pytest.mark.django_db
+def test_account_summary(charge_objects, billing_objects):
+    """
+    Account summaries are updated along with each transaction, both when
+    created in bulk (subscription cycle orders and invoices) and one by one
+    """
+
+    subscription_cycle = charge_objects["subscription_cycle"]
+    org = billing_objects.org
+
+    summary = AccountSummary.objects.get(org=org, currency="USD")
+    price = subscription_cycle.price
+    assert float(summary.ordered) == pytest.approx(price)
+    assert float(summary.invoiced) == pytest.approx(price)
+    assert float(summary.balance) == pytest.approx(-price)
+    assert float(summary.outstanding) == pytest.approx(price)
+    assert summary.transactions == Ledger.objects.filter(org=org).count()
+
+    payment = Payment.objects.create(
+        org=org, amount=10, billing_contact=billing_objects.billing_contact
+    )
+    Deposit.objects.create(org=org, amount=5.555)
+    Withdrawal.objects.create(org=org, amount=2)
+
+    summary.refresh_from_db()
+    assert summary.paid == 10
+    assert str(summary.deposited) == "5.56"
+    assert summary.withdrawn == 2
+    assert float(summary.balance) == pytest.approx(-price + 10 + 5.56 - 2)
+    assert summary.last_payment == payment.created
+    assert summary.transactions == Ledger.objects.filter(org=org).count()
+
+    # the summary computed from the ledger matches
+    computed = AccountSummary.compute(org)[(org.id, "USD")]
+    for field in ["ordered", "invoiced", "paid", "deposited", "withdrawn", "balance"]:
+        assert getattr(computed, field) == getattr(summary, field)
+    assert computed.transactions == summary.transactions
+    assert computed.last_payment == summary.last_payment
+
+
+@pytest.mark.django_db
+def test_account_summary_locks(billing_objects):
+    """
+    Transactions are applied under shared summary locks, rebuilds lock
+    the summaries of the organization exclusively
+    """
+
+    if connection.vendor != "postgresql":
+        pytest.skip("advisory locks need postgresql")
+
+    org = billing_objects.org
+
+    def summary_locks():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT objid, mode FROM pg_locks WHERE locktype = 'advisory' "
+                "AND classid = %s AND pid = pg_backend_pid()",
+                [AccountSummary.lock_namespace],
+            )
+            return set(cursor.fetchall())
+
+    # transaction level locks are held until the test transaction ends
+    Deposit.objects.create(org=org, amount=5)
+    assert {(0, "ShareLock"), (org.id, "ShareLock")} <= summary_locks()
+
+    AccountSummary.rebuild(org)
+    assert (org.id, "ExclusiveLock") in summary_locks()
+    assert AccountSummary.objects.get(org=org, currency="USD").deposited == 5
+
+
+@pytest.mark.django_db
+def test_money_totals(charge_objects, billing_objects, django_assert_num_queries):
+    """
+    Prices, payment dates and invoice / order numbers annotated by the
+    querysets match the model properties, in a single query
+    """
+
+    org = billing_objects.org
+
+    for i in range(3):
+        order = Order.objects.create(org=org)
+        invoice = Invoice.objects.create(org=org, order=order)
+        for _ in range(3):
+            OrderLine.objects.create(order=order, amount="0.10", currency="EUR")
+            InvoiceLine.objects.create(invoice=invoice, amount="0.10", currency="EUR")
+
+    Payment.objects.create(
+        org=org, amount="0.30", invoice_number=invoice.invoice_number
+    )
+
+    PaymentCharge.objects.create(
+        payment_method=billing_objects.payment_method, price=10, description="Other"
+    )
+
+    with django_assert_num_queries(1):
+        invoices = [
+            (invoice.price, invoice.currency, invoice.paid)
+            for invoice in Invoice.objects.totals().order_by("id")
+        ]
+
+    assert invoices == [
+        (invoice.price, invoice.currency, invoice.paid)
+        for invoice in Invoice.objects.order_by("id")
+    ]
+    assert invoices[-1][0] == Decimal("0.30")
+    assert invoices[-1][2] is not None
+    assert invoices[-2][2] is None
+
+    with django_assert_num_queries(1):
+        orders = [order.price for order in Order.objects.totals().order_by("id")]
+
+    assert orders == [order.price for order in Order.objects.order_by("id")]
+    assert orders[-1] == Decimal("0.30")
+
+    with django_assert_num_queries(1):
+        charges = [
+            (charge.invoice_number, charge.order_number)
+            for charge in PaymentCharge.objects.references().order_by("id")
+        ]
+
+    cycle_charge = charge_objects["payment_charge"]
+    assert charges == [
+        (cycle_charge.invoice_number, cycle_charge.order_number),
+        (None, None),
+    ]
+    assert charges[0][0] is not None
+
+    # only the invoice lines are queried for the charge details
+    details = cycle_charge.details
+    charge = PaymentCharge.objects.references().get(id=cycle_charge.id)
+    with django_assert_num_queries(1):
+        assert charge.details == details
+
+
+@pytest.mark.django_db
+def test_product_eligibility(billing_objects, django_assert_num_queries):
+    org = billing_objects.org
+    product = billing_objects.product
+
+    trial = Product.objects.create(name="test.trial", description="trial")
+    billing_objects.product_subscription_fixed.trial_product = trial
+    billing_objects.product_subscription_fixed.save()
+
+    renewable = Product.objects.create(
+        name="test.renewable", description="renewable", renewable=30
+    )
+    never = Product.objects.create(name="test.never", description="never", renewable=-1)
+    component = Product.objects.create(
+        name="test.component",
+        description="component",
+        component_billable_entity="ix",
+    )
+
+    products = [product, trial, renewable, never, component]
+
+    # the org has the product the trial is for, for component object 1
+    OrganizationProduct.objects.create(
+        org=org,
+        product=billing_objects.product_subscription_fixed,
+        component_object_id=1,
+    )
+    OrganizationProduct.objects.create(org=org, product=product)
+    for other in (renewable, never):
+        OrganizationProductHistory.objects.create(org=org, product=other)
+
+    with django_assert_num_queries(2):
+        eligibility = ProductEligibility(org, products)
+
+    with django_assert_num_queries(0):
+        assert not eligibility.can_add(product)
+        assert eligibility.can_add(trial)
+        assert not eligibility.can_add(trial, component_object_id=1)
+        assert not eligibility.can_add(renewable)
+        assert not eligibility.can_add(never)
+        assert not eligibility.can_add(component)
+        assert eligibility.can_add(component, component_object_id="2")
+
+    # same answers as checking the products one by one
+    for other in products:
+        for component_object_id in (None, 1, 2):
+            assert other.can_add_to_org(
+                org, component_object_id=component_object_id
+            ) == eligibility.can_add(other, component_object_id=component_object_id)
+
+
+@pytest.mark.django_db
+def test_service_org_can_trial(billing_objects):
+    from django_aaactl.rest.serializers.service_bridge import Serializers
+
+    org = billing_objects.org
+
+    for i in range(5):
+        trial = Product.objects.create(name=f"test.trial.{i}", description="trial")
+        Service.objects.create(
+            slug=f"service{i}",
+            name=f"Service {i}",
+            service_url="https://localhost",
+            trial_product=trial,
+        )
+        if i % 2:
+            OrganizationProduct.objects.create(org=org, product=trial)
+
+    services = Service.objects.order_by("id").select_related("trial_product")
+
+    with CaptureQueriesContext(connection) as queries:
+        data = Serializers.service_application(
+            services, many=True, context={"org": org}
+        ).data
+
+    assert [service["org_can_trial"] for service in data] == [
+        True,
+        False,
+        True,
+        False,
+        True,
+    ]
+
+    # trial eligibility is checked once for all services
+    eligibility_queries = [
+        query
+        for query in queries.captured_queries
+        if "billing_org_product_history" in query["sql"]
+    ]
+    assert len(eligibility_queries) == 1
+
+
 @pytest.mark.django_db
 def test_create_transactions_from_product(billing_objects):
     product = billing_objects.product
@@ -1,7 +1,12 @@
+import datetime
+
 import pytest
 from django.conf import settings
+from django.utils import timezone
+from reversion.models import Version
 
 import billing.payment_processors as bpp
+import billing.payment_processors.simulated  # noqa: F401
 from billing import models
 
 
@@ -88,3 +93,280 @@ def test_stripe_sync_charge_success(billing_objects, mocker):
     )
     stripe.sync_charge(payment_charge)
     assert payment_charge.status == "ok"
+
+
+def stripe_list_page(data, has_more=False):
+    return {"object": "list", "data": data, "has_more": has_more}
+
+
+@pytest.mark.django_db
+def test_stripe_reconciliation_sync_charges(billing_objects, mocker):
+    payment_charges = [
+        models.PaymentCharge.objects.create(
+            payment_method=billing_objects.payment_method,
+            price=100,
+            description="Test payment",
+            status="pending",
+            data={"stripe_payment_intent": f"pi_{i}"},
+        )
+        for i in range(3)
+    ]
+
+    list_payment_intents = mocker.patch(
+        "billing.payment_processors.stripe.stripe.PaymentIntent.list",
+        side_effect=[
+            stripe_list_page(
+                [
+                    {"id": "pi_0", "status": "failed"},
+                    {"id": "pi_other", "status": "succeeded"},
+                ],
+                has_more=True,
+            ),
+            stripe_list_page(
+                [
+                    {"id": "pi_1", "status": "processing"},
+                    {"id": "pi_2", "status": "failed"},
+                ],
+                has_more=True,
+            ),
+        ],
+    )
+    retrieve = mocker.patch(
+        "billing.payment_processors.stripe.stripe.PaymentIntent.retrieve"
+    )
+
+    reconciliation = bpp.stripe.Reconciliation()
+    assert reconciliation.sync_charges(models.PaymentCharge.objects.all()) == 2
+
+    # paging stops once all payment intents are found
+    assert list_payment_intents.call_count == 2
+    assert reconciliation.requests == 2
+    assert list_payment_intents.call_args.kwargs["starting_after"] == "pi_other"
+    assert "customer" not in list_payment_intents.call_args.kwargs
+    assert not retrieve.called
+
+    assert reconciliation.reconciled_charges == {pc.id for pc in payment_charges}
+
+    for payment_charge in payment_charges:
+        payment_charge.refresh_from_db()
+
+    assert payment_charges[0].status == "failed"
+    assert payment_charges[1].status == "pending"
+    assert payment_charges[2].status == "failed"
+
+    # status changes are saved per charge, with their revisions
+    assert Version.objects.get_for_object(payment_charges[0]).exists()
+
+
+@pytest.mark.django_db
+def test_stripe_reconciliation_max_age(billing_objects, mocker):
+    payment_charges = [
+        models.PaymentCharge.objects.create(
+            payment_method=billing_objects.payment_method,
+            price=100,
+            description="Test payment",
+            status="pending",
+            data={"stripe_payment_intent": f"pi_{i}"},
+        )
+        for i in range(2)
+    ]
+
+    # old charges do not widen the listed window
+    models.PaymentCharge.objects.filter(id=payment_charges[0].id).update(
+        created=timezone.now() - datetime.timedelta(days=60)
+    )
+
+    list_payment_intents = mocker.patch(
+        "billing.payment_processors.stripe.stripe.PaymentIntent.list",
+        return_value=stripe_list_page(
+            [
+                {"id": "pi_0", "status": "failed"},
+                {"id": "pi_1", "status": "failed"},
+            ]
+        ),
+    )
+
+    reconciliation = bpp.stripe.Reconciliation()
+    assert reconciliation.sync_charges(models.PaymentCharge.objects.all()) == 1
+
+    created = list_payment_intents.call_args.kwargs["created"]["gte"]
+    assert created > (timezone.now() - reconciliation.max_age).timestamp()
+
+    # and are left to be synced individually
+    assert reconciliation.reconciled_charges == {payment_charges[1].id}
+
+
+@pytest.mark.django_db
+def test_stripe_reconciliation_customers(billing_objects, mocker):
+    customer = bpp.stripe.Stripe(
+        billing_objects.payment_method
+    ).billing_contact_customer
+    customer.data["stripe_customer"] = "cus_1"
+    customer.save()
+
+    payment_charge = models.PaymentCharge.objects.create(
+        payment_method=billing_objects.payment_method,
+        price=100,
+        description="Test payment",
+        status="pending",
+        data={"stripe_payment_intent": "pi_missing"},
+    )
+
+    list_payment_intents = mocker.patch(
+        "billing.payment_processors.stripe.stripe.PaymentIntent.list",
+        return_value=stripe_list_page([{"id": "pi_other", "status": "succeeded"}]),
+    )
+
+    reconciliation = bpp.stripe.Reconciliation()
+    assert reconciliation.sync_charges([payment_charge]) == 0
+
+    assert list_payment_intents.call_count == 1
+    kwargs = list_payment_intents.call_args.kwargs
+    assert kwargs["customer"] == "cus_1"
+    assert kwargs["created"]["gte"] < payment_charge.created.timestamp()
+
+    # unmatched charges are left to be synced individually
+    assert not reconciliation.reconciled_charges
+    payment_charge.refresh_from_db()
+    assert payment_charge.status == "pending"
+
+
+@pytest.mark.django_db
+def test_stripe_reconciliation_sync_invoices(billing_objects, mocker):
+    invoices = [
+        models.Invoice.objects.create(
+            org=billing_objects.org,
+            order=models.Order.objects.create(org=billing_objects.org),
+            data={"stripe_invoice": f"in_{i}"},
+        )
+        for i in range(2)
+    ]
+
+    list_invoices = mocker.patch(
+        "billing.payment_processors.stripe.stripe.Invoice.list",
+        return_value=stripe_list_page(
+            [
+                {"id": "in_0", "status": "uncollectible", "payment_intent": "pi_0"},
+                {"id": "in_1", "status": "open", "payment_intent": "pi_1"},
+            ]
+        ),
+    )
+    retrieve = mocker.patch("billing.payment_processors.stripe.stripe.Invoice.retrieve")
+
+    reconciliation = bpp.stripe.Reconciliation()
+    assert reconciliation.sync_invoices(models.Invoice.objects.all()) == 1
+
+    assert list_invoices.call_count == 1
+    assert list_invoices.call_args.kwargs["expand"] == ["data.charge"]
+    assert not retrieve.called
+
+    for invoice in invoices:
+        invoice.refresh_from_db()
+
+    assert invoices[0].status == "failed"
+    assert invoices[1].status == "pending"
+
+
+@pytest.fixture
+def simulated_payment_method(billing_objects, mocker):
+    bpp.simulated.Simulated.configure(seed=0)
+    mocker.patch.dict(bpp.PROCESSORS, {"simulated": bpp.simulated.Simulated})
+
+    payment_method = billing_objects.payment_method
+    payment_method.processor = "simulated"
+    payment_method.data = {}
+    payment_method.save()
+    payment_method.processor_instance.setup_billing()
+
+    return payment_method
+
+
+def simulated_charge(payment_method):
+    payment_charge = models.PaymentCharge.objects.create(
+        payment_method=payment_method,
+        price=100,
+        description="Test payment",
+    )
+    payment_method.processor_instance.charge(payment_charge)
+    return payment_charge
+
+
+@pytest.mark.django_db
+def test_simulated_processor_charge(simulated_payment_method):
+    assert bpp.processor.get_processor("simulated") == bpp.simulated.Simulated
+    assert simulated_payment_method.data["stripe_payment_method"]
+
+    ledger = bpp.simulated.Simulated.configure(settle_after=2)
+    processor = simulated_payment_method.processor_instance
+
+    payment_charge = simulated_charge(simulated_payment_method)
+    assert payment_charge.status == "pending"
+
+    payment_intent = ledger.payment_intents[payment_charge.data["processor_txn_id"]]
+    assert payment_intent["amount"] == 10000
+    assert payment_intent["status"] == "processing"
+
+    # pending for `settle_after` syncs, settled on the next one
+    assert processor.sync_charge(payment_charge) is None
+    assert processor.sync_charge(payment_charge) is None
+    assert processor.sync_charge(payment_charge) == "ok"
+
+    assert payment_charge.status == "ok"
+    assert payment_charge.data["receipt_url"] == payment_intent["receipt_url"]
+    assert ledger.requests_for("charge") == 1
+    assert ledger.requests_for("sync_charge") == 3
+
+
+@pytest.mark.django_db
+def test_simulated_processor_failures(simulated_payment_method):
+    ledger = bpp.simulated.Simulated.configure(failure_rate=1)
+
+    payment_charge = simulated_charge(simulated_payment_method)
+    assert payment_charge.status == "failed"
+    assert payment_charge.data["processor_failure"] == "Simulated card declined"
+    assert ledger.declined == 1
+
+    bpp.simulated.Simulated.configure()
+    payment_charge = simulated_charge(simulated_payment_method)
+    assert payment_charge.status == "pending"
+
+    # rate limit errors fail new charges and leave synced charges pending
+    ledger = bpp.simulated.Simulated.configure(rate_limit_rate=1)
+    ledger.payment_intents.update(
+        {payment_charge.data["processor_txn_id"]: {"status": "succeeded"}}
+    )
+
+    simulated_payment_method.processor_instance.sync_charge(payment_charge)
+    assert payment_charge.status == "pending"
+
+    payment_charge = simulated_charge(simulated_payment_method)
+    assert payment_charge.status == "failed"
+    assert "rate limit" in payment_charge.data["processor_failure"]
+    assert ledger.rate_limited == 2
+
+
+@pytest.mark.django_db
+def test_simulated_processor_invoice_capture(billing_objects, simulated_payment_method):
+    ledger = bpp.simulated.Simulated.configure(settle_after=1)
+
+    invoice = models.Invoice.objects.create(
+        org=billing_objects.org,
+        order=models.Order.objects.create(org=billing_objects.org),
+    )
+    models.InvoiceLine.objects.create(
+        invoice=invoice, amount=25, description="Test invoice line"
+    )
+    simulated_payment_method.processor_instance.create_invoice(invoice)
+
+    assert invoice.sync_status() == "pending"
+    assert invoice.sync_status() == "ok"
+
+    # the paid invoice is captured as a payment charge of the payment method
+    payment_charge = invoice.charge_object
+    assert payment_charge.payment_method == simulated_payment_method
+    assert payment_charge.price == 25
+    assert payment_charge.status == "ok"
+    assert payment_charge.payment_transaction
+
+    assert ledger.requests_for("create_invoice") == 1
+    assert ledger.requests_for("sync_invoice") == 2
@@ -0,0 +1,334 @@
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+import requests.exceptions
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from account.models import InternalAPIKey, Organization
+from applications.models import Service
+from billing.models import SubscriptionCycleProduct, UsageSample
+from billing.usage import UsageCollector, ingest_usage
+
+USAGE_DOCUMENT = [
+    {"name": "test.subscription.metered", "units": 10},
+    {"name": "test.subscription.other", "units": 3},
+]
+
+
+class FakeServiceBridgeHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        try:
+            time.sleep(server.delay)
+
+            org_slug = self.path.strip("/").split("/")[-1]
+
+            with server.lock:
+                fail = server.failures.get(org_slug, 0)
+                if fail:
+                    server.failures[org_slug] = fail - 1
+
+            if fail:
+                self.send_response(500)
+                self.end_headers()
+                return
+
+            body = json.dumps({"data": USAGE_DOCUMENT}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_service_bridge():
+    """
+    Local HTTP server answering service bridge usage requests
+
+    Set `delay` to slow down responses and `failures` (org slug -> count)
+    to answer with server errors
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServiceBridgeHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.delay = 0
+    server.failures = {}
+    server.requests = 0
+    server.in_flight = 0
+    server.max_in_flight = 0
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def usage_service(db, fake_service_bridge):
+    InternalAPIKey.require()
+    host, port = fake_service_bridge.server_address
+    return Service.objects.create(
+        slug="usage", name="usage", api_url=f"http://{host}:{port}"
+    )
+
+
+def create_orgs(count):
+    return [
+        Organization.objects.create(name=f"Usage Org {i}", slug=f"usage_org_{i}")
+        for i in range(count)
+    ]
+
+
+@pytest.mark.django_db
+def test_usage_collector(billing_objects):
+    service = Service.objects.create(
+        slug="usage", name="usage", api_url="https://usage.localhost"
+    )
+    org = billing_objects.org
+    collector = UsageCollector()
+
+    with patch(
+        "applications.service_bridge.Bridge.usage_document",
+        return_value=USAGE_DOCUMENT,
+    ) as usage_document, patch(
+        "applications.service_bridge.Bridge.__init__", return_value=None
+    ):
+        assert collector.usage(service, org, "test.subscription.metered") == 10
+        assert collector.usage(service, org, "test.subscription.other") == 3
+        assert collector.usage(service, org, "test.subscription.missing") is None
+
+    assert usage_document.call_count == 1
+    assert collector.requests == 1
+    assert collector.lookups == 3
+    assert collector.saved == 2
+
+
+def test_usage_collector_prefetch(usage_service, fake_service_bridge):
+    orgs = create_orgs(6)
+    fake_service_bridge.delay = 0.3
+
+    collector = UsageCollector(concurrency=3)
+
+    t = time.monotonic()
+    fetched = collector.prefetch([(usage_service, org) for org in orgs])
+    elapsed = time.monotonic() - t
+
+    assert fetched == 6
+    assert not collector.errors
+    assert fake_service_bridge.requests == 6
+    assert fake_service_bridge.max_in_flight == 3
+
+    # two rounds of 3 concurrent requests rather than 6 sequential ones
+    assert elapsed < 6 * 0.3
+
+    for org in orgs:
+        assert collector.usage(usage_service, org, "test.subscription.metered") == 10
+
+    # no additional requests after prefetching
+    assert fake_service_bridge.requests == 6
+    assert collector.saved == 0
+
+
+def test_usage_collector_prefetch_retry(usage_service, fake_service_bridge):
+    (org,) = create_orgs(1)
+    fake_service_bridge.failures[org.slug] = 2
+
+    collector = UsageCollector(retries=2, retry_backoff=0)
+    collector.prefetch([(usage_service, org)])
+
+    assert not collector.errors
+    assert fake_service_bridge.requests == 3
+    assert collector.usage(usage_service, org, "test.subscription.other") == 3
+
+
+def test_usage_collector_prefetch_timeout(usage_service, fake_service_bridge):
+    (org,) = create_orgs(1)
+    fake_service_bridge.delay = 1
+
+    collector = UsageCollector(timeout=0.2, retries=1, retry_backoff=0)
+    collector.prefetch([(usage_service, org)])
+
+    assert fake_service_bridge.requests == 2
+    assert (usage_service.id, org.id) in collector.errors
+
+    # prefetch errors are raised when the usage is collected
+    with pytest.raises((requests.exceptions.Timeout, TimeoutError)):
+        collector.usage(usage_service, org, "test.subscription.metered")
+
+
+def test_billing_cycles_prefetch_usage(
+    db, usage_service, billing_objects, fake_service_bridge
+):
+    billing_objects.product_subscription_metered.component = usage_service
+    billing_objects.product_subscription_metered.save()
+
+    call_command("billing_cycles", commit=True)
+
+    # both subscriptions of the org share a single usage request
+    assert fake_service_bridge.requests == 1
+
+    for subscription in [
+        billing_objects.monthly_subscription,
+        billing_objects.yearly_subscription,
+    ]:
+        cycle_product = SubscriptionCycleProduct.objects.get(
+            subscription_cycle__subscription=subscription
+        )
+        assert cycle_product.usage == 10
+
+
+def start_cycles(billing_objects, service):
+    billing_objects.product_subscription_metered.component = service
+    billing_objects.product_subscription_metered.save()
+
+    for subscription in [
+        billing_objects.monthly_subscription,
+        billing_objects.yearly_subscription,
+    ]:
+        subscription.start_subscription_cycle()
+
+
+@pytest.mark.django_db
+def test_ingest_usage(billing_objects):
+    service = Service.objects.create(
+        slug="usage", name="usage", api_url="https://usage.localhost"
+    )
+    start_cycles(billing_objects, service)
+    org = billing_objects.org
+    now = timezone.now()
+
+    stored, ignored = ingest_usage(
+        service,
+        [
+            {"org": org.slug, "product": "test.subscription.metered", "units": 5},
+            {
+                "org": org.slug,
+                "product": "test.subscription.metered",
+                "units": 7,
+                "timestamp": now + datetime.timedelta(minutes=1),
+            },
+            # before the current cycles
+            {
+                "org": org.slug,
+                "product": "test.subscription.metered",
+                "units": 1,
+                "timestamp": now - datetime.timedelta(days=400),
+            },
+            {"org": org.slug, "product": "test.subscription.missing", "units": 1},
+            {"org": "missing", "product": "test.subscription.metered", "units": 1},
+        ],
+    )
+
+    assert (stored, ignored) == (2, 3)
+
+    # a sample is stored for each subscription with the product
+    assert UsageSample.objects.count() == 4
+    latest = UsageSample.objects.latest_per_product()
+    assert sorted(latest.values_list("units", flat=True)) == [7, 7]
+
+    series = list(UsageSample.objects.downsample("day"))
+    assert [row["units"] for row in series] == [7, 7]
+
+
+@pytest.mark.django_db
+def test_usage_push_api(billing_objects):
+    service = Service.objects.create(
+        slug="usage", name="usage", api_url="https://usage.localhost"
+    )
+    start_cycles(billing_objects, service)
+    org = billing_objects.org
+    client = billing_objects.api_client
+    billing_objects.user.grainy_permissions.add_permission("service_bridge", 15)
+
+    url = reverse("service_bridge_api:service-bridge-data-usage-list")
+    data = {
+        "service_slug": service.slug,
+        "samples": [
+            {"org": org.slug, "product": "test.subscription.metered", "units": 4},
+            {"org": org.slug, "product": "test.subscription.other", "units": 4},
+        ],
+    }
+
+    # usage cannot be pushed for services the key has no access to
+    response = client.post(url, data, format="json")
+    assert response.status_code == 403
+    assert not UsageSample.objects.exists()
+
+    billing_objects.user.grainy_permissions.add_permission(
+        f"service.{service.slug}", 15
+    )
+
+    response = client.post(url, data, format="json")
+    assert response.status_code == 200
+    assert response.json()["data"][0] == {"stored": 1, "ignored": 1}
+
+    response = client.post(
+        url,
+        {"service_slug": "missing", "samples": []},
+        format="json",
+    )
+    assert response.status_code == 400
+    assert set(response.json()["errors"]) == {"service_slug", "samples"}
+
+    response = client.get(
+        url, {"org": org.slug, "product": "test.subscription.metered", "bucket": "hour"}
+    )
+    assert response.status_code == 200
+    assert [row["units"] for row in response.json()["data"]] == [4, 4]
+
+    response = client.get(url, {"org": org.slug})
+    assert response.status_code == 400
+
+
+def test_billing_cycles_pushed_usage(
+    db, usage_service, billing_objects, fake_service_bridge
+):
+    start_cycles(billing_objects, usage_service)
+    ingest_usage(
+        usage_service,
+        [
+            {
+                "org": billing_objects.org.slug,
+                "product": "test.subscription.metered",
+                "units": 25,
+            }
+        ],
+    )
+
+    call_command("billing_cycles", commit=True, all=True)
+
+    # pushed usage is billed without requesting it from the service
+    assert fake_service_bridge.requests == 0
+
+    for subscription in [
+        billing_objects.monthly_subscription,
+        billing_objects.yearly_subscription,
+    ]:
+        cycle_product = SubscriptionCycleProduct.objects.get(
+            subscription_cycle__subscription=subscription
+        )
+        assert cycle_product.usage == 25
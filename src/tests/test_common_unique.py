@@ -0,0 +1,46 @@
+from unittest.mock import patch
+
+import pytest
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
+
+from account.models import Organization
+from billing.models import Order, order_numbers
+from common.unique import TokenAllocator
+
+
+@pytest.mark.django_db
+def test_token_allocator_create(billing_objects):
+    org = billing_objects.org
+
+    with CaptureQueriesContext(connection) as ctx:
+        order = order_numbers.create(org=org)
+
+    assert order.order_number
+    assert Order.objects.get(order_number=order.order_number) == order
+
+    # no probing for existing values before the insert
+    assert not [q for q in ctx.captured_queries if q["sql"].startswith("SELECT")]
+
+
+@pytest.mark.django_db
+def test_token_allocator_create_collision(billing_objects):
+    org = billing_objects.org
+    existing = order_numbers.create(org=org)
+
+    tokens = iter([existing.order_number, "new-order-number"])
+
+    with patch("common.unique.unique_token", side_effect=lambda *args: next(tokens)):
+        order = order_numbers.create(org=org)
+
+    assert order.order_number == "new-order-number"
+    assert Order.objects.filter(order_number=existing.order_number).count() == 1
+
+
+@pytest.mark.django_db
+def test_token_allocator_create_integrity_error(billing_objects):
+    # violations of other unique constraints are not retried
+    allocator = TokenAllocator(Organization, "slug", nbytes=8, lower=True)
+
+    with pytest.raises(IntegrityError):
+        allocator.create(name=billing_objects.org.name)